@@ -58,49 +58,152 @@ H - безнаковое короткое (unsigned short), 2 байта
 DNS_HEADER_FORMAT = '>HHHHHH'
 
 
+HEADER_STRUCT = struct.Struct(DNS_HEADER_FORMAT)  # Заранее скомпилированные форматы,
+RESOURCE_STRUCT = struct.Struct('>HHIH')  # чтобы struct не разбирал строку формата на каждый вызов
+QUESTION_STRUCT = struct.Struct('>HH')
+
+MAX_NAME_LENGTH = 255  # Больше 255 байт доменное имя быть не может (RFC 1035)
+MAX_POINTER_JUMPS = 127  # Больше прыжков по указателям сжатия в одном имени не бывает
+
+
 # decompressors for RDATA
-def decompress_r_data(r_type, r_len, stream):
-    """Метод для распаковки данных ресурсных записей. Пришлось вывести из-за записей типа ns и cname"""
-    """Пояснение, почему к ответам типа ns и cname такое особое отношение.
+def decompress_r_data(r_type, r_len, buf, offset):
+    """Метод для распаковки данных ресурсных записей. Пришлось вывести из-за записей,
+    в данных которых лежат доменные имена (ns, cname, ptr, mx, soa)"""
+    """Пояснение, почему к таким ответам особое отношение.
     У них в r_data зашиты доменные имена, а не ip, как, например, у записей типа A.
-    Поэтому приходится их распаковывать особым образом"""
-    if r_type in [2, 5]:
-        return pack_address(parse_address(stream).decode())
-    return stream.read(r_len)  # Если у нас просто ip, то тупо считываем нужное число байт
+    А имена внутри пакета могут быть сжаты, т.е. ссылаться на другие места пакета.
+    Вне пакета такие ссылки ничего не значат, поэтому имена приходится разворачивать"""
+    end = offset + r_len
+    if r_type in (2, 5, 12):  # NS, CNAME, PTR - в данных только имя
+        return read_wire_name(buf, offset)[0]
+    if r_type == 15:  # MX - 2 байта приоритета, затем имя
+        return bytes(buf[offset:offset + 2]) + read_wire_name(buf, offset + 2)[0]
+    if r_type == 6:  # SOA - два имени, а за ними 5 чисел по 4 байта
+        m_name, offset = read_wire_name(buf, offset)
+        r_name, offset = read_wire_name(buf, offset)
+        return m_name + r_name + bytes(buf[offset:end])
+    return bytes(buf[offset:end])  # Если у нас просто ip, то тупо копируем нужное число байт
 
 
-def parse_address(stream):
-    """Метод для распаковки доменного имени из пришедшего пакета"""
-    if type(stream) == bytearray:
-        stream = io.BytesIO(stream)
-    name = bytearray()  # создаем под результат bytearray
+def read_labels(buf, offset):
+    """Метод для распаковки доменного имени из пакета, начиная со смещения offset.
+    Возвращает список меток (кусочков имени между точками) и смещение сразу за именем"""
+    """ПОЯСНЕНИЕ! Имена доменов внутри пакета записываются так:
+    имя разбито на домены (по точкам, в смысле).
+    Каждый такой кусочек записывается следующим образом:
+    байт на указание количества знаков в поддомене, а затем эти самые знаки
+    (например, 2 e1 2 ru) Но есть нюанс, как всегда! В байте счетчика значения могут быть от 0 до 63,
+    а если 2 первых бита выставлены в 1, то это признак использования сжатия.
+    Сжатие работает так. Первые 2 бита - единицы, а остальные 14 бит указывают смещение от начала пакета.
+    И запись доменного имени заканчивается зануленным байтом"""
+    """Раньше мы на каждый указатель рекурсивно вызывали сами себя и прыгали по потоку туда-обратно.
+    Теперь просто двигаем смещение внутри буфера. Чтобы хитро составленный пакет
+    не загнал нас в бесконечный цикл, указатель обязан смотреть строго назад,
+    а число прыжков и длина имени ограничены"""
+    labels = []
+    end = None  # Смещение сразу за именем (там, где оно лежит, а не куда нас завели указатели)
+    jumps = 0
+    length = 1  # Длина имени в байтах (с учетом завершающего нулевого байта)
     while True:
-        """ПОЯСНЕНИЕ! Внутри цикла есть break, который точно отработает 
-        (если, конечно, мы ему сами нарочно не подсунет самолично сделанный фальшивый пакет)"""
-        n = stream.read(1)[0]  # Считываем один байт (читаем именно так, чтобы байт перевелся сразу в число
-        """ПОЯСНЕНИЕ! Имена доменов внутри пакета записываются так:
-        имя разбито на домены (по точкам, в смысле).
-        Каждый такой кусочек записывается следующим образом:
-        байт на указание количества знаков в поддомене, а затем эти самые знаки
-        (например, 2 e1 2 ru) Но есть нюанс, как всегда! В байте счетчика значения могут быть от 0 до 63,
-        а если 2 первых байта выставлены в 1, то это признак использования сжатия. 
-        Сжатие работает так. Первые 2 бита - единицы, а остальные 6 бит указывают смещение от начала пакета.
-        И запись доменного имени заканчивается зануленным байтом"""
-        if n & 0xC0:
+        n = buf[offset]
+        if n >= 0xC0:
             """Вот этот if сработает, если напоролись на сжатие"""
-            m = stream.read(1)[0]  # Считываем следующий байт
-            sub_name_offset = ((n & 0x3F) << 8) | m  # Вычисляем смещение относительно начала пакета
-            current_offset = stream.tell()  # Спрашиваем текущее смещение
-            stream.seek(sub_name_offset)  # Устанавливаем нужное нам
-            sub_name = parse_address(stream)  # И уже оттуда забираем кусочек имени, нужный нам
-            stream.seek(current_offset)  # Возвращаем указатель туда, где он был
-            name.extend(sub_name)  # Добавляем к результату этот самый кусочек
-            return name  # Возвращаем результат
+            pointer = ((n & 0x3F) << 8) | buf[offset + 1]  # Вычисляем смещение относительно начала пакета
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if pointer >= offset or jumps > MAX_POINTER_JUMPS:
+                raise ValueError('Compression pointer loop at offset {}'.format(offset))
+            offset = pointer
+            continue
+        if n > 63:
+            raise ValueError('Bad label length {} at offset {}'.format(n, offset))
         if not n:
             """Вот этот if отработает, когда напорется на байт нулей"""
             break
-        name.extend(stream.read(n))  # Если у нас штатная ситуация (не сжатие),
-        # то мы добавим к результату столько байт, сколько указано в байте-счетчике
+        length += n + 1
+        if length > MAX_NAME_LENGTH:
+            raise ValueError('Domain name is too long at offset {}'.format(offset))
+        labels.append(buf[offset + 1:offset + 1 + n])  # Срез memoryview - это не копия, а окошко в пакет
+        offset += n + 1
+    if end is None:
+        end = offset + 1
+    return labels, end
+
+
+def read_name(buf, offset, names=None):
+    """Читает имя из пакета и возвращает его строкой вида 'e1.ru.' и смещение сразу за ним.
+    names - словарь смещение -> уже распакованное имя в пределах одного пакета"""
+    """ПОЯСНЕНИЕ! В ответах имена владельцев записей почти всегда сжаты до одного указателя
+    на имя, которое мы уже распаковали (обычно на имя из запроса). Такие имена берем из словаря,
+    не разбирая метки заново"""
+    n = buf[offset]
+    if names is not None and n >= 0xC0:
+        pointer = ((n & 0x3F) << 8) | buf[offset + 1]
+        name = names.get(pointer)
+        if name is not None:
+            return name, offset + 2
+        if pointer >= offset:
+            raise ValueError('Compression pointer loop at offset {}'.format(offset))
+        names[pointer] = read_name(buf, pointer)[0]  # Если на это место сошлются еще раз, имя уже будет готово
+        return names[pointer], offset + 2
+    labels, end = read_labels(buf, offset)
+    name = (b'.'.join(labels) + b'.').decode() if labels else ''  # Пустое имя - это корень
+    if names is not None:
+        names[offset] = name
+    return name, end
+
+
+def read_wire_name(buf, offset):
+    """Читает имя из пакета и возвращает его в несжатом wire-формате (длина-метка...0)
+    и смещение сразу за ним. Так не нужно гонять имя через строку и обратно"""
+    """Здесь метки по отдельности нам не нужны, поэтому копируем имя целыми кусками:
+    от начала имени (или места, куда привел указатель) до следующего указателя или нулевого байта.
+    Проверки на зацикливание те же, что и в read_labels"""
+    parts = []
+    start = offset
+    end = None
+    jumps = 0
+    length = 1
+    while True:
+        n = buf[offset]
+        if n >= 0xC0:
+            parts.append(buf[start:offset])
+            pointer = ((n & 0x3F) << 8) | buf[offset + 1]
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if pointer >= offset or jumps > MAX_POINTER_JUMPS:
+                raise ValueError('Compression pointer loop at offset {}'.format(offset))
+            offset = start = pointer
+            continue
+        if n > 63:
+            raise ValueError('Bad label length {} at offset {}'.format(n, offset))
+        if not n:
+            break
+        length += n + 1
+        if length > MAX_NAME_LENGTH:
+            raise ValueError('Domain name is too long at offset {}'.format(offset))
+        offset += n + 1
+    parts.append(buf[start:offset + 1])  # Вместе с завершающим нулевым байтом
+    if end is None:
+        end = offset + 1
+    return b''.join(parts), end
+
+
+def parse_address(stream):
+    """Метод для распаковки доменного имени. Принимает байты (имя лежит в самом начале)
+    или поток io.BytesIO (имя лежит в текущей позиции потока)"""
+    if isinstance(stream, io.BytesIO):
+        offset = stream.tell()
+        labels, end = read_labels(memoryview(stream.getbuffer()), offset)
+        stream.seek(end)
+    else:
+        labels, _ = read_labels(memoryview(stream), 0)
+    name = bytearray()  # создаем под результат bytearray
+    for label in labels:
+        name.extend(label)
         name.extend(b'.')  # Ну и после каждого кусочка добавляем точку
     return name  # возвращаем результат
 
@@ -117,9 +220,78 @@ def pack_address(name):
     return result
 
 
+POINTER_STRUCT = struct.Struct('>H')
+NAME_R_TYPES = (2, 5, 6, 12, 15)  # Типы записей, в данных которых лежат имена (NS, CNAME, SOA, PTR, MX)
+
+
+"""EDNS0 (RFC 6891). Без него ответ по UDP не может быть больше 512 байт. С ним клиент кладет в additional
+псевдозапись OPT: имя - корень, тип 41, в поле класса - сколько байт он готов принять по UDP,
+в поле времени жизни - расширенный rcode, версия и флаги (например, DO для DNSSEC), в данных - опции."""
+OPT_TYPE = 41
+MIN_UDP_PAYLOAD = 512  # Столько по UDP можно всегда, даже без EDNS0
+DEFAULT_UDP_PAYLOAD = 1232  # Размер, с которым пакет точно не фрагментируется (рекомендация DNS Flag Day 2020)
+MAX_TCP_MESSAGE = 65535  # По TCP перед сообщением идут 2 байта длины, так что больше не бывает
+FLAG_TC = 0x0200  # Флаг "обрезано": ответ не влез, переспросите по TCP
+OPT_STRUCT = struct.Struct('>BHHIH')  # Вся запись OPT без опций: корень, тип, размер, флаги, длина данных
+
+
+def make_opt(payload=DEFAULT_UDP_PAYLOAD):
+    """Создает запись OPT, объявляющую, что мы принимаем по UDP до payload байт"""
+    return DnsResource('', OPT_TYPE, payload, 0, b'')
+
+
+def append_opt(raw_packet, payload=DEFAULT_UDP_PAYLOAD):
+    """Дописывает запись OPT в конец уже собранного пакета (bytearray) и увеличивает счетчик additional.
+    OPT может лежать в additional где угодно, так что перепаковывать пакет ради нее незачем"""
+    ar_count, = POINTER_STRUCT.unpack_from(raw_packet, 10)
+    POINTER_STRUCT.pack_into(raw_packet, 10, ar_count + 1)
+    raw_packet.extend(OPT_STRUCT.pack(0, OPT_TYPE, payload, 0, 0))
+    return raw_packet
+
+
+def read_opt_payload(buf, offset):
+    """Если по смещению лежит запись OPT без опций или с опциями, возвращает заявленный в ней размер
+    UDP-пакета и смещение за записью, иначе None"""
+    if offset + OPT_STRUCT.size > len(buf):
+        return None
+    root, r_type, payload, _, r_len = OPT_STRUCT.unpack_from(buf, offset)
+    if root or r_type != OPT_TYPE:
+        return None
+    return payload, offset + OPT_STRUCT.size + r_len
+
+
+def write_name(result, name, offsets):
+    """Метод для запаковки доменного имени со сжатием (RFC 1035, 4.1.4).
+    Дописывает имя в конец result. offsets - словарь суффикс имени -> смещение в пакете,
+    по которому этот суффикс уже записан. Возвращает, сколько байт сэкономило сжатие"""
+    """ПОЯСНЕНИЕ! Идем по суффиксам имени от самого длинного: для www.e1.ru. это www.e1.ru, e1.ru, ru.
+    Как только суффикс уже встречался в пакете, вместо него пишем 2 байта указателя на него и заканчиваем.
+    А все суффиксы, которые записали сами, запоминаем, чтобы на них могли сослаться следующие имена"""
+    labels = name.split('.')
+    if labels[-1] == '':
+        labels.pop()  # Имя заканчивается точкой, последний кусочек пустой
+    for i in range(len(labels)):
+        suffix = '.'.join(labels[i:]).lower()  # Имена регистронезависимы
+        pointer = offsets.get(suffix)
+        if pointer is not None:
+            result.extend(POINTER_STRUCT.pack(0xC000 | pointer))
+            return len(suffix)  # Суффикс занял бы len(suffix) + 2 байта, а указатель - 2
+        if len(result) < 0x4000:
+            offsets[suffix] = len(result)  # Указатель может ссылаться только на первые 16 Кб пакета
+        label = labels[i].encode()
+        result.append(len(label))
+        result.extend(label)
+    result.append(0)
+    return 0
+
+
 class DnsResource:
     """Класс для создания, хранения, упаковки и распаковки ответов,
     additional и authority"""
+    """__slots__ - чтобы у каждой записи не было своего __dict__: записей в кэше много,
+    а так каждая занимает заметно меньше памяти"""
+    __slots__ = ('r_name', 'r_type', 'r_class', 'r_ttl', 'r_len', 'r_data')
+
     def __init__(self, r_name, r_type, r_class, r_ttl, r_data):
         self.r_name = r_name  # Доменное имя
         self.r_type = r_type  # Тип записи
@@ -142,15 +314,19 @@ class DnsResource:
             self.r_data)
 
     @staticmethod
-    def parse_resource(stream):
-        """Метод для распаковки инфы из полученного пакета"""
-        r_name = parse_address(stream).decode()  # Вынимаем доменное имя
+    def parse_resource(buf, offset, names=None):
+        """Метод для распаковки инфы из полученного пакета (buf - memoryview всего пакета).
+        Возвращает запись и смещение сразу за ней"""
+        r_name, offset = read_name(buf, offset, names)  # Вынимаем доменное имя
         r_type, r_class, r_ttl, r_len = \
-            struct.unpack('>HHIH', stream.read(10))  # Вынимаем тип записи,
+            RESOURCE_STRUCT.unpack_from(buf, offset)  # Вынимаем тип записи,
         # класс записи, время жизни, длину данных)
-        r_data = decompress_r_data(r_type, r_len, stream)  # Распаковываем данные на основании полученной инфы
-        return DnsResource(r_name, r_type, r_class, r_ttl, r_data)  # Возвращаем новый объект ресурсной записи,
-        # созданный на основании полученных данных
+        offset += RESOURCE_STRUCT.size
+        if offset + r_len > len(buf):
+            raise ValueError('Resource data is out of packet')
+        r_data = decompress_r_data(r_type, r_len, buf, offset)  # Распаковываем данные на основании полученной инфы
+        return DnsResource(r_name, r_type, r_class, r_ttl, r_data), offset + r_len  # Возвращаем новый объект
+        # ресурсной записи, созданный на основании полученных данных
 
     def to_bytes(self):
         """Метод для запаковки данных в ресурсную запись"""
@@ -161,6 +337,40 @@ class DnsResource:
         result.extend(self.r_data)  # Данные просто добавляем (с ними и так все в порядке)
         return result  # возвращаем пользователю уже байты
 
+    def write(self, result, offsets, ttl_offsets=None):
+        """Метод для запаковки записи прямо в пакет со сжатием имен (см. write_name).
+        Возвращает, сколько байт сэкономило сжатие. Если передан ttl_offsets,
+        дописывает в него смещение поля времени жизни этой записи в пакете"""
+        saved = write_name(result, self.r_name, offsets)
+        if ttl_offsets is not None:
+            ttl_offsets.append(len(result) + 4)  # Перед временем жизни лежат тип и класс по 2 байта
+        if self.r_type not in NAME_R_TYPES:
+            result.extend(RESOURCE_STRUCT.pack(self.r_type, self.r_class, self.r_ttl, self.r_len))
+            result.extend(self.r_data)
+            return saved
+        """Имена в данных тоже сжимаем, поэтому длину данных узнаем только после записи"""
+        header_offset = len(result)
+        result.extend(bytes(RESOURCE_STRUCT.size))
+        saved += self.write_r_data(result, offsets)
+        r_len = len(result) - header_offset - RESOURCE_STRUCT.size
+        RESOURCE_STRUCT.pack_into(result, header_offset, self.r_type, self.r_class, self.r_ttl, r_len)
+        return saved
+
+    def write_r_data(self, result, offsets):
+        """Метод для запаковки данных записи, в которых лежат имена"""
+        r_data = self.r_data
+        offset = 0
+        if self.r_type == 15:
+            result.extend(r_data[:2])  # Приоритет MX
+            offset = 2
+        name, offset = read_name(r_data, offset)
+        saved = write_name(result, name, offsets)
+        if self.r_type == 6:
+            name, offset = read_name(r_data, offset)  # У SOA второе имя (почта админа)
+            saved += write_name(result, name, offsets)
+            result.extend(r_data[offset:])  # И числа
+        return saved
+
     def __eq__(self, other):
         """Метод для проверки ресурсных записей на равенство"""
         if type(other) == DnsResource:
@@ -173,6 +383,8 @@ class DnsResource:
 
 class DnsQuestion:
     """Класс для работы с dns запросами"""
+    __slots__ = ('q_name', 'q_type', 'q_class')  # См. DnsResource
+
     def __init__(self, q_name, q_type, q_class):
         self.q_name = q_name  # Доменное имя
         self.q_type = q_type  # Тип запроса
@@ -199,12 +411,12 @@ class DnsQuestion:
         return False
 
     @staticmethod
-    def parse_question(stream):
-        """Метод для распаковки запроса"""
-        q_name = parse_address(stream).decode()  # Сначала вытаскиваем из запроса имя запрашиваемого домена
-        q_type, q_class = struct.unpack('>HH', stream.read(4))  # Затем вынимаем информацию о типе
+    def parse_question(buf, offset, names=None):
+        """Метод для распаковки запроса. Возвращает запрос и смещение сразу за ним"""
+        q_name, offset = read_name(buf, offset, names)  # Сначала вытаскиваем из запроса имя запрашиваемого домена
+        q_type, q_class = QUESTION_STRUCT.unpack_from(buf, offset)  # Затем вынимаем информацию о типе
         # запроса и классе запроса (класс запроса обычно равен 1, с другим не сталкивался)
-        return DnsQuestion(q_name, q_type, q_class)  # Возвращаем новый запрос, созданный по вытянутой инфе
+        return DnsQuestion(q_name, q_type, q_class), offset + QUESTION_STRUCT.size
 
     def to_bytes(self):
         result = bytearray()
@@ -212,6 +424,12 @@ class DnsQuestion:
         result.extend(struct.pack('>HH', self.q_type, self.q_class))
         return result
 
+    def write(self, result, offsets):
+        """Метод для запаковки запроса прямо в пакет со сжатием имени (см. write_name)"""
+        saved = write_name(result, self.q_name, offsets)
+        result.extend(QUESTION_STRUCT.pack(self.q_type, self.q_class))
+        return saved
+
 
 class DNSPacket:
     """Класс, позволяющий хранить пакет
@@ -223,9 +441,15 @@ class DNSPacket:
         # ответ на какой запрос они получили)
         self.flags = flags  # Флаги (первые 12 байт пакета)
         self.question = question  # запросы
-        self.answer = answer  # ответы
-        self.authority = authority  # Дополнительная инфа от авторитетных серваков
-        self.additional = additional  # Еще дополнительная инфа от авторитетных серваков
+        self._answer = answer  # ответы
+        self._authority = authority  # Дополнительная инфа от авторитетных серваков
+        self._additional = additional  # Еще дополнительная инфа от авторитетных серваков
+        self._raw = None  # Сырой пакет, если ответы, authority и additional еще не распакованы
+        self._counts = None  # (an_count, ns_count, ar_count) из заголовка сырого пакета
+        self._offset = 0  # Смещение, с которого в сыром пакете начинаются ответы
+        self._names = None  # Уже распакованные имена сырого пакета (смещение -> имя)
+        self.compression_saved = 0  # Сколько байт сэкономило сжатие имен при последнем to_bytes
+        self.ttl_offsets = []  # Смещения полей времени жизни записей при последнем to_bytes
         """НА ЗАМЕТОЧКУ! Разница между authority и additional.
         В первое авторитетные серваки помещают записи ns всех днс-серваков для конкретного домена, 
         а во второе авторитетные серваки помещают  ip для днс-серваков, 
@@ -236,60 +460,117 @@ class DNSPacket:
         имена серваков в других доменах тоже нельзя, иначе нах их вообще заводить?
         Вот и приходится разводить эти два случая по разные углы."""
 
+    """ПОЯСНЕНИЕ! Пакет распаковывается лениво. from_bytes разбирает только заголовок и запросы
+    (а серваку на горячем пути больше ничего и не надо), а ответы, authority и additional
+    распаковываются при первом обращении к ним."""
+    @property
+    def answer(self):
+        if self._raw is not None:
+            self.parse_sections()
+        return self._answer
+
+    @property
+    def authority(self):
+        if self._raw is not None:
+            self.parse_sections()
+        return self._authority
+
+    @property
+    def additional(self):
+        if self._raw is not None:
+            self.parse_sections()
+        return self._additional
+
+    def parse_sections(self):
+        """Метод, распаковывающий ответы, authority и additional из сырого пакета"""
+        buf, offset, names = self._raw, self._offset, self._names
+        an_count, ns_count, ar_count = self._counts
+        sections = []
+        for count in (an_count, ns_count, ar_count):
+            section = []
+            for i in range(count):
+                resource, offset = DnsResource.parse_resource(buf, offset, names)
+                section.append(resource)
+            sections.append(section)
+        self._answer, self._authority, self._additional = sections
+        self._raw = self._names = None  # Пакет больше не нужен, отпускаем его
+
     def to_bytes(self):
         """Метод для перевода пакета в байты"""
-        header = struct.pack(
-            DNS_HEADER_FORMAT, self.packet_id, self.flags,
+        header = HEADER_STRUCT.pack(
+            self.packet_id, self.flags,
             len(self.question), len(self.answer),
             len(self.authority), len(self.additional)  # Запаковываем заголовок
         )
         result = bytearray()
         result.extend(header)
-        """Присовокупляем к нему в правильном порядке остальные части пакета"""
+        """Присовокупляем к нему в правильном порядке остальные части пакета.
+        Имена при этом сжимаем: повторяющиеся суффиксы заменяем указателями на первое их вхождение"""
+        offsets = {}
+        saved = 0
+        ttl_offsets = []  # Смещения полей времени жизни всех записей (нужны кэшу готовых ответов)
         for question in self.question:
-            result.extend(question.to_bytes())
+            saved += question.write(result, offsets)
         for answer in self.answer:
-            result.extend(answer.to_bytes())
+            saved += answer.write(result, offsets, ttl_offsets)
         for authority in self.authority:
-            result.extend(authority.to_bytes())
+            saved += authority.write(result, offsets, ttl_offsets)
         for additional in self.additional:
-            result.extend(additional.to_bytes())
+            saved += additional.write(result, offsets, ttl_offsets)
+        self.compression_saved = saved  # Сколько байт сэкономило сжатие имен
+        self.ttl_offsets = ttl_offsets
         return result  # Возвращаем переведенный в байты пакет
 
     @staticmethod
-    def from_bytes(raw_packet):
+    def from_bytes(raw_packet, lazy=True):
         """Метод, позволяющий получить распарсенный dns пакет"""
         """
         Замечание!
-        Модуль io используется для работы с различными объектами ввода-вывода.
-        Мы конкретно используем т.н. Binary i/o.
+        Раньше пакет заворачивался в io.BytesIO и читался по байтику.
+        Теперь мы работаем со смещениями внутри memoryview пакета:
+        memoryview дает доступ к байтам пакета без копирования, а struct.unpack_from
+        читает числа прямо из него.
         """
-        stream = io.BytesIO(raw_packet)
-        """Распаковываем первые 12 байт, чтобы получить заголовок пакета и, 
+        buf = memoryview(raw_packet)
+        """Распаковываем первые 12 байт, чтобы получить заголовок пакета и,
         соответственно, данные о нем"""
         packet_id, flags, q_count, an_count, ns_count, ar_count = \
-            struct.unpack(DNS_HEADER_FORMAT, stream.read(12))
+            HEADER_STRUCT.unpack_from(buf, 0)
+        offset = HEADER_STRUCT.size
 
-        """создаем массивы под запросы, ответы, authority и additional 
-        (не знаю, как на русский грамотно перевести)"""
+        """Запросы забираем сразу, а остальное - когда понадобится"""
         questions = []
-        answers = []
-        authority = []
-        additional = []
-
-        """И теперь в зависимости от количества запросов, ответов и проч. забираем их из пакета"""
+        names = {}
         for i in range(q_count):
-            questions.append(DnsQuestion.parse_question(stream))
-        for i in range(an_count):
-            answers.append(DnsResource.parse_resource(stream))
-        for i in range(ns_count):
-            authority.append(DnsResource.parse_resource(stream))
-        for i in range(ar_count):
-            additional.append(DnsResource.parse_resource(stream))
-
-        return DNSPacket(packet_id,
-                         flags,
-                         questions,
-                         answers,
-                         authority,
-                         additional)
+            question, offset = DnsQuestion.parse_question(buf, offset, names)
+            questions.append(question)
+
+        packet = DNSPacket(packet_id, flags, questions, [], [], [])
+        packet._raw = buf
+        packet._counts = (an_count, ns_count, ar_count)
+        packet._offset = offset
+        packet._names = names
+        if not lazy:
+            packet.parse_sections()
+        return packet
+
+    def get_opt(self):
+        """Запись OPT пакета (EDNS0) или None, если клиент EDNS0 не использует"""
+        for additional in self.additional:
+            if additional.r_type == OPT_TYPE:
+                return additional
+        return None
+
+    def udp_limit(self, payload=DEFAULT_UDP_PAYLOAD):
+        """Сколько байт можно отправить в ответ на этот запрос по UDP: если клиент прислал OPT -
+        меньшее из его размера и нашего payload (но не меньше 512), иначе 512"""
+        opt = self.get_opt()
+        if opt is None:
+            return MIN_UDP_PAYLOAD
+        return max(MIN_UDP_PAYLOAD, min(opt.r_class, payload))
+
+    def truncated(self):
+        """Обрезанный вариант этого ответа: только вопрос, флаг TC и OPT, если он был"""
+        opt = self.get_opt()
+        return DNSPacket(self.packet_id, self.flags | FLAG_TC, self.question, [], [],
+                         [opt] if opt is not None else [])
@@ -0,0 +1,432 @@
+import asyncio
+import random
+import time
+from DNSPacketParser import DEFAULT_UDP_PAYLOAD
+from DnsTcp import LENGTH_STRUCT, TCP_IDLE_TIMEOUT, TCP_MAX_CONNECTIONS, TCP_MAX_PIPELINE, frame
+from DnsResolve import resolve_query, fetch_miss, refresh_stale, ask_forwarder, IO_UPSTREAM, IO_FORWARDER, IO_MISSES
+from DnsQueryLog import FLAG_TCP
+from DnsUpstream import UPSTREAM_POOL_SIZE, UPSTREAM_TIMEOUT, UPSTREAM_RETRIES, UPSTREAM_ROTATE_AFTER, \
+    UPSTREAM_TCP_TIMEOUT, question_key, reply_key, make_request, new_packet_id, is_truncated
+
+
+"""Движок сервака на asyncio. В отличие от обычного режима, где на каждый пришедший
+датаграмм создается отдельный поток, здесь все запросы крутятся в одном event loop-е:
+и прием запросов от клиентов, и общение с форвардером идут через DatagramProtocol.
+Пока один запрос ждет ответа форвардера, loop спокойно обслуживает остальные."""
+
+
+class ListenerProtocol(asyncio.DatagramProtocol):
+    """Протокол для слушающего сокета (того самого, что висит на 53 порту)"""
+    def __init__(self, engine):
+        self.engine = engine
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.engine.receive(data, addr)
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """Протокол для одного сокета из пула сокетов к форвардеру.
+    Пришедшие ответы просто отдаем пулу, он сам разберется, кому они"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.transport = None
+        self.uses = 0  # Сколько запросов ушло через этот сокет
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.pool.dispatch(data, addr)
+
+
+class AsyncUpstreamPool:
+    """Асинхронный аналог DnsUpstream.UpstreamPool: несколько долгоживущих сокетов
+    на случайных портах, ответы раздаются ждущим корутинам по ключу (идентификатор, вопрос).
+    Форвардера выбирает тот же UpstreamSelector, что и у пула потоков"""
+    def __init__(self, loop, selector, size=UPSTREAM_POOL_SIZE, timeout=UPSTREAM_TIMEOUT,
+                 retries=UPSTREAM_RETRIES, rotate_after=UPSTREAM_ROTATE_AFTER, payload=DEFAULT_UDP_PAYLOAD,
+                 hedge=False):
+        self.loop = loop
+        self.upstreams = selector
+        self.payload = payload
+        self.hedge = hedge
+        self.tcp = {stats.address: AsyncTcpUpstream(loop, stats.address, payload)
+                    for stats in selector.upstreams}  # Сюда идем, если ответ не влез в UDP
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.rotate_after = rotate_after
+        self.pending = {}  # (packet_id, ключ вопроса) -> (future, UpstreamStats, когда отправили)
+        self.endpoints = []
+
+    async def open_endpoint(self):
+        _, protocol = await self.loop.create_datagram_endpoint(
+            lambda: UpstreamProtocol(self), local_addr=('0.0.0.0', 0))  # Порт выбирает ядро
+        return protocol
+
+    async def start(self):
+        for _ in range(self.size):
+            self.endpoints.append(await self.open_endpoint())
+
+    def dispatch(self, data, addr):
+        match = reply_key(data)
+        if match is None:
+            return
+        entry = self.pending.get(match)
+        if entry is None or entry[1].address != addr:
+            return  # Ответ не от того форвардера, которого спрашивали, игнорируем
+        del self.pending[match]
+        future, stats, sent_at = entry
+        self.upstreams.answered(stats, time.monotonic() - sent_at)
+        if not future.done():
+            future.set_result((data, stats))
+
+    async def query(self, question):
+        """Задает вопрос форвардерам и возвращает сырой ответ (или None, если не дождались)"""
+        key = question_key(question)
+        future = self.loop.create_future()  # Общая на все запросы: кто первый ответил, того и берем
+        sent = []
+        tried = []
+        try:
+            for _ in range(self.retries + 1):
+                primary = self.upstreams.choose(exclude=tried)
+                attempt = [primary]
+                await self.send_query(primary, question, key, future, sent)
+                wait = self.timeout
+                if self.hedge:
+                    delay = self.upstreams.hedge_delay(primary)
+                    second = None
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future), delay)  # shield - чтобы таймаут
+                        # не отменил саму future
+                    except asyncio.TimeoutError:
+                        second = self.upstreams.other(primary)
+                    if second is not None:
+                        attempt.append(second)
+                        await self.send_query(second, question, key, future, sent)
+                    else:
+                        wait -= delay  # Второго не спросили - первый ждем до конца его таймаута
+                try:
+                    data, stats = await asyncio.wait_for(asyncio.shield(future), wait)
+                except asyncio.TimeoutError:
+                    for stats in attempt:
+                        if stats not in tried:
+                            self.upstreams.failed(stats)
+                    tried.extend(attempt)
+                    continue  # Переспросим с новым идентификатором
+                if len(attempt) > 1:
+                    self.upstreams.count_hedge(stats is not primary)
+                if is_truncated(data):
+                    return await self.tcp[stats.address].query(question)  # Ответ обрезан - переспрашиваем по TCP
+                return data
+            return None
+        finally:
+            for match in sent:
+                self.pending.pop(match, None)
+
+    async def send_query(self, stats, question, key, future, sent):
+        packet_id = new_packet_id(self.pending, key)
+        self.pending[(packet_id, key)] = (future, stats, time.monotonic())
+        sent.append((packet_id, key))
+        self.upstreams.sent(stats)
+        await self.send(make_request(packet_id, question, self.payload), stats.address)
+
+    async def send(self, data, address):
+        """Отправляет запрос через случайный сокет пула, заезженные сокеты пересоздает"""
+        index = random.randrange(len(self.endpoints))
+        endpoint = self.endpoints[index]
+        endpoint.transport.sendto(data, address)
+        endpoint.uses += 1
+        if endpoint.uses == self.rotate_after:
+            self.endpoints[index] = await self.open_endpoint()
+            """Старый сокет закроем чуть позже, чтобы успели прийти ответы на отправленные через него запросы"""
+            self.loop.call_later(self.timeout, endpoint.transport.close)
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.transport.close()
+        for tcp in self.tcp.values():
+            tcp.close()
+
+
+class AsyncTcpUpstream:
+    """Асинхронный аналог DnsUpstream.TcpUpstream: одно TCP-соединение с форвардером,
+    запросы идут по нему конвейером, ответы раздает корутина-читатель"""
+    def __init__(self, loop, address, payload=DEFAULT_UDP_PAYLOAD, timeout=UPSTREAM_TCP_TIMEOUT):
+        self.loop = loop
+        self.address = address
+        self.payload = payload
+        self.timeout = timeout
+        self.writer = None
+        self.connecting = None  # future подключения, чтобы одновременные запросы не открыли два соединения
+        self.pending = {}  # (packet_id, ключ вопроса) -> future, в которую упадет ответ
+
+    async def connect(self):
+        if self.writer is not None:
+            return self.writer
+        if self.connecting is None:
+            self.connecting = self.loop.create_task(asyncio.wait_for(
+                asyncio.open_connection(*self.address), self.timeout))
+        try:
+            reader, writer = await asyncio.shield(self.connecting)
+        finally:
+            self.connecting = None
+        if self.writer is None:
+            self.writer = writer
+            self.loop.create_task(self.receive_loop(reader, writer))
+        return self.writer
+
+    async def receive_loop(self, reader, writer):
+        try:
+            while True:
+                length = await reader.readexactly(LENGTH_STRUCT.size)
+                data = await reader.readexactly(LENGTH_STRUCT.unpack(length)[0])
+                match = reply_key(data)
+                future = self.pending.pop(match, None) if match is not None else None
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError):
+            pass  # Форвардер закрыл соединение
+        self.drop(writer)
+
+    def drop(self, writer):
+        """Забывает соединение и будит всех, кто ждал по нему ответа"""
+        if writer is not self.writer:
+            return
+        self.writer = None
+        writer.close()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(None)
+
+    async def query(self, question):
+        """Задает вопрос форвардеру по TCP; если соединение оборвалось, один раз пробуем через новое"""
+        key = question_key(question)
+        for _ in range(2):
+            packet_id = new_packet_id(self.pending, key)
+            future = self.loop.create_future()
+            self.pending[(packet_id, key)] = future
+            try:
+                writer = await self.connect()
+                writer.write(frame(make_request(packet_id, question, self.payload)))
+                data = await asyncio.wait_for(future, self.timeout)
+                if data is not None:
+                    return data
+            except (OSError, asyncio.TimeoutError):
+                return None
+            finally:
+                self.pending.pop((packet_id, key), None)
+        return None
+
+    def close(self):
+        if self.writer is not None:
+            self.drop(self.writer)
+
+
+class AsyncSingleFlight:
+    """Асинхронный аналог DnsUpstream.SingleFlight: на одинаковые вопросы
+    к форвардеру идет одна корутина, остальные ждут ее future"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.flights = {}  # ключ вопроса -> future с результатом
+        self.sent = 0  # Сколько запросов реально ушло к форвардеру
+        self.saved = 0  # Сколько запросов к форвардеру мы сэкономили
+
+    async def do(self, key, coroutine_function):
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.saved += 1
+            return await asyncio.shield(flight)  # shield - чтобы отмена ждущего не отменила запрос остальным
+        self.sent += 1
+        flight = self.flights[key] = self.loop.create_task(coroutine_function())
+        try:
+            return await asyncio.shield(flight)
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+
+class AsyncEngine:
+    """Собственно, движок. Работает поверх DnsServer: берет у него сокет, кэш и настройки"""
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        self.listener = None
+        self.upstream = None
+        self.flights = AsyncSingleFlight(None)
+        self.tasks = set()  # Держим ссылки на корутины, иначе сборщик мусора может их прибить
+        self.tcp_connections = 0  # Сколько TCP-соединений сейчас обслуживаем
+
+    def run(self):
+        """Запускает loop и крутится в нем, пока сервак не остановят"""
+        asyncio.run(self.main())
+
+    def spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.flights.loop = self.loop
+        listener_transport, self.listener = await self.loop.create_datagram_endpoint(
+            lambda: ListenerProtocol(self), sock=self.server.serve_socket)
+        tcp_server = await asyncio.start_server(self.serve_tcp, sock=self.server.tcp_socket)
+        self.upstream = AsyncUpstreamPool(self.loop, self.server.upstreams, payload=self.server.udp_payload,
+                                          hedge=self.server.hedge)
+        await self.upstream.start()
+        """Флаг server_runnable снимается из консоли, поэтому просто периодически его проверяем"""
+        while self.server.server_runnable:
+            await asyncio.sleep(0.5)
+        listener_transport.close()  # Новых запросов больше не принимаем
+        tcp_server.close()
+        if self.tasks:
+            await asyncio.wait(self.tasks)  # А начатые доделываем
+        self.upstream.close()
+
+    def receive(self, data, addr):
+        """Асинхронный аналог цикла DnsServer.run: лимит клиента, готовый ответ сразу,
+        а на остальные запросы - корутина, а не поток. Если корутин и так queue_size, запрос выкидываем"""
+        server = self.server
+        server.log.debug('Connection from {}', addr)
+        received = time.perf_counter()  # Для лога запросов
+        if server.rate_limiter is not None and not server.check_rate(data, addr, self.listener.transport.sendto):
+            return
+        raw_response = server.handle_cached(data, client=(addr, received))
+        if raw_response is not None:
+            self.send_response(raw_response, addr)
+        elif len(self.tasks) >= server.queue_size:
+            server.metrics.inc('shed_queries')
+            server.log.debug('Too many queries in progress, dropped query from {}', addr)
+            server.log_query((addr, received), data, None)
+        else:
+            self.spawn(self.serve_client(addr, data, received))
+
+    def send_response(self, raw_response, addr):
+        started = time.perf_counter()
+        self.listener.transport.sendto(raw_response, addr)
+        self.server.metrics.observe('send', time.perf_counter() - started)
+
+    async def get_from_forwarder(self, question):
+        """Асинхронный аналог DnsServer.get_from_forwarder"""
+        if not self.server.forwarder_on:
+            return []
+        return await self.flights.do(question_key(question),
+                                     lambda: self.drive(ask_forwarder(self.server, question)))
+
+    async def drive(self, steps):
+        """Асинхронный аналог DnsServer.drive: запросы ввода-вывода генератора из DnsResolve ждем через await"""
+        send, value = steps.send, None
+        try:
+            while True:
+                try:
+                    kind, argument = send(value)
+                except StopIteration as stop:
+                    return stop.value
+                try:
+                    send, value = steps.send, await self.do_io(kind, argument)
+                except Exception as ex:
+                    send, value = steps.throw, ex
+        finally:
+            steps.close()  # В том числе если корутину отменили
+
+    async def do_io(self, kind, argument):
+        server = self.server
+        if kind == IO_UPSTREAM:
+            return await self.upstream.query(argument)
+        if kind == IO_FORWARDER:
+            return await self.get_from_forwarder(argument)
+        if kind == IO_MISSES:
+            """Промахи пакета спрашиваем одновременно (их не больше MAX_QUESTIONS, см. DnsServer.check_questions)"""
+            return await asyncio.gather(*[self.drive(fetch_miss(server, question)) for question in argument],
+                                        return_exceptions=True)
+        """IO_REFRESH: обновление идет отдельной задачей, которая доработает и положит ответ в кэш,
+        даже если клиенту уже ушли протухшие записи"""
+        task = self.spawn(self.drive(refresh_stale(server, argument)))
+        done, _ = await asyncio.wait({task}, timeout=server.stale_deadline)
+        return task.result() if done else None
+
+    async def serve_client(self, addr, raw_packet, received):
+        """Асинхронный аналог DnsServer.serve_queued"""
+        raw_response = await self.resolve_query(raw_packet, client=(addr, received))
+        if raw_response is not None:
+            self.send_response(raw_response, addr)
+
+    async def serve_tcp(self, reader, writer):
+        """Обслуживает одно TCP-соединение клиента (см. DnsTcp.TcpListener): на каждый промах конвейера
+        своя корутина, ответы пишем по мере готовности. Ограничения те же, что и в режиме потоков"""
+        addr = writer.get_extra_info('peername')
+        if self.tcp_connections >= TCP_MAX_CONNECTIONS:
+            self.server.metrics.inc('tcp_refused')
+            self.server.log.debug('Too many TCP connections, refused {}', addr)
+            writer.close()
+            return
+        self.tcp_connections += 1
+        self.server.log.debug('TCP connection from {}', addr)
+        in_flight = asyncio.Semaphore(TCP_MAX_PIPELINE)
+        try:
+            while self.server.server_runnable:
+                length = await asyncio.wait_for(reader.readexactly(LENGTH_STRUCT.size), TCP_IDLE_TIMEOUT)
+                message = await asyncio.wait_for(reader.readexactly(LENGTH_STRUCT.unpack(length)[0]),
+                                                 TCP_IDLE_TIMEOUT)
+                await asyncio.wait_for(in_flight.acquire(), TCP_IDLE_TIMEOUT)
+                self.serve_tcp_message(writer, message, (addr, time.perf_counter()), in_flight)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass  # Клиент закрыл соединение или молчит слишком долго
+        try:
+            for _ in range(TCP_MAX_PIPELINE):
+                await in_flight.acquire()  # Доотвечаем на то, что уже спросили, и только потом закрываем
+        finally:
+            writer.close()
+            self.tcp_connections -= 1
+
+    def serve_tcp_message(self, writer, message, client, in_flight):
+        """Асинхронный аналог DnsTcp.TcpListener.serve_message: готовый ответ - сразу, промах - в корутину,
+        если их и так не queue_size. Место в in_flight освобождается, когда с запросом покончено"""
+        server = self.server
+        addr, received = client
+        if server.rate_limiter is not None and not server.check_rate(message, addr, None):
+            in_flight.release()
+            return
+        raw_response = server.handle_cached(message, tcp=True, client=client)
+        if raw_response is not None:
+            self.send_tcp(writer, raw_response)
+            in_flight.release()
+        elif len(self.tasks) >= server.queue_size:
+            server.metrics.inc('shed_queries')
+            server.log.debug('Too many queries in progress, dropped TCP query from {}', addr)
+            server.log_query(client, message, None, FLAG_TCP)
+            in_flight.release()
+        else:
+            self.spawn(self.resolve_tcp_message(writer, message, client, in_flight))
+
+    async def resolve_tcp_message(self, writer, message, client, in_flight):
+        try:
+            raw_response = await self.resolve_query(message, tcp=True, client=client)
+            if raw_response is not None:
+                self.send_tcp(writer, raw_response)
+        finally:
+            in_flight.release()
+
+    def send_tcp(self, writer, raw_response):
+        if writer.is_closing():
+            return
+        started = time.perf_counter()
+        writer.write(frame(raw_response))  # write не ждет, так что ответы не перемешаются
+        self.server.metrics.observe('send', time.perf_counter() - started)
+
+    async def handle_query(self, raw_packet, tcp=False, client=None):
+        """Асинхронный аналог DnsServer.handle_query"""
+        raw_response = self.server.handle_cached(raw_packet, tcp, client)
+        if raw_response is not None:
+            return raw_response
+        return await self.resolve_query(raw_packet, tcp, client)
+
+    async def resolve_query(self, raw_packet, tcp=False, client=None):
+        """Асинхронный аналог DnsServer.resolve_query"""
+        return await self.drive(resolve_query(self.server, raw_packet, tcp, client))
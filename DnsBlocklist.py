@@ -0,0 +1,214 @@
+import argparse
+import bisect
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+from array import array
+from DNSPacketParser import DnsResource
+
+
+"""Блоклист: домены рекламы, трекеров и малвари, на которые сервак отвечает сам (NXDOMAIN или адресом-заглушкой).
+В фидах миллионы имен, и множество питоновских строк на них съело бы гигабайты. Поэтому фиды заранее
+компилируются в файл: отсортированный массив 64-битных хэшей имен и фильтр Блума перед ним.
+Запуск компиляции: python DnsBlocklist.py compile blocklist.bin feed.txt [feed2.txt ...]
+Сервак открывает файл через mmap (--blocklist): загрузка мгновенная, память - 8 байт на имя
+плюс чуть больше байта на фильтр, а у воркеров страницы файла и вовсе общие."""
+"""ПОЯСНЕНИЕ! Правила бывают двух видов: "имя и все его поддомены" (строка фида - просто домен,
+или ||домен^ в формате adblock) и "ровно это имя" (строка в формате hosts: 0.0.0.0 домен).
+Вид правила - младший бит хэша, так что для вопроса a.b.example.com считаем хэши всех его суффиксов
+(a.b.example.com, b.example.com, example.com, com) и для каждого смотрим правило на поддомены,
+а для самого имени - еще и точное. Почти все имена в блоклисте отсутствуют, и фильтр Блума
+говорит это за несколько обращений к памяти, а бинарный поиск по массиву нужен только, когда фильтр
+ответил "может быть"."""
+
+FILE_MAGIC = b'DNSBLK1\n'
+HEADER_STRUCT = struct.Struct('<QQII')  # сколько хэшей, сколько бит в фильтре Блума, сколько хэш-функций, резерв
+BLOOM_BITS_PER_ENTRY = 10  # С 7 хэш-функциями это ~1% ложных "может быть"
+BLOOM_HASHES = 7
+KIND_SUBTREE = 1  # Младший бит хэша: правило на имя и все поддомены
+KIND_EXACT = 0  # Правило только на само имя
+HOSTS_ADDRESSES = ('0.0.0.0', '127.0.0.1', '::', '::1')  # Адреса-заглушки в строках фидов формата hosts
+BLOCKED_TTL = 60  # TTL ответов-заглушек
+SINKHOLE_ADDRESSES = ('0.0.0.0', '::')  # Куда по умолчанию "ведут" заблокированные имена в режиме sinkhole
+
+
+def name_hash(name):
+    """64-битный хэш имени (в нижнем регистре, без точки на конце) с обнуленным младшим битом"""
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') & ~1
+
+
+def bloom_bits(key, bits, hashes):
+    """Номера бит фильтра Блума для ключа (двойное хэширование из двух половин ключа)"""
+    first = key & 0xffffffff
+    step = (key >> 32) | 1
+    return [(first + i * step) % bits for i in range(hashes)]
+
+
+def valid_name(name):
+    return 0 < len(name) <= 253 and all(0 < len(label) <= 63 for label in name.split('.')) and \
+        all(char.isalnum() or char in '-_.' for char in name)
+
+
+def parse_feed_line(line):
+    """Правила из строки фида: [(имя, вид правила)]. Пустые строки, комментарии и строки не про домены
+    дают None (то, что не похоже на домен, пропускаем)"""
+    line = line.split('#', 1)[0].strip()
+    if not line or line.startswith('!'):
+        return []
+    fields = line.split()
+    if len(fields) >= 2 and fields[0] in HOSTS_ADDRESSES:
+        names = [name.lower().rstrip('.') for name in fields[1:]]
+        rules = [(name, KIND_EXACT) for name in names
+                 if name not in ('localhost', 'localhost.localdomain', 'local', 'broadcasthost')]  # Стандартные
+        # строки hosts-файла, а не реклама
+        return rules if all(valid_name(name) for name, _ in rules) else None
+    if len(fields) != 1:
+        return None
+    name = fields[0]
+    if name.startswith('||') and name.endswith('^'):
+        name = name[2:-1]
+    elif name.startswith('*.'):
+        name = name[2:]
+    name = name.lower().rstrip('.')
+    return [(name, KIND_SUBTREE)] if valid_name(name) else None
+
+
+def compile_feeds(feeds, path):
+    """Компилирует фиды в файл блоклиста. Пишет во временный файл и подменяет им старый одним rename,
+    так что сервак, перечитывающий файл, видит либо старый блоклист, либо новый целиком.
+    Возвращает (сколько правил записано, сколько строк пропущено)"""
+    """Хэши раскладываем по 256 корзинам по старшему байту: тогда сортировать можно по корзине,
+    и в питоновские числа за раз превращается только маленькая часть всех хэшей"""
+    buckets = [array('Q') for _ in range(256)]
+    skipped = 0
+    for feed in feeds:
+        with open(feed, encoding='utf-8', errors='replace') as file:
+            for line in file:
+                rules = parse_feed_line(line)
+                if rules is None:
+                    skipped += 1
+                    continue
+                for name, kind in rules:
+                    key = name_hash(name) | kind
+                    buckets[key >> 56].append(key)
+    keys = array('Q')
+    for index, bucket in enumerate(buckets):
+        previous = None
+        for key in sorted(bucket):
+            if key != previous:  # Повторы выкидываем
+                keys.append(key)
+                previous = key
+        buckets[index] = None
+    bits = max(64, len(keys) * BLOOM_BITS_PER_ENTRY)
+    bits += -bits % 64  # Чтобы массив хэшей после фильтра был выровнен по 8 байт
+    bloom = bytearray(bits // 8)
+    for key in keys:
+        for bit in bloom_bits(key, bits, BLOOM_HASHES):
+            bloom[bit >> 3] |= 1 << (bit & 7)
+    if sys.byteorder != 'little':
+        keys.byteswap()  # В файле всегда little-endian
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(FILE_MAGIC)
+        file.write(HEADER_STRUCT.pack(len(keys), bits, BLOOM_HASHES, 0))
+        file.write(bloom)
+        keys.tofile(file)
+    os.replace(temp_path, path)
+    return len(keys), skipped
+
+
+def sinkhole_records(question, addresses):
+    """Записи-заглушки для заблокированного имени: A и AAAA из addresses, на остальные типы - ничего (NODATA)"""
+    records = []
+    for address in addresses:
+        family, r_type = (socket.AF_INET6, 28) if ':' in address else (socket.AF_INET, 1)
+        if question.q_type == r_type:
+            records.append(DnsResource(question.q_name, r_type, 1, BLOCKED_TTL, socket.inet_pton(family, address)))
+    return records
+
+
+class Blocklist:
+    """Открытый (через mmap) скомпилированный блоклист. Только для чтения, так что локи не нужны"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = len(FILE_MAGIC) + HEADER_STRUCT.size
+        if len(self.map) < header_end or self.map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            raise ValueError('{} is not a compiled blocklist'.format(path))
+        self.entries, self.bits, self.hashes, _ = HEADER_STRUCT.unpack_from(self.map, len(FILE_MAGIC))
+        keys_start = header_end + self.bits // 8
+        if len(self.map) != keys_start + self.entries * 8:
+            raise ValueError('{} is truncated'.format(path))
+        view = memoryview(self.map)
+        self.bloom = view[header_end:keys_start]
+        if sys.byteorder == 'little':
+            self.keys = view[keys_start:].cast('Q')  # Прямо из файла, без копирования
+        else:
+            self.keys = array('Q', view[keys_start:])
+            self.keys.byteswap()
+        self.loaded_at = time.time()
+
+    def contains(self, key):
+        """Есть ли ключ в блоклисте. Биты фильтра считаем по одному (как в bloom_bits):
+        для отсутствующего ключа обычно хватает одного-двух"""
+        bloom = self.bloom
+        bits = self.bits
+        position = key & 0xffffffff
+        step = (key >> 32) | 1
+        for _ in range(self.hashes):
+            bit = position % bits
+            if not bloom[bit >> 3] >> (bit & 7) & 1:
+                return False
+            position += step
+        index = bisect.bisect_left(self.keys, key)
+        return index < self.entries and self.keys[index] == key
+
+    def blocked(self, name):
+        """Заблокировано ли имя (само или как поддомен заблокированного)"""
+        name = name.lower().rstrip('.')
+        if not self.entries or not name:
+            return False
+        key = name_hash(name)
+        if self.contains(key | KIND_EXACT) or self.contains(key | KIND_SUBTREE):
+            return True
+        dot = name.find('.')
+        while dot >= 0:
+            name = name[dot + 1:]
+            if self.contains(name_hash(name) | KIND_SUBTREE):
+                return True
+            dot = name.find('.')
+        return False
+
+    def get_status(self):
+        return 'Blocklist: {}\nRules: {}\nSize: {} bytes\nLoaded: {}'.format(
+            self.path, self.entries, len(self.map),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.loaded_at)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Компиляция фидов блоклиста для DnsServer --blocklist')
+    commands = parser.add_subparsers(dest='command', required=True)
+    compile_parser = commands.add_parser('compile', help='скомпилировать фиды в файл блоклиста')
+    compile_parser.add_argument('output', help='куда записать блоклист')
+    compile_parser.add_argument('feeds', nargs='+',
+                                help='фиды: по домену на строку (блокируется с поддоменами), ||домен^ (так же) '
+                                     'или строки hosts-файла "0.0.0.0 домен" (блокируется только само имя)')
+    check_parser = commands.add_parser('check', help='проверить, заблокированы ли имена')
+    check_parser.add_argument('blocklist')
+    check_parser.add_argument('names', nargs='+')
+    args = parser.parse_args()
+    if args.command == 'compile':
+        started = time.monotonic()
+        rules, skipped = compile_feeds(args.feeds, args.output)
+        print('Compiled {} rules ({} lines skipped) into {} in {:.1f}s'.format(
+            rules, skipped, args.output, time.monotonic() - started))
+    else:
+        blocklist = Blocklist(args.blocklist)
+        for name in args.names:
+            print(name, 'blocked' if blocklist.blocked(name) else 'allowed')
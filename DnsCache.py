@@ -0,0 +1,513 @@
+import heapq
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from DNSPacketParser import HEADER_STRUCT, QUESTION_STRUCT, DnsResource, DnsQuestion, read_name, parse_address, \
+    read_opt_payload, append_opt, MIN_UDP_PAYLOAD, DEFAULT_UDP_PAYLOAD
+
+
+DEFAULT_CACHE_MEMORY = 64 * 1024 * 1024  # Сколько памяти по умолчанию может занимать кэш (64 Мб)
+RECORD_OVERHEAD = 200  # Примерно столько байт на запись уходит помимо самого объекта записи:
+# кортеж (время протухания, запись), float, элемент кучи, место в словаре
+BUCKET_OVERHEAD = 250  # А столько - на ключ: сам словарь корзины и место в OrderedDict
+
+NOERROR = 0  # rcode "все хорошо" (в том числе NODATA: имя есть, а записей такого типа нет)
+NXDOMAIN = 3  # rcode "такого имени нет"
+SERVFAIL = 2  # rcode "сервер не смог ответить" (для зацикленных CNAME)
+FORMERR = 1  # rcode "запрос составлен неправильно" (для пакетов со слишком большим числом вопросов)
+RCODE_MASK = 0x000F  # rcode - младшие 4 бита флагов
+RCODE_PRIORITY = {NOERROR: 0, NXDOMAIN: 1, SERVFAIL: 2}  # Какой rcode перебивает какой (см. set_rcode)
+MAX_CNAME_CHAIN = 8  # Сколько CNAME подряд проходим за одним именем: дальше считаем цепочку зацикленной
+CHAIN_CACHE_SIZE = 65536  # Сколько пройденных цепочек CNAME помнит ChainCache
+NAME_WIDE_TYPE = 0  # NXDOMAIN относится к имени целиком, а не к одному типу, поэтому храним его
+# под этим типом (тип 0 зарезервирован, настоящих записей с ним не бывает)
+SOA_MINIMUM_STRUCT = struct.Struct('>I')  # Поле MINIMUM - последние 4 байта данных SOA
+DEFAULT_STALE_WINDOW = 24 * 60 * 60  # Сколько секунд протухшая запись еще хранится, чтобы отвечать ей,
+# если форвардер не отвечает (RFC 8767, serve-stale)
+STALE_TTL = 30  # С таким TTL отдаем протухшие записи (рекомендация RFC 8767)
+
+
+def make_key(name, r_type, r_class):
+    """Ключ записи в кэше. Доменные имена в DNS регистронезависимы,
+    поэтому имя приводим к нижнему регистру"""
+    return name.lower(), r_type, r_class
+
+
+def record_size(resource):
+    """Примерно сколько памяти занимает запись в кэше"""
+    return sys.getsizeof(resource) + sys.getsizeof(resource.r_name) + \
+        sys.getsizeof(resource.r_data) + RECORD_OVERHEAD
+
+
+def bucket_size(key):
+    """Примерно сколько памяти занимает ключ (и корзина под него) в кэше"""
+    return sys.getsizeof(key) + sys.getsizeof(key[0]) + BUCKET_OVERHEAD
+
+
+def negative_key(name, q_type, q_class, rcode):
+    """Ключ отрицательного ответа: NODATA - на (имя, тип), NXDOMAIN - на имя целиком"""
+    return make_key(name, NAME_WIDE_TYPE if rcode == NXDOMAIN else q_type, q_class)
+
+
+def negative_ttl(soa):
+    """Время жизни отрицательного ответа по RFC 2308: меньшее из TTL записи SOA и ее поля MINIMUM"""
+    minimum, = SOA_MINIMUM_STRUCT.unpack_from(soa.r_data, len(soa.r_data) - SOA_MINIMUM_STRUCT.size)
+    return min(soa.r_ttl, minimum)
+
+
+def set_rcode(response, rcode):
+    """Вписывает rcode в ответ. rcode в пакете один на все вопросы, и OR-ить его нельзя
+    (NXDOMAIN | SERVFAIL - это снова NXDOMAIN), поэтому поле заменяем целиком, но только
+    более важным кодом: SERVFAIL > NXDOMAIN > NOERROR"""
+    current = response.flags & RCODE_MASK
+    if RCODE_PRIORITY.get(rcode, 0) >= RCODE_PRIORITY.get(current, 0):
+        response.flags = (response.flags & ~RCODE_MASK) | rcode
+
+
+def stale_copy(resource):
+    """Копия протухшей записи, которую можно отдать клиенту (RFC 8767: с небольшим TTL)"""
+    return DnsResource(resource.r_name, resource.r_type, resource.r_class, STALE_TTL, resource.r_data)
+
+
+class CnameLoop(Exception):
+    """Цепочка CNAME зациклилась или длиннее MAX_CNAME_CHAIN"""
+
+
+def find_negative(response):
+    """Проверяет, не отрицательный ли ответ пришел от форвардера (NXDOMAIN или NODATA - имя есть,
+    а записей нужного типа нет). Если да, возвращает (вопрос, rcode, запись SOA), иначе None.
+    Если в ответе цепочка CNAME, то в вопросе будет последнее имя цепочки: отрицательный ответ про него"""
+    rcode = response.flags & RCODE_MASK
+    if rcode not in (NOERROR, NXDOMAIN) or len(response.question) != 1:
+        return None  # Ошибки форвардера (SERVFAIL и прочие) не кэшируем
+    question = response.question[0]
+    soa = next((resource for resource in response.authority if resource.r_type == 6), None)
+    if soa is None:
+        return None  # Без SOA неизвестно, сколько помнить такой ответ (RFC 2308 велит тогда не кэшировать)
+    name = question.q_name.lower()
+    if question.q_type != 5:
+        """Идем по цепочке CNAME в ответе (не дальше, чем записей в ответе, - на случай петли)"""
+        for _ in range(len(response.answer)):
+            c_name = next((resource for resource in response.answer if resource.r_type == 5 and
+                           resource.r_name.lower() == name), None)
+            if c_name is None:
+                break
+            name = parse_address(c_name.r_data).decode().lower()
+    for resource in response.answer:
+        if resource.r_name.lower() == name and resource.r_type == question.q_type:
+            return None  # Ответ таки есть
+    return DnsQuestion(name, question.q_type, question.q_class), rcode, soa
+
+
+class DnsCache:
+    """Класс, в котором будет храниться кэш нашего сервака.
+    Записи лежат в словаре по ключу (имя, тип, класс), так что поиск идет за O(1),
+    а не пробежкой по всему кэшу. Для каждой записи храним абсолютное время протухания."""
+    """ПОЯСНЕНИЕ! Протухшие записи выкидываются лениво: рядом лежит куча (heapq)
+    с временами протухания, и при каждом обращении мы снимаем с ее верхушки только то,
+    что уже протухло. В итоге очистка стоит O(log n) на запись, а не O(n) на каждый запрос."""
+    """ПОЯСНЕНИЕ 2! Кэш ограничен по памяти (max_memory байт, None - без ограничения). Память считаем
+    приблизительно, но для каждой записи (см. record_size). Если записи не влезают, вытесняем ключи,
+    к которым дольше всего не обращались (LRU): иначе форвардер, отдающий кучу случайных поддоменов
+    с большими TTL, раздует кэш, пока сервак не прибьет OOM killer."""
+    """ПОЯСНЕНИЕ 3! Протухшая запись выкидывается не сразу, а через stale_window секунд после протухания.
+    Обычный поиск ее уже не видит, а поиск с stale=True отдает: если форвардер лежит или тормозит,
+    лучше ответить чуть устаревшими данными, чем ничем (см. DnsResolve.get_stale_or_forwarder)."""
+    def __init__(self, max_memory=DEFAULT_CACHE_MEMORY, stale_window=DEFAULT_STALE_WINDOW):
+        self.cache = OrderedDict()  # (r_name, r_type, r_class) -> {r_data: (expire_time, resource)}
+        # в порядке от давно не использованных ключей к недавно использованным
+        self.expire_heap = []  # Куча из (expire_time, key, r_data)
+        self.max_memory = max_memory
+        self.stale_window = stale_window  # Сколько хранить протухшие записи (0 - выкидывать сразу)
+        self.memory = 0  # Сколько памяти сейчас занимает кэш (примерно)
+        self.records = 0  # Сколько в нем записей
+        self.evicted = 0  # Сколько записей вытеснено из-за нехватки памяти
+        self.negative = OrderedDict()  # Отрицательные ответы (RFC 2308): ключ -> (expire_time, rcode, soa)
+        self.negative_heap = []  # Куча из (expire_time, key) для отрицательных ответов
+        self.lock = threading.Lock()  # Кэш дергают из кучи потоков одновременно
+        self.listeners = []  # Кого оповещать, когда записи по ключу добавились, заменились или протухли
+
+    def add_listener(self, listener):
+        """Подписывает listener(key) на изменения записей в кэше.
+        Вызывается под локом кэша, так что обратно в кэш из него лезть нельзя"""
+        self.listeners.append(listener)
+
+    def notify(self, key):
+        for listener in self.listeners:
+            listener(key)
+
+    def clear_cache(self):
+        """Метод, очищающий кэш от устаревших записей (тех, что протухли больше stale_window секунд назад).
+        Вызывать его нужно под локом"""
+        now = time.time()
+        heap = self.expire_heap
+        stale_until = now - self.stale_window
+        while heap and heap[0][0] < stale_until:
+            expire_time, key, r_data = heapq.heappop(heap)
+            bucket = self.cache.get(key)
+            if bucket is None:
+                continue
+            item = bucket.get(r_data)
+            """Если у записи другое время протухания, значит, в куче лежит старый хвост,
+            а сама запись уже была заменена. Такой хвост просто выкидываем"""
+            if item is None or item[0] != expire_time:
+                continue
+            del bucket[r_data]
+            self.records -= 1
+            self.memory -= record_size(item[1])
+            if not bucket:
+                del self.cache[key]
+                self.memory -= bucket_size(key)
+            self.notify(key)
+        heap = self.negative_heap
+        while heap and heap[0][0] < now:
+            expire_time, key = heapq.heappop(heap)
+            item = self.negative.get(key)
+            if item is not None and item[0] == expire_time:
+                self.drop_negative(key)
+
+    def drop_stale(self, bucket, now):
+        """Выкидывает из корзины протухшие записи: раз по ключу пришли свежие данные, старые
+        отдавать уже не надо (их хвосты в куче выкинет clear_cache). Вызывать под локом"""
+        for r_data, (expire_time, resource) in list(bucket.items()):
+            if expire_time <= now:
+                del bucket[r_data]
+                self.records -= 1
+                self.memory -= record_size(resource)
+
+    def drop_negative(self, key):
+        """Выкидывает отрицательный ответ. Вызывать под локом"""
+        _, _, soa = self.negative.pop(key)
+        self.memory -= record_size(soa) + bucket_size(key)
+
+    def evict(self):
+        """Вытесняет давно не использованные ключи, пока кэш не влезет в max_memory.
+        Вызывать под локом"""
+        """Сначала отрицательные ответы: их дешевле всего получить заново, а именно ими
+        забивают кэш запросы случайных несуществующих поддоменов"""
+        while self.max_memory is not None and self.memory > self.max_memory and len(self.negative) > 1:
+            self.drop_negative(next(iter(self.negative)))
+            self.evicted += 1
+        while self.max_memory is not None and self.memory > self.max_memory and len(self.cache) > 1:
+            key, bucket = self.cache.popitem(last=False)
+            self.records -= len(bucket)
+            self.evicted += len(bucket)
+            self.memory -= bucket_size(key) + sum(record_size(resource) for _, resource in bucket.values())
+            self.notify(key)
+        """Вытесненные записи остаются в куче хвостами до своего протухания. Если хвостов стало
+        больше, чем живых записей, пересобираем кучу, а то при больших TTL она растет без ограничения"""
+        if len(self.expire_heap) > 2 * self.records + 1024:
+            self.expire_heap = [(expire_time, key, r_data) for key, bucket in self.cache.items()
+                                for r_data, (expire_time, _) in bucket.items()]
+            heapq.heapify(self.expire_heap)
+        if len(self.negative_heap) > 2 * len(self.negative) + 1024:
+            self.negative_heap = [(item[0], key) for key, item in self.negative.items()]
+            heapq.heapify(self.negative_heap)
+
+    def get_resources(self, question, stale=False):
+        """Метод, возвращающий данные из кэша
+        (если они у нас, конечно, имеются).
+        stale - отдать и протухшие записи (их копии с TTL STALE_TTL)"""
+        key = make_key(question.q_name, question.q_type, question.q_class)
+        with self.lock:
+            self.clear_cache()
+            bucket = self.cache.get(key)
+            if not bucket:
+                return []
+            now = time.time()
+            if stale:
+                result = [resource if expire_time > now else stale_copy(resource)
+                          for expire_time, resource in bucket.values()]
+            else:
+                result = [resource for expire_time, resource in bucket.values() if expire_time > now]
+            if result:
+                self.cache.move_to_end(key)  # Ключ только что использовали
+            return result
+
+    def put_resource(self, resource, expire_time=None):
+        """Метод, добавляющий данные в кэш. expire_time - абсолютное время протухания
+        (если не задано, запись живет r_ttl секунд с текущего момента).
+        Если такая запись уже есть, но протухает раньше, - продлеваем ее (так работает
+        упреждающее обновление, см. DnsPrefetch)"""
+        key = make_key(resource.r_name, resource.r_type, resource.r_class)
+        r_data = bytes(resource.r_data)
+        if type(resource.r_data) is not bytes:
+            """Данные распакованной записи могут быть bytearray-ем - кладем в кэш компактную копию"""
+            resource = DnsResource(resource.r_name, resource.r_type, resource.r_class, resource.r_ttl, r_data)
+        with self.lock:
+            self.clear_cache()
+            """Раз запись появилась, отрицательные ответы про нее больше не актуальны"""
+            for negative in (key, (key[0], NAME_WIDE_TYPE, key[2])):
+                if negative in self.negative:
+                    self.drop_negative(negative)
+            bucket = self.cache.get(key)
+            if bucket is None:
+                bucket = self.cache[key] = {}
+                self.memory += bucket_size(key)
+            else:
+                self.cache.move_to_end(key)
+            now = time.time()
+            if expire_time is None:
+                expire_time = now + resource.r_ttl
+            if expire_time > now:
+                self.drop_stale(bucket, now)
+            item = bucket.get(r_data)
+            if item is not None:
+                if item[0] >= expire_time:
+                    return  # Такая запись уже есть (см. DnsResource.__eq__), второй раз не кладем
+                self.records -= 1  # Старая запись заменяется (ее хвост в куче выкинет clear_cache)
+                self.memory -= record_size(item[1])
+            bucket[r_data] = (expire_time, resource)
+            self.records += 1
+            self.memory += record_size(resource)
+            heapq.heappush(self.expire_heap, (expire_time, key, r_data))
+            self.notify(key)
+            self.evict()
+
+    def put_negative(self, question, rcode, soa, expire_time=None):
+        """Метод, добавляющий в кэш отрицательный ответ на вопрос (см. find_negative).
+        Если expire_time не задано, ответ живет negative_ttl(soa) секунд"""
+        key = negative_key(question.q_name, question.q_type, question.q_class, rcode)
+        if expire_time is None:
+            expire_time = time.time() + negative_ttl(soa)
+        soa = DnsResource(soa.r_name, soa.r_type, soa.r_class, soa.r_ttl, bytes(soa.r_data))
+        with self.lock:
+            self.clear_cache()
+            if key in self.negative:
+                self.drop_negative(key)
+            self.negative[key] = (expire_time, rcode, soa)
+            self.memory += record_size(soa) + bucket_size(key)
+            heapq.heappush(self.negative_heap, (expire_time, key))
+            self.evict()
+
+    def get_negative(self, question):
+        """Метод, возвращающий отрицательный ответ на вопрос в виде (rcode, soa, время протухания)
+        или None, если такого нет"""
+        key = make_key(question.q_name, question.q_type, question.q_class)
+        with self.lock:
+            self.clear_cache()
+            for negative in (key, (key[0], NAME_WIDE_TYPE, key[2])):
+                item = self.negative.get(negative)
+                if item is not None:
+                    self.negative.move_to_end(negative)
+                    expire_time, rcode, soa = item
+                    return rcode, soa, expire_time
+        return None
+
+    def get_expire_time(self, resource):
+        """Метод, возвращающий абсолютное время протухания записи (или None, если ее нет в кэше)"""
+        key = make_key(resource.r_name, resource.r_type, resource.r_class)
+        with self.lock:
+            item = self.cache.get(key, {}).get(bytes(resource.r_data))
+        return item[0] if item else None
+
+    def entries(self):
+        """Метод, возвращающий все записи кэша (в том числе протухшие, но еще хранящиеся)
+        в виде списка (время протухания, запись)"""
+        with self.lock:
+            self.clear_cache()
+            return [item for bucket in self.cache.values() for item in bucket.values()]
+
+    def negative_entries(self):
+        """Метод, возвращающий все живые отрицательные ответы в виде списка (время протухания, ключ, rcode, soa)"""
+        with self.lock:
+            self.clear_cache()
+            return [(expire_time, key, rcode, soa) for key, (expire_time, rcode, soa) in self.negative.items()]
+
+    def get_status(self):
+        """Метод, выводящий на экран данные обо всех имеющихся записях в кэше нашего сервака"""
+        with self.lock:
+            self.clear_cache()
+            now = time.time()
+            return '\n'.join(['Time: {:5d}s Resource: {:80}'.format(
+                int(expire_time - now),
+                resource.to_string()
+            ) for bucket in self.cache.values()
+                for expire_time, resource in bucket.values()] + ['Time: {:5d}s Negative: {:20s} {:04X} {:04X} rcode {}'.format(
+                int(expire_time - now), name, q_type, q_class, rcode
+            ) for (name, q_type, q_class), (expire_time, rcode, _) in self.negative.items()] + [self.get_usage()])
+
+    def get_counters(self):
+        """Числа для метрик (см. DnsMetrics)"""
+        return {'cache_records': self.records, 'cache_negative': len(self.negative),
+                'cache_memory_bytes': self.memory, 'cache_evicted': self.evicted}
+
+    def get_usage(self):
+        """Строка со сводкой по занятой памяти"""
+        return 'Records: {} Negative: {} Memory: {}/{} bytes Evicted: {}'.format(
+            self.records, len(self.negative), self.memory,
+            self.max_memory if self.max_memory is not None else 'unlimited', self.evicted)
+
+
+TTL_STRUCT = struct.Struct('>I')
+
+
+def parse_request_key(raw_packet):
+    """Достает из сырого запроса ключ единственного вопроса, длину секции вопроса и размер UDP-пакета
+    из записи OPT (или None, если клиент EDNS0 не использует), не создавая по дороге никаких объектов.
+    Если запрос не такой простой, возвращает None"""
+    _, _, q_count, an_count, ns_count, ar_count = HEADER_STRUCT.unpack_from(raw_packet, 0)
+    if q_count != 1 or an_count or ns_count or ar_count > 1:
+        return None
+    name, offset = read_name(raw_packet, HEADER_STRUCT.size)
+    q_type, q_class = QUESTION_STRUCT.unpack_from(raw_packet, offset)
+    offset += QUESTION_STRUCT.size
+    payload = None
+    if ar_count:
+        opt = read_opt_payload(raw_packet, offset)
+        if opt is None:
+            return None  # В additional не OPT, а что-то другое
+        payload = opt[0]
+    return make_key(name, q_type, q_class), offset - HEADER_STRUCT.size, payload
+
+
+class ResponseCache:
+    """Второй слой кэша: уже собранные ответы в wire-формате.
+    На попадание не нужно ни собирать объекты, ни паковать пакет заново:
+    берем готовые байты, вписываем идентификатор запроса и оставшиеся времена жизни и отправляем"""
+    """ПОЯСНЕНИЕ! Готовый ответ собран из записей DnsCache (иногда из нескольких ключей -
+    например, при цепочке CNAME), поэтому для каждого ответа помним, от каких ключей он зависит.
+    Как только по любому из них в DnsCache что-то добавилось, заменилось или протухло,
+    DnsCache оповещает нас, и ответ выкидывается."""
+    def __init__(self, cache):
+        self.entries = {}  # ключ вопроса -> (байты ответа, [(смещение ttl, время протухания)],
+        # время протухания, сколько байт сэкономило сжатие имен)
+        self.depends = {}  # ключ записи в DnsCache -> множество ключей вопросов, чьи ответы из нее собраны
+        self.generation = 0  # Растет при каждой инвалидации (см. put)
+        self.sweep_at = 1024  # При таком числе ответов выкинем протухшие (см. sweep)
+        self.lock = threading.Lock()
+        cache.add_listener(self.invalidate)
+
+    def get(self, raw_packet, payload=DEFAULT_UDP_PAYLOAD, tcp=False):
+        """Возвращает готовый ответ на сырой запрос, сколько байт в нем сэкономило сжатие имен
+        и ключ вопроса - или None, если такого ответа нет.
+        payload - сколько байт по UDP принимаем мы сами (объявляем в OPT, если клиент прислал свою).
+        Если ответ не влезает в UDP-пакет клиента, тоже возвращаем None: обрезать его будет обычный путь"""
+        try:
+            request = parse_request_key(raw_packet)
+        except Exception:
+            return None
+        if request is None:
+            return None
+        key, question_length, client_payload = request
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        template, ttl_fields, expire_time, compression_saved = entry
+        now = time.time()
+        if expire_time <= now:
+            return None  # Записи уже протухли, просто DnsCache об этом еще не узнал
+        response = bytearray(template)
+        response[0:2] = raw_packet[0:2]  # Идентификатор запроса
+        end = HEADER_STRUCT.size + question_length
+        response[HEADER_STRUCT.size:end] = raw_packet[HEADER_STRUCT.size:end]  # Вопрос ровно в том регистре,
+        # в каком его задал клиент (длина та же, ключ-то регистронезависимый)
+        for offset, record_expire_time in ttl_fields:
+            TTL_STRUCT.pack_into(response, offset, int(record_expire_time - now))
+        limit = MIN_UDP_PAYLOAD
+        if client_payload is not None:
+            append_opt(response, payload)
+            limit = max(MIN_UDP_PAYLOAD, min(client_payload, payload))
+        if not tcp and len(response) > limit:
+            return None
+        return response, compression_saved, key
+
+    def put(self, key, raw_response, compression_saved, ttl_fields, depends, generation):
+        """Запоминает готовый ответ на вопрос key.
+        ttl_fields - [(смещение ttl, время протухания записи)], depends - ключи записей DnsCache.
+        generation - значение self.generation до того, как ответ начали собирать из DnsCache:
+        если с тех пор что-то инвалидировалось, ответ мог собраться из уже неактуальных записей,
+        и запоминать его не стоит"""
+        expire_time = min(record_expire_time for _, record_expire_time in ttl_fields)
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (bytes(raw_response), ttl_fields, expire_time, compression_saved)
+            if len(self.entries) >= self.sweep_at:
+                self.sweep()
+            for record_key in depends:
+                self.depends.setdefault(record_key, set()).add(key)
+
+    def clear(self):
+        """Выкидывает все готовые ответы (например, когда перезагрузили локальные зоны)"""
+        with self.lock:
+            self.generation += 1
+            self.entries = {}
+            self.depends = {}
+
+    def invalidate(self, record_key):
+        """Выкидывает все ответы, собранные из записей по ключу record_key"""
+        with self.lock:
+            self.generation += 1
+            for key in self.depends.pop(record_key, ()):
+                self.entries.pop(key, None)
+
+    def sweep(self):
+        """Выкидывает протухшие ответы. Обычно это делает invalidate по оповещению от DnsCache,
+        но общий кэш воркеров (DnsSharedCache) не знает о протухании записей в других процессах,
+        поэтому время от времени чистим сами. Вызывать под локом"""
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry[2] <= now]:
+            del self.entries[key]
+        depends = {}
+        for record_key, keys in self.depends.items():
+            keys = {key for key in keys if key in self.entries}
+            if keys:
+                depends[record_key] = keys
+        self.depends = depends
+        self.sweep_at = max(1024, len(self.entries) * 2)  # Чтобы чистка стоила O(1) в среднем на ответ
+
+
+class ChainCache:
+    """Третий слой кэша: уже пройденные цепочки CNAME. Имена CDN-ов часто ведут через 3-4 CNAME,
+    и раньше каждый вопрос про такое имя заново проходил цепочку по DnsCache, запись за записью.
+    Теперь для начала цепочки запоминаем, куда она в итоге ведет, и сами записи CNAME по порядку:
+    ответ на вопрос - это одна эта проверка плюс один поиск по каноническому имени"""
+    """ПОЯСНЕНИЕ! Цепочка живет, пока живет самая короткоживущая ее запись, а инвалидируется так же,
+    как готовые ответы в ResponseCache: DnsCache оповещает нас об изменениях CNAME любого имени цепочки
+    (и канонического - вдруг у него появился свой CNAME), и цепочка выкидывается"""
+    def __init__(self, cache, max_size=CHAIN_CACHE_SIZE):
+        self.entries = {}  # ключ CNAME начала цепочки -> (каноническое имя, [записи CNAME по порядку],
+        # время протухания)
+        self.depends = {}  # ключ CNAME имени цепочки -> множество ключей цепочек, через которые оно проходит
+        self.generation = 0  # Растет при каждой инвалидации (см. ResponseCache.put)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        cache.add_listener(self.invalidate)
+
+    def get(self, key):
+        """Возвращает (каноническое имя, [записи CNAME]) для начала цепочки или None"""
+        entry = self.entries.get(key)
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[0], entry[1]
+
+    def put(self, key, target, chain, expire_time, generation):
+        """Запоминает цепочку chain от key до имени target. generation - как в ResponseCache.put"""
+        with self.lock:
+            if generation != self.generation:
+                return
+            if len(self.entries) >= self.max_size:
+                self.entries = {}  # Проще начать заново, чем вести LRU: пройти цепочку снова недорого
+                self.depends = {}
+            self.entries[key] = (target, chain, expire_time)
+            for record_key in [make_key(record.r_name, 5, record.r_class) for record in chain] + \
+                    [make_key(target, 5, key[2])]:
+                self.depends.setdefault(record_key, set()).add(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries = {}
+            self.depends = {}
+
+    def invalidate(self, record_key):
+        """Выкидывает все цепочки, проходящие через имя из ключа record_key (если это ключ CNAME)"""
+        if record_key[1] != 5:
+            return
+        with self.lock:
+            self.generation += 1
+            for key in self.depends.pop(record_key, ()):
+                self.entries.pop(key, None)
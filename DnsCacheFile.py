@@ -0,0 +1,130 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from DNSPacketParser import DnsResource, DnsQuestion, pack_address, read_name
+
+
+"""Файл кэша. Раньше кэш целиком сериализовался pickle-ом и только по команде exit:
+упал сервак - кэш потерян, а большой pickle долго грузится, и все это время сервак не отвечает.
+Теперь в файле лежат записи в wire-формате с абсолютными временами протухания.
+Файл пишется снимками: раз в какое-то время (и на выходе) кэш целиком пишется во временный файл,
+который потом атомарно подменяет старый (os.replace). Так при любом падении на диске остается
+либо старый целый снимок, либо новый целый снимок."""
+"""ПОЯСНЕНИЕ! Грузится файл через mmap в фоновом потоке уже после запуска сервака, так что клиентам
+сервак отвечает сразу. У каждой записи первым полем лежит время протухания: протухшие записи
+пропускаем, даже не распаковывая. Битый хвост файла (например, недописанный старой версией) просто отбрасываем."""
+
+FILE_MAGIC = b'DNSC\x01'  # Сигнатура и версия формата
+ENTRY_STRUCT = struct.Struct('<dBBHHIHH')  # время протухания, вид записи (KIND_*), rcode,
+# тип, класс, ttl, длина имени, длина данных. Дальше имя в wire-формате и данные
+KIND_RECORD = 0  # Ресурсная запись
+KIND_NEGATIVE = 1  # Отрицательный ответ: имя, тип и класс - из вопроса, а данные - запакованная запись SOA
+DEFAULT_CACHE_FILE = 'cache'
+DEFAULT_SNAPSHOT_INTERVAL = 60  # Раз во сколько секунд пишем снимок
+
+
+def pack_entry(result, expire_time, kind, rcode, resource):
+    name = pack_address(resource.r_name)
+    result.extend(ENTRY_STRUCT.pack(expire_time, kind, rcode, resource.r_type, resource.r_class,
+                                    resource.r_ttl, len(name), len(resource.r_data)))
+    result.extend(name)
+    result.extend(resource.r_data)
+
+
+def save_snapshot(cache, path=DEFAULT_CACHE_FILE):
+    """Пишет снимок кэша (обычного или общего для воркеров) в файл. Возвращает, сколько записей записали"""
+    result = bytearray(FILE_MAGIC)
+    count = 0
+    for expire_time, resource in cache.entries():
+        pack_entry(result, expire_time, KIND_RECORD, 0, resource)
+        count += 1
+    for expire_time, (name, q_type, q_class), rcode, soa in cache.negative_entries():
+        pack_entry(result, expire_time, KIND_NEGATIVE, rcode,
+                   DnsResource(name, q_type, q_class, soa.r_ttl, bytes(soa.to_bytes())))
+        count += 1
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(result)
+        file.flush()
+        os.fsync(file.fileno())  # Чтобы после падения системы не остался файл с пустым содержимым
+    os.replace(temp_path, path)  # Атомарная подмена
+    return count
+
+
+def load_snapshot(cache, path=DEFAULT_CACHE_FILE):
+    """Грузит снимок из файла в кэш. Возвращает, сколько живых записей загрузили"""
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < len(FILE_MAGIC):
+            raise ValueError('Cache file is too short')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            buf = memoryview(mapped)
+            try:
+                if buf[:len(FILE_MAGIC)] != FILE_MAGIC:
+                    raise ValueError('Not a cache file (or an old one)')
+                return load_entries(cache, buf)
+            finally:
+                buf.release()  # Иначе mmap не закроется
+
+
+def load_entries(cache, buf):
+    count = 0
+    offset = len(FILE_MAGIC)
+    now = time.time()
+    while offset + ENTRY_STRUCT.size <= len(buf):
+        expire_time, kind, rcode, r_type, r_class, r_ttl, name_len, data_len = \
+            ENTRY_STRUCT.unpack_from(buf, offset)
+        start = offset + ENTRY_STRUCT.size
+        offset = start + name_len + data_len
+        if offset > len(buf):
+            break  # Недописанный хвост
+        if expire_time + (cache.stale_window if kind == KIND_RECORD else 0) <= now:
+            continue  # Протухло, пока сервак не работал (записи еще нужны, пока годятся для serve-stale)
+        name, _ = read_name(buf, start)
+        r_data = bytes(buf[start + name_len:offset])
+        if kind == KIND_NEGATIVE:
+            soa, _ = DnsResource.parse_resource(memoryview(r_data), 0)
+            cache.put_negative(DnsQuestion(name, r_type, r_class), rcode, soa, expire_time)
+        else:
+            cache.put_resource(DnsResource(name, r_type, r_class, r_ttl, r_data), expire_time)
+        count += 1
+    return count
+
+
+class CacheSnapshotter(threading.Thread):
+    """Фоновый поток: сначала грузит кэш из файла, потом раз в interval секунд пишет снимок"""
+    def __init__(self, cache, path=DEFAULT_CACHE_FILE, interval=DEFAULT_SNAPSHOT_INTERVAL):
+        super().__init__(name='CacheSnapshotter', daemon=True)
+        self.cache = cache
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()  # Чтобы периодический снимок и снимок на выходе не писали файл одновременно
+
+    def run(self):
+        try:
+            started = time.monotonic()
+            count = load_snapshot(self.cache, self.path)
+            print('Loaded {} cached records in {:.3f}s'.format(count, time.monotonic() - started))
+        except Exception as ex:
+            print('Can\'t load cache:')  # если словили ошибку на кэше, выведем, что к чему
+            print(ex)
+        while self.interval > 0 and not self.stopped.wait(self.interval):
+            self.save()
+
+    def save(self):
+        with self.lock:
+            try:
+                save_snapshot(self.cache, self.path)
+            except Exception as ex:
+                # Ну и, как обычно если ловим ошибку, выводим инфу
+                print('Can\'t save cache:')
+                print(ex)
+
+    def stop(self):
+        """Останавливает поток и пишет последний снимок"""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()  # Если кэш еще грузится, дожидаемся, иначе снимок получится неполным
+        self.save()
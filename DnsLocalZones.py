@@ -0,0 +1,366 @@
+import socket
+import struct
+import time
+from DNSPacketParser import DnsResource, pack_address, parse_address
+from DnsCache import NXDOMAIN, SERVFAIL, MAX_CNAME_CHAIN, negative_ttl
+
+
+"""Локальные зоны и hosts-файлы: имена, на которые сервак отвечает сам, не ходя к форвардеру.
+Зоны читаются из мастер-файлов (RFC 1035: $ORIGIN, $TTL, скобки, кавычки, комментарии),
+а hosts-файлы - в обычном формате "IP имя [синонимы...]".
+Все записи лежат в дереве по меткам имени, начиная с последней: com -> example -> www."""
+"""ПОЯСНЕНИЕ! Дерево с перевернутыми метками сразу дает все, что нужно авторитетному ответу:
+спускаясь по имени вопроса, мы проходим через вершину зоны (узел с SOA), через точку делегирования
+(узел с NS внутри зоны - дальше имена не наши, их спрашиваем у форвардера) и в конце либо находим
+имя целиком, либо останавливаемся на ближайшем существующем предке - а у него может быть потомок "*".
+Если нет и его, то имени в нашей зоне нет - отвечаем NXDOMAIN.
+Дерево после загрузки не меняется. Перезагрузка строит новое дерево и просто подменяет ссылку на него
+в серваке, так что запросы не ждут ни секунды, а каждый запрос видит либо старые зоны, либо новые целиком."""
+
+DEFAULT_TTL = 3600  # TTL записей зоны, если в файле нет $TTL
+HOSTS_TTL = 300  # TTL записей из hosts-файлов
+FLAG_AA = 0x0400  # Флаг "авторитетный ответ"
+NS_TYPE = 2
+CNAME_TYPE = 5
+SOA_TYPE = 6
+PTR_TYPE = 12
+ANY_TYPE = 255
+TYPE_CODES = {'A': 1, 'NS': NS_TYPE, 'CNAME': CNAME_TYPE, 'SOA': SOA_TYPE, 'PTR': PTR_TYPE, 'MX': 15, 'TXT': 16,
+              'AAAA': 28, 'SRV': 33}
+TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+SOA_NUMBERS_STRUCT = struct.Struct('>IIIII')  # serial, refresh, retry, expire, minimum
+
+
+class ZoneError(Exception):
+    """Ошибка в файле зоны или hosts-файле (в тексте - файл и строка)"""
+
+
+class QuotedString(str):
+    """Токен, который в файле был в кавычках (чтобы отличать "1" от 1)"""
+
+
+def name_labels(name):
+    """Метки имени в обратном порядке и в нижнем регистре: 'www.Example.com.' -> ['com', 'example', 'www']"""
+    name = name.lower().rstrip('.')
+    return name.split('.')[::-1] if name else []
+
+
+def absolute_name(name, origin):
+    """Полное имя с точкой на конце: '@' - это сам origin, имена без точки на конце - относительно него"""
+    if name == '@':
+        return origin
+    if not name.endswith('.'):
+        name = name + ('.' + origin if origin != '.' else '.')
+    labels = name.rstrip('.').split('.') if name != '.' else []
+    if len(name) > 255 or any(not label or len(label) > 63 for label in labels):
+        raise ValueError('bad name {!r}'.format(name))
+    return name
+
+
+def wire_name(name):
+    """Имя в формате пакета (pack_address не умеет корень)"""
+    return b'\x00' if name == '.' else bytes(pack_address(name))
+
+
+def parse_ttl(text):
+    """TTL числом секунд или с единицами, как в BIND: 3600, 1h, 1h30m, 2d"""
+    if text.isdigit():
+        return int(text)
+    total = 0
+    number = ''
+    for char in text.lower():
+        if char.isdigit():
+            number += char
+        elif char in TTL_UNITS and number:
+            total += int(number) * TTL_UNITS[char]
+            number = ''
+        else:
+            raise ValueError('bad TTL {!r}'.format(text))
+    return total + int(number or 0)
+
+
+def read_records(path):
+    """Разбирает мастер-файл на логические записи (запись в скобках может занимать несколько строк).
+    Отдает (номер строки, начинается ли запись с пробела - то есть без имени, [токены])"""
+    depth = 0
+    tokens = []
+    start_line = 0
+    no_owner = False
+    with open(path, encoding='utf-8') as file:
+        for line_no, line in enumerate(file, 1):
+            if depth == 0:
+                start_line = line_no
+                no_owner = line[:1] in (' ', '\t')
+                tokens = []
+            index = 0
+            while index < len(line):
+                char = line[index]
+                if char == ';':
+                    break  # Комментарий до конца строки
+                if char in ' \t\r\n':
+                    index += 1
+                elif char in '()':
+                    depth += 1 if char == '(' else -1
+                    if depth < 0:
+                        raise ZoneError('{}:{}: unbalanced ")"'.format(path, line_no))
+                    index += 1
+                elif char == '"':
+                    end = index + 1
+                    chars = []
+                    while end < len(line) and line[end] != '"':
+                        if line[end] == '\\' and end + 1 < len(line):
+                            end += 1
+                        chars.append(line[end])
+                        end += 1
+                    if end >= len(line):
+                        raise ZoneError('{}:{}: unterminated string'.format(path, line_no))
+                    tokens.append(QuotedString(''.join(chars)))
+                    index = end + 1
+                else:
+                    end = index
+                    while end < len(line) and line[end] not in ' \t\r\n;()"':
+                        end += 1
+                    tokens.append(line[index:end])
+                    index = end
+            if depth == 0 and tokens:
+                yield start_line, no_owner, tokens
+    if depth:
+        raise ZoneError('{}:{}: unclosed "("'.format(path, start_line))
+
+
+def make_r_data(r_type, fields, origin):
+    """Данные записи в формате пакета из текстовых полей мастер-файла"""
+    if r_type == 1:
+        return socket.inet_pton(socket.AF_INET, fields[0])
+    if r_type == 28:
+        return socket.inet_pton(socket.AF_INET6, fields[0])
+    if r_type in (NS_TYPE, CNAME_TYPE, PTR_TYPE):
+        return wire_name(absolute_name(fields[0], origin))
+    if r_type == 15:
+        return struct.pack('>H', int(fields[0])) + wire_name(absolute_name(fields[1], origin))
+    if r_type == 16:
+        result = bytearray()
+        for field in fields:
+            data = field.encode()
+            if len(data) > 255:
+                raise ValueError('TXT string is longer than 255 bytes')
+            result.append(len(data))
+            result.extend(data)
+        return bytes(result)
+    if r_type == SOA_TYPE:
+        return wire_name(absolute_name(fields[0], origin)) + wire_name(absolute_name(fields[1], origin)) + \
+            SOA_NUMBERS_STRUCT.pack(int(fields[2]), *(parse_ttl(field) for field in fields[3:7]))
+    if r_type == 33:
+        return struct.pack('>HHH', int(fields[0]), int(fields[1]), int(fields[2])) + \
+            wire_name(absolute_name(fields[3], origin))
+    raise ValueError('unsupported type {}'.format(r_type))
+
+
+def parse_zone_file(path):
+    """Читает мастер-файл зоны, возвращает список записей. Хотя бы одна SOA обязательна,
+    а все записи должны лежать внутри зон, объявленных SOA этого же файла"""
+    resources = []
+    origin = '.'
+    default_ttl = DEFAULT_TTL
+    owner = None
+    for line_no, no_owner, tokens in read_records(path):
+        where = '{}:{}'.format(path, line_no)
+        try:
+            directive = tokens[0].upper()
+            if directive == '$ORIGIN':
+                origin = absolute_name(tokens[1], '.')
+                continue
+            if directive == '$TTL':
+                default_ttl = parse_ttl(tokens[1])
+                continue
+            if directive.startswith('$'):
+                raise ValueError('unsupported directive {}'.format(tokens[0]))
+            if not no_owner:
+                owner = absolute_name(tokens.pop(0), origin)
+            elif owner is None:
+                raise ValueError('record without a name')
+            ttl = default_ttl
+            while tokens and not isinstance(tokens[0], QuotedString):  # TTL и класс - в любом порядке
+                if tokens[0].upper() == 'IN':
+                    tokens.pop(0)
+                elif tokens[0][:1].isdigit():
+                    ttl = parse_ttl(tokens.pop(0))
+                else:
+                    break
+            r_type = TYPE_CODES.get(tokens[0].upper())
+            if r_type is None:
+                raise ValueError('unsupported type {}'.format(tokens[0]))
+            resources.append(DnsResource(owner, r_type, 1, ttl, make_r_data(r_type, tokens[1:], origin)))
+        except ZoneError:
+            raise
+        except (ValueError, IndexError, OSError) as ex:
+            raise ZoneError('{}: {}'.format(where, ex))
+    apexes = {tuple(name_labels(resource.r_name)) for resource in resources if resource.r_type == SOA_TYPE}
+    if not apexes:
+        raise ZoneError('{}: no SOA record'.format(path))
+    for resource in resources:
+        labels = name_labels(resource.r_name)
+        if not any(tuple(labels[:len(apex)]) == apex for apex in apexes):
+            raise ZoneError('{}: {} is outside of the zone'.format(path, resource.r_name))
+    return resources
+
+
+def parse_hosts_file(path):
+    """Читает hosts-файл: на каждое имя - A или AAAA, на первое имя строки - еще и PTR"""
+    resources = []
+    with open(path, encoding='utf-8') as file:
+        for line_no, line in enumerate(file, 1):
+            fields = line.split('#', 1)[0].split()
+            if len(fields) < 2:
+                continue
+            try:
+                family, r_type = (socket.AF_INET6, 28) if ':' in fields[0] else (socket.AF_INET, 1)
+                address = socket.inet_pton(family, fields[0])
+                names = [absolute_name(name.rstrip('.') + '.', '.') for name in fields[1:]]
+            except (ValueError, OSError) as ex:
+                raise ZoneError('{}:{}: {}'.format(path, line_no, ex))
+            for name in names:
+                resources.append(DnsResource(name, r_type, 1, HOSTS_TTL, address))
+            if r_type == 1:
+                reverse = '.'.join(fields[0].split('.')[::-1]) + '.in-addr.arpa.'
+            else:
+                reverse = '.'.join(address.hex()[::-1]) + '.ip6.arpa.'
+            resources.append(DnsResource(reverse, PTR_TYPE, 1, HOSTS_TTL, wire_name(names[0])))
+    return resources
+
+
+class ZoneNode:
+    """Узел дерева: одна метка имени"""
+    __slots__ = ('children', 'records', 'soa', 'hosts')
+
+    def __init__(self):
+        self.children = {}  # метка -> ZoneNode
+        self.records = {}  # тип -> [записи]
+        self.soa = None  # Запись SOA, если здесь вершина зоны
+        self.hosts = False  # Есть ли здесь записи из hosts-файла
+
+
+class LocalAnswer:
+    """Ответ из локальных зон. target - имя, на которое указывает последний CNAME, если его нет в наших зонах:
+    тогда остаток цепочки сервак ищет обычным путем (кэш и форвардер)"""
+    __slots__ = ('rcode', 'answer', 'authority', 'target')
+
+    def __init__(self, rcode, answer, authority=(), target=None):
+        self.rcode = rcode
+        self.answer = answer
+        self.authority = list(authority)
+        self.target = target
+
+
+class LocalZones:
+    """Все локальные зоны и hosts-записи сервака"""
+    def __init__(self):
+        self.root = ZoneNode()
+        self.zones = []  # Имена вершин зон
+        self.records = 0
+        self.files = []
+        self.loaded_at = time.time()
+
+    @staticmethod
+    def load(zone_files=(), hosts_files=()):
+        """Читает все файлы и строит дерево. Если хоть в одном файле ошибка, выкидывает ZoneError"""
+        zones = LocalZones()
+        for path, parse, hosts in [(path, parse_zone_file, False) for path in zone_files] + \
+                [(path, parse_hosts_file, True) for path in hosts_files]:
+            try:
+                resources = parse(path)
+            except (OSError, UnicodeDecodeError) as ex:
+                raise ZoneError('{}: {}'.format(path, ex))
+            for resource in resources:
+                zones.add(resource, hosts)
+            zones.files.append(path)
+        return zones
+
+    def add(self, resource, hosts=False):
+        node = self.root
+        for label in name_labels(resource.r_name):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = ZoneNode()
+            node = child
+        same_type = node.records.setdefault(resource.r_type, [])
+        if resource in same_type:
+            return  # Такая запись уже есть
+        same_type.append(resource)
+        self.records += 1
+        node.hosts = node.hosts or hosts
+        if resource.r_type == SOA_TYPE and node.soa is None:
+            node.soa = resource
+            self.zones.append(resource.r_name)
+
+    def find(self, name):
+        """Ищет имя в дереве. Возвращает (узел, узел вершины зоны, нашлось ли имя целиком).
+        Если имени целиком нет, узел - его ближайший существующий предок.
+        None - имя не наше: вне наших зон (и не из hosts) или ниже точки делегирования"""
+        node = self.root
+        zone = None
+        for label in name_labels(name):
+            child = node.children.get(label)
+            if child is None:
+                return (node, zone, False) if zone is not None else None
+            node = child
+            if node.soa is not None:
+                zone = node
+            elif zone is not None and NS_TYPE in node.records:
+                return None  # Поддомен отдан другим серверам, пусть на него отвечает форвардер
+        if zone is None and not node.hosts:
+            return None
+        return node, zone, True
+
+    def lookup(self, question):
+        """Ответ на вопрос из локальных зон (LocalAnswer) или None, если имя не наше"""
+        if question.q_class != 1 or not self.root.children:
+            return None
+        answer = []
+        name = question.q_name
+        seen = set()
+        for _ in range(MAX_CNAME_CHAIN):
+            if name.lower() in seen:
+                break
+            seen.add(name.lower())
+            found = self.find(name)
+            if found is None:
+                return LocalAnswer(0, answer, target=name) if answer else None
+            node, zone, exact = found
+            if not exact:
+                node = node.children.get('*')
+                if node is None:
+                    return LocalAnswer(NXDOMAIN, answer, [self.negative_soa(zone)])
+            records = node.records
+            cname = records.get(CNAME_TYPE)
+            if cname and question.q_type != CNAME_TYPE:
+                record = self.owned_by(cname[0], name)
+                answer.append(record)
+                name = parse_address(record.r_data).decode()
+                continue
+            if question.q_type == ANY_TYPE:
+                found_records = [record for same_type in records.values() for record in same_type]
+            else:
+                found_records = records.get(question.q_type, [])
+            if found_records:
+                return LocalAnswer(0, answer + [self.owned_by(record, name) for record in found_records])
+            return LocalAnswer(0, answer, [self.negative_soa(zone)] if zone is not None else [])  # NODATA
+        return LocalAnswer(SERVFAIL, answer)  # Цепочка CNAME слишком длинная или зациклилась
+
+    @staticmethod
+    def owned_by(record, name):
+        """Запись с именем вопроса (для записей, найденных по шаблону "*", имя другое)"""
+        if record.r_name == name:
+            return record
+        return DnsResource(name, record.r_type, record.r_class, record.r_ttl, record.r_data)
+
+    @staticmethod
+    def negative_soa(zone):
+        """SOA для отрицательного ответа (с TTL по RFC 2308, как и в DnsCache)"""
+        soa = zone.soa
+        return DnsResource(soa.r_name, soa.r_type, soa.r_class, negative_ttl(soa), soa.r_data)
+
+    def get_status(self):
+        return 'Zones: {}\nRecords: {}\nFiles: {}\nLoaded: {}'.format(
+            ' '.join(self.zones) or '-', self.records, ' '.join(self.files) or '-',
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.loaded_at)))
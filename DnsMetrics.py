@@ -0,0 +1,189 @@
+import bisect
+import http.server
+import threading
+import time
+
+
+"""Метрики сервака: счетчики (сколько запросов, попаданий, промахов, ошибок...) и гистограммы
+времени каждого этапа обработки запроса (ожидание в очереди, разбор, поиск в кэше, поход к форвардеру,
+сборка ответа, отправка).
+Смотреть их можно командой stats в консоли или HTTP-запросом в формате Prometheus (--metrics-port)."""
+"""ПОЯСНЕНИЕ! Метрики обновляются на каждом запросе, поэтому они максимально дешевые: счетчик - это
+элемент словаря, гистограмма - массив счетчиков по фиксированным корзинам (поиск корзины - bisect).
+Локов нет: под GIL одновременное увеличение одного счетчика из двух потоков изредка может потерять
+единичку, но для статистики это не страшно, а лок на каждом запросе стоил бы заметно дороже.
+Раньше на каждый запрос печаталась строка в консоль - это и тормозило (вывод синхронный), и чисел не давало.
+Теперь эти строки - отладочный лог (DebugLog): по умолчанию выключен, а включенный печатает
+не больше заданного числа строк в секунду."""
+
+COUNTERS = (
+    ('queries', 'Запросов от клиентов'),
+    ('tcp_queries', 'Из них по TCP'),
+    ('response_cache_hits', 'Ответов из кэша готовых ответов'),
+    ('local_answers', 'Вопросов, на которые ответили локальные зоны и hosts-файлы'),
+    ('blocked', 'Вопросов про имена из блоклиста'),
+    ('cname_loops', 'Вопросов, у которых цепочка CNAME зациклилась или слишком длинная (ответ SERVFAIL)'),
+    ('cache_hits', 'Вопросов, найденных в кэше записей'),
+    ('negative_hits', 'Вопросов, на которые в кэше есть отрицательный ответ'),
+    ('misses', 'Вопросов, за которыми пришлось идти к форвардеру'),
+    ('upstream_failures', 'Вопросов, на которые форвардеры так и не ответили'),
+    ('stale_answers', 'Вопросов, на которые ответили протухшими записями (serve-stale)'),
+    ('truncated', 'Ответов, обрезанных до флага TC'),
+    ('shed_queries', 'Запросов, выкинутых из-за переполненной очереди или слишком долгого ожидания в ней'),
+    ('shed_misses', 'Промахов, выкинутых из-за того, что форвардера и так ждет слишком много запросов'),
+    ('rate_limited', 'Запросов, выкинутых из-за лимита ответов одному клиенту'),
+    ('rate_slipped', 'Запросов сверх лимита, на которые ушел пустой ответ с флагом TC'),
+    ('tcp_refused', 'TCP-соединений, закрытых сразу из-за того, что их и так слишком много'),
+    ('formerr', 'Запросов со слишком большим числом вопросов (ответ FORMERR)'),
+    ('errors', 'Запросов, на которых что-то упало'),
+)
+STAGES = ('queue', 'parse', 'cache', 'upstream', 'encode', 'send')
+LATENCY_BUCKETS = tuple(0.00001 * 2 ** i for i in range(21))  # Верхние границы корзин: от 10 мкс до ~10 с
+DEBUG_LOG_RATE = 20  # Сколько строк в секунду печатает отладочный лог, если его включили без --debug-log
+
+
+class Histogram:
+    """Гистограмма времен (в секундах) по корзинам LATENCY_BUCKETS, последняя корзина - все, что дольше"""
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0  # Сумма всех времен (для среднего)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def quantile(self, fraction):
+        """Оценка перцентиля: верхняя граница корзины, в которую он попал (или None, если замеров нет)"""
+        counts = list(self.counts)
+        rank = sum(counts) * fraction
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float('inf')
+        return None
+
+
+class Metrics:
+    """Все метрики одного сервака (в режиме воркеров - у каждого воркера свои)"""
+    def __init__(self):
+        self.counters = dict.fromkeys((name for name, _ in COUNTERS), 0)
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.sources = []  # Функции, возвращающие {имя: значение} - числа, которые считают другие части сервака
+        self.started = time.time()
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def collect(self):
+        """Числа из других частей сервака (кэш, форвардеры, склейка запросов...)"""
+        result = {}
+        for source in self.sources:
+            result.update(source())
+        return result
+
+    def get_status(self):
+        """Текст для команды stats"""
+        lines = ['Uptime: {:.0f}s'.format(time.time() - self.started)]
+        lines += ['{}: {}'.format(name, self.counters[name]) for name, _ in COUNTERS]
+        lines += ['{}: {}'.format(name, value) for name, value in self.collect().items()]
+        lines.append('{:10s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('stage', 'count', 'avg ms', 'p50 ms', 'p99 ms'))
+        for stage, histogram in self.stages.items():
+            count = sum(histogram.counts)
+            if not count:
+                continue
+            lines.append('{:10s} {:10d} {:10.3f} {:>10s} {:>10s}'.format(
+                stage, count, histogram.total / count * 1000,
+                '<{:.3f}'.format(histogram.quantile(0.5) * 1000), '<{:.3f}'.format(histogram.quantile(0.99) * 1000)))
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """Текстовый формат Prometheus (version 0.0.4)"""
+        lines = []
+        for name, help_text in COUNTERS:
+            lines.append('# HELP dns_{}_total {}'.format(name, help_text))
+            lines.append('# TYPE dns_{}_total counter'.format(name))
+            lines.append('dns_{}_total {}'.format(name, self.counters[name]))
+        for name, value in self.collect().items():
+            lines.append('# TYPE dns_{} gauge'.format(name))
+            lines.append('dns_{} {}'.format(name, value))
+        lines.append('# HELP dns_stage_seconds Время этапов обработки запроса')
+        lines.append('# TYPE dns_stage_seconds histogram')
+        for stage, histogram in self.stages.items():
+            counts = list(histogram.counts)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), counts):
+                cumulative += count
+                lines.append('dns_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    stage, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+            lines.append('dns_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram.total))
+            lines.append('dns_stage_seconds_count{{stage="{}"}} {}'.format(stage, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Не засоряем консоль каждым опросом
+
+
+class MetricsServer:
+    """HTTP-сервер с метриками в формате Prometheus. Слушает только localhost"""
+    def __init__(self, metrics, port):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = metrics
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='MetricsServer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class DebugLog:
+    """Отладочный лог запросов. Выключенный стоит одну проверку флага, включенный печатает
+    не больше rate строк в секунду, а о пропущенных строках сообщает, когда снова есть место"""
+    def __init__(self, rate=0):
+        self.rate = rate or DEBUG_LOG_RATE
+        self.enabled = rate > 0
+        self.lock = threading.Lock()
+        self.tokens = self.rate
+        self.tokens_time = time.monotonic()
+        self.suppressed = 0
+
+    def debug(self, message, *args):
+        if not self.enabled:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.tokens_time) * self.rate)
+            self.tokens_time = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            print('({} debug messages suppressed)'.format(suppressed))
+        print(message.format(*args))  # Строку собираем, только если ее правда печатаем
@@ -0,0 +1,178 @@
+import collections
+import threading
+import time
+from DNSPacketParser import HEADER_STRUCT, FLAG_TC
+from DnsCache import parse_request_key
+
+
+"""Защита сервака от перегрузки.
+Раньше на каждую датаграмму заводился свой поток, без всякого предела: один шумный (или злой) клиент
+мог наплодить тысячи потоков, съесть память и затормозить ответы всем остальным.
+Теперь запросы обрабатывает фиксированный пул потоков (WorkQueue) из ограниченной очереди,
+а то, что в очередь не влезло, просто выкидывается - клиент переспросит."""
+"""ПОЯСНЕНИЕ! Выкидывать стараемся промахи, а не попадания в кэш:
+- готовые ответы (ResponseCache) отдаются прямо в потоке-приемнике и в очередь вообще не попадают;
+- ждать форвардера одновременно может только часть пула (Admission), остальные потоки всегда свободны
+  для ответов из кэша. Промах сверх этого предела выкидывается (или получает протухшие записи, если есть);
+- запрос, пролежавший в очереди дольше QUEUE_MAX_WAIT, клиент скорее всего уже не ждет - его тоже выкидываем,
+  чтобы под нагрузкой не отвечать только на давно никому не нужные запросы.
+А RateLimiter ограничивает, сколько ответов в секунду получает один IP (как RRL в BIND)."""
+
+WORKER_THREADS = 64  # Сколько потоков обрабатывают запросы (в режиме threads)
+QUEUE_SIZE = 1024  # Сколько запросов может ждать в очереди
+QUEUE_MAX_WAIT = 1  # Сколько секунд запрос может пролежать в очереди
+MISS_SHARE = 0.75  # Какая доля пула может одновременно ждать форвардера
+MISS_THREADS = 16  # Сколько потоков спрашивают форвардера о вопросах пакета, кроме первого (см. resolve_misses)
+MISS_QUEUE_SIZE = 64  # Сколько таких вопросов может ждать свободного потока
+MAX_QUESTIONS = 4  # Сколько вопросов может быть в одном запросе (на большее отвечаем FORMERR)
+RATE_SLIP = 2  # Каждый какой ответ сверх лимита отдаем обрезанным (TC), а не выкидываем (0 - выкидывать все)
+RATE_TABLE_SIZE = 65536  # Сколько клиентов помнит RateLimiter
+
+ALLOW = 0  # Отвечаем как обычно
+SLIP = 1  # Отвечаем пустым ответом с флагом TC: настоящий клиент переспросит по TCP
+DROP = 2  # Не отвечаем
+
+
+class Overloaded(Exception):
+    """Промах, который некому обработать: все места для ожидания форвардера заняты"""
+
+
+class Admission:
+    """Ограничение на число запросов, одновременно ждущих форвардера"""
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def try_enter(self):
+        with self.lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+
+class WorkQueue:
+    """Ограниченная очередь запросов и фиксированный пул потоков, которые ее разбирают.
+    handler(сколько секунд элемент пролежал в очереди, *item) вызывается для каждого элемента.
+    Если handler упал, зовем on_error(исключение), а поток берет следующий элемент"""
+    def __init__(self, handler, threads=WORKER_THREADS, size=QUEUE_SIZE, on_error=None):
+        self.handler = handler
+        self.on_error = on_error
+        self.threads = threads
+        self.size = size
+        self.items = collections.deque()  # (когда положили, элемент)
+        self.condition = threading.Condition()
+        self.running = False
+        self.workers = []
+        self.max_depth = 0  # Самая длинная очередь за все время
+
+    def start(self):
+        self.running = True
+        for index in range(self.threads):
+            worker = threading.Thread(target=self.work, name='Worker-{}'.format(index), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """Останавливает пул, дав ему доделать то, что уже в очереди"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def put(self, item):
+        """Кладет элемент в очередь. Если места нет (или пул уже остановлен), возвращает False"""
+        with self.condition:
+            if not self.running or len(self.items) >= self.size:
+                return False
+            self.items.append((time.monotonic(), item))
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.condition.notify()
+        return True
+
+    def work(self):
+        while True:
+            with self.condition:
+                while self.running and not self.items:
+                    self.condition.wait()
+                if not self.items:
+                    return  # Остановили, и все доделано
+                queued_at, item = self.items.popleft()
+            try:
+                self.handler(time.monotonic() - queued_at, *item)
+            except Exception as ex:
+                """Кривой элемент должен стоить одного запроса, а не потока: поток, убитый исключением,
+                никто не пересоздаст, и пул так потихоньку вымрет"""
+                if self.on_error is not None:
+                    self.on_error(ex)
+
+    def depth(self):
+        return len(self.items)
+
+
+class RateLimiter:
+    """Ограничение частоты ответов одному IP: ведро на burst жетонов, которое пополняется
+    со скоростью rate жетонов в секунду. Каждый ответ стоит жетон.
+    Зовут его поток-приемник UDP и потоки TCP-соединений, поэтому под локом"""
+    def __init__(self, rate, burst=None, slip=RATE_SLIP, max_clients=RATE_TABLE_SIZE):
+        self.rate = rate
+        self.burst = max(1.0, burst or rate)  # По умолчанию - секунда ответов (но хотя бы один ответ:
+        # при rate < 1 ведро меньше жетона не дало бы ответить никому и никогда)
+        self.slip = slip
+        self.max_clients = max_clients
+        self.clients = {}  # IP -> [жетонов, когда считали, сколько ответов подряд не уложилось в лимит]
+        self.lock = threading.Lock()
+
+    def check(self, ip):
+        """Возвращает ALLOW, SLIP или DROP"""
+        with self.lock:
+            return self.take(ip)
+
+    def take(self, ip):
+        now = time.monotonic()
+        entry = self.clients.get(ip)
+        if entry is None:
+            if len(self.clients) >= self.max_clients:
+                self.prune(now)
+            entry = self.clients[ip] = [self.burst, now, 0]
+        tokens = min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+        entry[1] = now
+        if tokens >= 1:
+            entry[0] = tokens - 1
+            entry[2] = 0
+            return ALLOW
+        entry[0] = tokens
+        entry[2] += 1
+        if self.slip and entry[2] % self.slip == 0:
+            return SLIP
+        return DROP
+
+    def prune(self, now):
+        """Забывает клиентов, чьи ведра уже снова полные (для них это ничего не меняет).
+        Если таблица все равно полна - забывает всех: она не должна расти бесконечно от подделанных адресов"""
+        full_after = self.burst / self.rate
+        self.clients = {ip: entry for ip, entry in self.clients.items() if now - entry[1] < full_after}
+        if len(self.clients) >= self.max_clients:
+            self.clients = {}
+
+
+def slip_response(raw_packet):
+    """Пустой ответ с флагом TC на сырой запрос (только заголовок и вопрос) или None, если запрос непростой"""
+    try:
+        request = parse_request_key(raw_packet)
+    except Exception:
+        return None
+    if request is None:
+        return None
+    _, question_length, _ = request
+    packet_id, flags, _, _, _, _ = HEADER_STRUCT.unpack_from(raw_packet, 0)
+    response = bytearray(HEADER_STRUCT.pack(packet_id, (flags & 0x7900) | 0x8000 | FLAG_TC, 1, 0, 0, 0))
+    # Из флагов запроса оставляем opcode и RD, ставим QR (это ответ) и TC
+    response += raw_packet[HEADER_STRUCT.size:HEADER_STRUCT.size + question_length]
+    return response
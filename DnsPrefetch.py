@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import threading
+import time
+from DNSPacketParser import DnsQuestion
+from DnsCache import CnameLoop
+
+
+"""Упреждающее обновление популярных записей (refresh-ahead).
+Без него популярная запись протухает раз в TTL, и следующий клиент ждет полный поход к форвардеру.
+Поэтому считаем, сколько раз спрашивали каждый вопрос, и если запись популярная,
+то незадолго до протухания (в последние fraction ее TTL) переспрашиваем форвардер сами, в фоне."""
+"""ПОЯСНЕНИЕ! Чтобы не пробегать все вопросы на каждом тике, для каждого вопроса один раз
+считаем момент обновления и кладем его в кучу. Поток-обновлятор снимает с кучи только то,
+чему уже пора: если вопрос с прошлого раза спрашивали достаточно часто - обновляем,
+иначе просто забываем про него (следующий запрос клиента снова начнет его считать)."""
+"""ПОЯСНЕНИЕ 2! Обновление - такой же поход к форвардеру, как промах клиента, поэтому оно занимает место
+в admission сервака (нет места - откладываем) и идет тем же путем, что и промахи: в режиме asyncio -
+корутиной в event loop-е движка, через его AsyncSingleFlight, чтобы не дублировать запросы клиентов."""
+
+PREFETCH_FRACTION = 0.1  # В какой последней доле TTL обновляем запись (0 - не обновляем вообще)
+PREFETCH_MIN_HITS = 3  # Сколько раз вопрос должны спросить с прошлого обновления, чтобы он считался популярным
+PREFETCH_CONCURRENCY = 4  # Сколько обновлений идет одновременно
+PREFETCH_RATE = 20  # Сколько обновлений в секунду максимум
+PREFETCH_MAX_TRACKED = 10000  # Больше стольких вопросов не отслеживаем (чтобы поток случайных имен не съел память)
+PREFETCH_TICK = 0.1  # Как часто поток-обновлятор просыпается (в секундах)
+
+
+class Prefetcher:
+    """Поток, заранее обновляющий популярные записи кэша через get_from_forwarder сервака (или его движка asyncio)"""
+    def __init__(self, server, fraction=PREFETCH_FRACTION, concurrency=PREFETCH_CONCURRENCY,
+                 rate=PREFETCH_RATE, min_hits=PREFETCH_MIN_HITS):
+        self.server = server
+        self.fraction = fraction
+        self.rate = rate
+        self.min_hits = min_hits
+        self.lock = threading.Lock()
+        self.hits = {}  # ключ вопроса -> сколько раз спросили с прошлого обновления
+        self.new_keys = []  # Вопросы, для которых еще не посчитан момент обновления
+        self.schedule = []  # Куча из (момент обновления, ключ вопроса)
+        self.slots = threading.BoundedSemaphore(concurrency)  # Ограничение на одновременные обновления
+        self.tokens = rate  # Ведро токенов для ограничения частоты обновлений
+        self.tokens_time = time.monotonic()
+        self.prefetched = 0  # Сколько обновлений сделали
+        self.postponed = 0  # Сколько раз откладывали обновление из-за ограничений
+        self.running = False
+        self.thread = threading.Thread(target=self.loop, name='Prefetcher', daemon=True)
+
+    def start(self):
+        if self.fraction <= 0:
+            return  # Обновление выключено
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def hit(self, key):
+        """Учитывает запрос клиента по ключу вопроса (имя, тип, класс). Вызывается на каждый вопрос"""
+        if not self.running:
+            return
+        with self.lock:
+            count = self.hits.get(key)
+            if count is not None:
+                self.hits[key] = count + 1
+            elif len(self.hits) < PREFETCH_MAX_TRACKED:
+                self.hits[key] = 1
+                self.new_keys.append(key)
+
+    def refresh_time(self, key):
+        """Момент, когда пора обновлять вопрос (по записи, которая протухнет раньше всех),
+        или None, если в кэше по нему ничего нет"""
+        try:
+            resources = self.server.get_from_cache(DnsQuestion(*key))
+        except CnameLoop:
+            return None  # Зацикленную цепочку CNAME обновлять незачем
+        times = [(self.server.cache.get_expire_time(resource), resource.r_ttl) for resource in resources]
+        times = [(expire_time, ttl) for expire_time, ttl in times if expire_time is not None]
+        if not times:
+            return None
+        expire_time, ttl = min(times)
+        return expire_time - ttl * self.fraction
+
+    def take_token(self):
+        """Ведро токенов: не больше rate обновлений в секунду"""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.tokens_time) * self.rate)
+        self.tokens_time = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def loop(self):
+        while self.running:
+            time.sleep(PREFETCH_TICK)
+            with self.lock:
+                new_keys, self.new_keys = self.new_keys, []
+            for key in new_keys:
+                self.reschedule(key)
+            now = time.time()
+            while self.schedule and self.schedule[0][0] <= now:
+                refresh_at, key = heapq.heappop(self.schedule)
+                with self.lock:
+                    hot = self.hits.get(key, 0) >= self.min_hits
+                if not hot:
+                    self.forget(key)
+                    continue
+                if not self.acquire():
+                    """Уперлись в ограничения - попробуем на следующем тике, если запись к тому времени не протухнет"""
+                    self.postponed += 1
+                    heapq.heappush(self.schedule, (now + PREFETCH_TICK, key))
+                    break
+                threading.Thread(target=self.refresh, args=(key,), name='Prefetch', daemon=True).start()
+
+    def acquire(self):
+        """Занимает место для обновления: токен, слот обновлятора и место в admission сервака"""
+        if not self.take_token() or not self.slots.acquire(blocking=False):
+            return False
+        if not self.server.admission.try_enter():
+            self.slots.release()
+            return False
+        return True
+
+    def forget(self, key):
+        with self.lock:
+            self.hits.pop(key, None)
+
+    def reschedule(self, key):
+        """Считает момент обновления вопроса и кладет его в кучу. Если в кэше ничего нет - забываем вопрос"""
+        refresh_at = self.refresh_time(key)
+        if refresh_at is None:
+            self.forget(key)
+            return
+        heapq.heappush(self.schedule, (refresh_at, key))
+
+    def refresh(self, key):
+        """Собственно обновление (в отдельном потоке)"""
+        try:
+            with self.lock:
+                if key in self.hits:
+                    self.hits[key] = 0  # Популярность считаем заново до следующего обновления
+            question = DnsQuestion(*key)
+            engine = self.server.async_engine
+            if engine is not None:
+                asyncio.run_coroutine_threadsafe(engine.get_from_forwarder(question), engine.loop).result()
+            else:
+                self.server.get_from_forwarder(question)
+            self.prefetched += 1
+        except Exception as ex:
+            self.server.metrics.inc('errors')
+            self.server.log.debug('Prefetch failed: {!r}', ex)
+        finally:
+            self.server.admission.leave()
+            self.slots.release()
+        if self.running:
+            with self.lock:
+                self.new_keys.append(key)  # Момент следующего обновления посчитает поток-обновлятор
+
+    def get_status(self):
+        return 'Prefetched: {}\nPrefetch postponed: {}'.format(self.prefetched, self.postponed)
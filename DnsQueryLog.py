@@ -0,0 +1,207 @@
+import argparse
+import collections
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import time
+from DNSPacketParser import DNSPacket
+from DnsMetrics import DebugLog
+
+
+"""Бинарный лог запросов: каждый запрос клиента и ответ на него в wire-формате, со временем, адресом клиента,
+задержкой и флагами. Нужен для планирования мощностей и для того, чтобы прогнать настоящий трафик
+через сервак еще раз (python bench/replay.py). Включается параметром --query-log.
+Посмотреть лог глазами: python DnsQueryLog.py dump querylog [querylog.1 ...]"""
+"""ПОЯСНЕНИЕ! Потоки, отвечающие клиентам, только кладут кортеж в ограниченную очередь (deque.append
+атомарен, лок не нужен), а упаковывает и пишет записи на диск отдельный поток, пачками раз в
+QUERY_LOG_FLUSH секунд. Если диск не успевает и очередь полна, запись выкидывается (и учитывается
+в dropped), а не тормозит ответы. Файл, доросший до max_bytes, переименовывается в querylog.1
+(старый querylog.1 - в querylog.2 и т.д., самый старый удаляется), и лог начинается заново."""
+"""ПОЯСНЕНИЕ 2! Формат файла: FILE_MAGIC, потом записи подряд. Запись - длина (4 байта, little-endian),
+за ней RECORD_STRUCT, сырой запрос и сырой ответ (ответа нет, если запрос выкинули)"""
+
+FILE_MAGIC = b'DNSQLOG1'
+LENGTH_STRUCT = struct.Struct('<I')
+RECORD_STRUCT = struct.Struct('<dIB16sHHH')  # когда пришел запрос (unix time), задержка (мкс), флаги,
+# адрес клиента (IPv4 - как ::ffff:a.b.c.d), порт, длина запроса, длина ответа
+QUERY_LOG_BUFFER = 65536  # Сколько записей может ждать записи на диск
+QUERY_LOG_FLUSH = 0.5  # Раз во сколько секунд пишем накопившееся
+QUERY_LOG_MAX_BYTES = 64 * 1024 * 1024  # При таком размере файл уходит в ротацию
+QUERY_LOG_FILES = 10  # Сколько старых файлов храним
+
+FLAG_CACHED = 1  # Ответили без форвардера (из кэша, локальных зон или блоклиста)
+FLAG_TCP = 2  # Запрос пришел по TCP
+FLAG_DROPPED = 4  # Запрос выкинули (перегрузка или ошибка), ответа не было
+
+QueryRecord = collections.namedtuple('QueryRecord', 'time latency flags address port query response')
+
+
+def pack_client_address(ip):
+    """Адрес клиента в 16 байт RECORD_STRUCT (IPv4 - как ::ffff:a.b.c.d)"""
+    if ':' not in ip:
+        ip = '::ffff:' + ip
+    return socket.inet_pton(socket.AF_INET6, ip)
+
+
+def unpack_client_address(packed):
+    address = ipaddress.IPv6Address(packed)
+    return str(address.ipv4_mapped or address)
+
+
+def encode_record(logged_at, latency, flags, addr, query, response):
+    """Упаковывает запись лога (вместе с длиной)"""
+    query = query[:0xffff]
+    response = response[:0xffff] if response is not None else b''
+    header = RECORD_STRUCT.pack(logged_at - latency, min(0xffffffff, int(latency * 1000000)), flags,
+                                pack_client_address(addr[0]), addr[1], len(query), len(response))
+    return LENGTH_STRUCT.pack(len(header) + len(query) + len(response)) + header + query + response
+
+
+def read_log(path):
+    """Генератор записей (QueryRecord) из файла лога. Недописанный хвост (сервак упал) молча пропускаем"""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if data[:len(FILE_MAGIC)] != FILE_MAGIC:
+        raise ValueError('{} is not a query log'.format(path))
+    offset = len(FILE_MAGIC)
+    while offset + LENGTH_STRUCT.size <= len(data):
+        length = LENGTH_STRUCT.unpack_from(data, offset)[0]
+        offset += LENGTH_STRUCT.size
+        if length < RECORD_STRUCT.size or offset + length > len(data):
+            return
+        started, latency, flags, address, port, query_length, response_length = \
+            RECORD_STRUCT.unpack_from(data, offset)
+        query_start = offset + RECORD_STRUCT.size
+        response_start = query_start + query_length
+        yield QueryRecord(started, latency / 1000000, flags, unpack_client_address(address), port,
+                          data[query_start:response_start], data[response_start:response_start + response_length])
+        offset += length
+
+
+class QueryLog:
+    """Лог запросов: record зовут потоки, отвечающие клиентам, а пишет на диск свой поток"""
+    def __init__(self, path, max_bytes=QUERY_LOG_MAX_BYTES, max_files=QUERY_LOG_FILES, buffer_size=QUERY_LOG_BUFFER,
+                 log=None):
+        self.path = path
+        self.log = log if log is not None else DebugLog()  # Куда жаловаться на ошибки записи (сервак дает свой)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.buffer_size = buffer_size
+        self.buffer = collections.deque()  # (время, задержка, флаги, адрес, запрос, ответ)
+        self.file = None
+        self.running = False
+        self.thread = None
+        self.written = 0  # Сколько записей записали
+        self.dropped = 0  # Сколько выкинули из-за полной очереди (без лока, так что число примерное)
+        self.rotations = 0
+
+    def start(self):
+        self.open_file()
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, name='QueryLog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Останавливает поток и дописывает все, что накопилось"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        self.file.close()
+
+    def record(self, addr, query, response, flags, latency):
+        """Кладет запрос в очередь на запись (response - None, если запрос выкинули)"""
+        if len(self.buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self.buffer.append((time.time(), latency, flags, addr, query, response))
+
+    def loop(self):
+        while self.running:
+            time.sleep(QUERY_LOG_FLUSH)
+            self.flush()
+
+    def flush(self):
+        """Пишет все, что накопилось, одним write (или несколькими, если по дороге файл пора ротировать)"""
+        chunk = bytearray()
+        count = 0
+        while True:
+            try:
+                item = self.buffer.popleft()
+            except IndexError:
+                break
+            chunk += encode_record(*item)
+            count += 1
+            if self.file.tell() + len(chunk) >= self.max_bytes:
+                if not self.write(chunk, count, rotate=True):
+                    return
+                chunk = bytearray()
+                count = 0
+        if chunk:
+            self.write(chunk, count)
+
+    def write(self, chunk, count, rotate=False):
+        try:
+            self.file.write(chunk)
+            self.file.flush()
+            if rotate:
+                self.rotate()
+        except OSError as ex:
+            self.dropped += count
+            self.log.debug('Query log write failed: {!r}', ex)  # Через DebugLog: при лежащем диске
+            # это повторялось бы на каждом flush, а он ограничивает число строк в секунду
+            return False
+        self.written += count
+        return True
+
+    def open_file(self):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(FILE_MAGIC)
+
+    def rotate(self):
+        """querylog -> querylog.1 -> querylog.2 ... (самый старый пропадает)"""
+        self.file.close()
+        for index in range(self.max_files - 1, 0, -1):
+            older = '{}.{}'.format(self.path, index)
+            if os.path.exists(older):
+                os.replace(older, '{}.{}'.format(self.path, index + 1))
+        if self.max_files > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self.open_file()
+
+    def get_status(self):
+        return 'Query log: {}\nRecords written: {}\nRecords dropped: {}\nWaiting: {}\nRotations: {}'.format(
+            self.path, self.written, self.dropped, len(self.buffer), self.rotations)
+
+
+def describe(record):
+    """Строка про запись лога для dump"""
+    try:
+        query = DNSPacket.from_bytes(record.query)
+        question = ' '.join('{} {}'.format(q.q_name, q.q_type) for q in query.question)
+    except Exception:
+        question = '<unparsable query>'
+    flags = ','.join(name for flag, name in ((FLAG_CACHED, 'cached'), (FLAG_TCP, 'tcp'), (FLAG_DROPPED, 'dropped'))
+                     if record.flags & flag) or '-'
+    rcode = record.response[3] & 15 if len(record.response) >= 4 else '-'
+    return '{}.{:03d} {}:{} {} rcode {} {:.3f}ms {} {}B'.format(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.time)), int(record.time * 1000) % 1000,
+        record.address, record.port, question, rcode, record.latency * 1000, flags, len(record.response))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Просмотр бинарного лога запросов DnsServer --query-log '
+                                                 '(прогнать лог через сервак: python bench/replay.py)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    dump_parser = commands.add_parser('dump', help='вывести записи лога по строке на запрос')
+    dump_parser.add_argument('logs', nargs='+', help='файлы лога (старые первыми: querylog.2 querylog.1 querylog)')
+    args = parser.parse_args()
+    for path in args.logs:
+        for record in read_log(path):
+            print(describe(record))
@@ -0,0 +1,159 @@
+import time
+from DNSPacketParser import DNSPacket
+from DnsCache import CnameLoop, MAX_CNAME_CHAIN
+from DnsOverload import Overloaded
+from DnsQueryLog import FLAG_CACHED, FLAG_TCP
+
+
+"""Логика ответа на промах, общая для обоих движков (потоков и asyncio).
+Раньше resolve_query, resolve_miss, chase_chain и прочие были написаны дважды: в DnsServer
+и почти построчно в DnsAsyncEngine (с await), и любая правка в одном месте забывалась в другом.
+Теперь все решения принимаются здесь, в генераторах, а когда нужен ввод-вывод, генератор отдает (yield)
+запрос на него и ждет результат. Выполняет эти запросы движок: DnsServer.drive - блокирующими вызовами,
+AsyncEngine.drive - через await. Ошибку ввода-вывода движок выкидывает обратно в генератор (throw)."""
+"""ПОЯСНЕНИЕ! Запрос на ввод-вывод - это пара (вид, аргумент), видов всего четыре (см. ниже).
+Сами генераторы ничего не ждут и потоков не заводят, так что одновременность - тоже забота движка:
+промахи пакета потоки спрашивают в пуле miss_queue, а asyncio - через gather."""
+
+IO_UPSTREAM = 0  # (IO_UPSTREAM, вопрос) -> сырой ответ форвардера или None (пул сокетов движка)
+IO_FORWARDER = 1  # (IO_FORWARDER, вопрос) -> записи (get_from_forwarder движка, через SingleFlight)
+IO_MISSES = 2  # (IO_MISSES, [вопросы]) -> по каждому fetch_miss: записи, CnameLoop или другое исключение
+IO_REFRESH = 3  # (IO_REFRESH, вопрос) -> refresh_stale в фоне; записи, если успел за stale_deadline, иначе None
+
+
+def resolve_query(server, raw_packet, tcp=False, client=None):
+    """Вторая часть handle_query: собирает ответ из кэша записей, а чего там нет - спрашивает у форвардера.
+    Возвращает сырой ответ или None, если запрос выкинули"""
+    metrics = server.metrics
+    raw_response = None
+    flags = FLAG_TCP if tcp else 0  # Для лога запросов
+    try:
+        generation = server.response_cache.generation
+        started = time.perf_counter()
+        packet = DNSPacket.from_bytes(raw_packet)  # Распаковываем запрос
+        metrics.observe('parse', time.perf_counter() - started)
+        raw_response = server.check_questions(packet)
+        if raw_response is not None:
+            return raw_response
+        response = DNSPacket(
+            packet.packet_id, 0x8000,
+            packet.question, [], [], []
+        )  # Формируем ответ
+        """Обрабатываем каждый запрос клиента: сначала отвечаем все, что можно, без форвардера,
+        а промахи потом спрашиваем у него все разом (IO_MISSES)"""
+        misses = [server.answer_cached(response, question) for question in packet.question]
+        misses = [question for question in misses if question is not None]
+        if not misses:
+            flags |= FLAG_CACHED
+        results = (yield IO_MISSES, misses) if misses else []
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, CnameLoop):
+                raise result  # Overloaded (или ошибка) по одному промаху - и весь пакет не отвечаем
+        for question, resources in zip(misses, results):
+            server.answer_miss(response, question, resources)  # Пакуем эти данные в ответ
+        started = time.perf_counter()
+        raw_response = server.finish_response(packet, response, generation, tcp)
+        metrics.observe('encode', time.perf_counter() - started)
+        return raw_response
+    except Overloaded:
+        metrics.inc('shed_misses')
+        server.log.debug('Too many queries wait for forwarder, dropped one')
+        return None
+    except Exception as ex:
+        metrics.inc('errors')  # Сколько таких, видно в stats, а что именно упало - в отладочном логе
+        server.log.debug('Query failed: {!r}', ex)
+        return None
+    finally:
+        server.log_query(client, raw_packet, raw_response, flags)
+
+
+def fetch_miss(server, question):
+    """resolve_miss с замером времени. Зацикленную цепочку CNAME не выкидывает, а возвращает:
+    на такой вопрос ответ SERVFAIL, а на остальные вопросы пакета - как обычно"""
+    started = time.perf_counter()
+    try:
+        return (yield from resolve_miss(server, question))  # Делаем запрос серваку, получаем данные
+    except CnameLoop as ex:
+        return ex
+    finally:
+        server.metrics.observe('upstream', time.perf_counter() - started)
+
+
+def resolve_miss(server, question):
+    """Для вопроса, которого нет в кэше: спрашиваем форвардера (или отвечаем протухшими записями,
+    см. get_stale_or_forwarder). Если ждать форвардера больше некому (admission), то без протухших записей
+    выкидываем Overloaded - запрос не обрабатываем, клиент переспросит"""
+    stale = server.get_from_cache(question, stale=True)  # Протухшее, но еще хранящееся
+    if not server.admission.try_enter():
+        if stale:
+            return server.answer_stale(question, stale)
+        raise Overloaded()
+    if stale:
+        return (yield from get_stale_or_forwarder(server, question, stale))  # Место в admission он отпустит сам
+    try:
+        return (yield IO_FORWARDER, question) or (yield from chase_chain(server, question))
+    finally:
+        server.admission.leave()
+
+
+def chase_chain(server, question):
+    """Доспрашивает цепочку CNAME, которую форвардер отдал не до конца (так бывает,
+    если хвост цепочки в чужой зоне, а форвардер - не рекурсор): сами спрашиваем у него каноническое имя.
+    Длину цепочки ограничивает follow_chain, а если форвардер ничего нового не сказал - бросаем"""
+    previous = None
+    for _ in range(MAX_CNAME_CHAIN):
+        target, chain = server.follow_chain(question)
+        if not chain or target.q_name.lower() == previous or server.cache.get_negative(target):
+            return []
+        previous = target.q_name.lower()
+        if (yield IO_FORWARDER, target):
+            return server.get_from_cache(question)
+    return []
+
+
+def get_stale_or_forwarder(server, question, stale):
+    """Для вопроса, на который в кэше остались только протухшие записи stale (RFC 8767, serve-stale).
+    Спрашиваем форвардера, но ждем не дольше stale_deadline: не успел - отвечаем протухшими,
+    а ответ форвардера, когда придет, просто попадет в кэш"""
+    """ПОЯСНЕНИЕ! Если форвардер на этот вопрос недавно не ответил, то STALE_RECHECK секунд
+    его не дергаем вовсе: лежащий форвардер иначе тормозил бы каждый запрос на stale_deadline"""
+    """ПОЯСНЕНИЕ 2! Вызывающий (resolve_miss) уже занял место в admission, и отпускает его не он,
+    а обновление (refresh_stale), когда дождется форвардера: иначе при лежащем форвардере обновлений
+    набиралось бы сколько угодно. По той же причине вопрос, который уже обновляется, второй раз не обновляем,
+    а сразу отвечаем протухшими записями. Если движку обновление запустить негде (пул потоков занят),
+    IO_REFRESH отпускает место сам и возвращает None - ответим протухшими, в следующий раз повезет"""
+    if not server.forwarder_on or server.recently_failed(question) or not server.start_refresh(question):
+        server.admission.leave()
+        return server.answer_stale(question, stale)
+    resources = yield IO_REFRESH, question
+    if resources is not None and (resources or server.get_negative(question)):
+        return resources  # Успел (пустой ответ - значит, пришел NXDOMAIN или NODATA, его отдаст вызывающий)
+    return server.answer_stale(question, stale)
+
+
+def refresh_stale(server, question):
+    """Обновление протухших записей вопроса (см. get_stale_or_forwarder). Что бы ни случилось,
+    возвращает полученные записи (или пустой список) и отпускает место в admission"""
+    resources = []
+    try:
+        resources = yield IO_FORWARDER, question
+        server.note_refresh(question, resources)
+    except CnameLoop:
+        pass  # Ответит вызывающий: get_negative выкинет ту же CnameLoop
+    except Exception as ex:
+        server.metrics.inc('errors')
+        server.log.debug('Stale refresh failed: {!r}', ex)
+    finally:
+        server.finish_refresh(question)
+    return resources
+
+
+def ask_forwarder(server, question):
+    """Собственно задает вопрос форвардеру (через пул сокетов движка) и кладет ответ в кэш"""
+    data = yield IO_UPSTREAM, question
+    if not data:
+        server.metrics.inc('upstream_failures')
+        return []  # если ничего не получили, то возвращаем шиш
+    response = DNSPacket.from_bytes(data)  # распаковываем полученные данные
+    server.cache_response(response)
+    return server.get_from_cache(question)  # А ПОТОМ ТАКИЕ БЕРЕМ И ИЗ КЭША ВОЗВРАЩАЕМ!
@@ -1,96 +1,143 @@
 import socket
-import random
 import threading
-import sys
-import pickle  # Сериализация для файла кэша
+import argparse
 import time
-from DNSPacketParser import DNSPacket, DnsQuestion, parse_address
+from DnsSharedCache import DEFAULT_SLOTS
+from DnsWorkers import WorkerPool
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, parse_address, append_opt, \
+    OPT_TYPE, DEFAULT_UDP_PAYLOAD, MAX_TCP_MESSAGE
+from DnsCache import DnsCache, ResponseCache, ChainCache, CnameLoop, DEFAULT_CACHE_MEMORY, DEFAULT_STALE_WINDOW, \
+    MAX_CNAME_CHAIN, NXDOMAIN, SERVFAIL, FORMERR, make_key, find_negative, set_rcode
+from DnsAsyncEngine import AsyncEngine
+from DnsResolve import resolve_query, fetch_miss, refresh_stale, ask_forwarder, IO_UPSTREAM, IO_FORWARDER, IO_MISSES
+from DnsUpstream import UpstreamPool, UpstreamSelector, SingleFlight, question_key, parse_forwarder
+from DnsTcp import TcpListener, make_tcp_socket, DNS_PORT
+from DnsCacheFile import CacheSnapshotter, DEFAULT_CACHE_FILE, DEFAULT_SNAPSHOT_INTERVAL
+from DnsPrefetch import Prefetcher, PREFETCH_FRACTION, PREFETCH_CONCURRENCY, PREFETCH_RATE
+from DnsMetrics import Metrics, MetricsServer, DebugLog
+from DnsLocalZones import LocalZones, ZoneError, FLAG_AA
+from DnsBlocklist import Blocklist, sinkhole_records, SINKHOLE_ADDRESSES
+from DnsQueryLog import QueryLog, FLAG_CACHED, FLAG_TCP, FLAG_DROPPED
+from DnsOverload import WorkQueue, Admission, RateLimiter, slip_response, WORKER_THREADS, QUEUE_SIZE, \
+    QUEUE_MAX_WAIT, MISS_SHARE, MISS_THREADS, MISS_QUEUE_SIZE, MAX_QUESTIONS, RATE_SLIP, ALLOW, SLIP
 
 
 TIMEOUT = 2  # Устанавливаем постоянный таймаут в 2 секунды (просто потому что мы можем!)
+STALE_DEADLINE = 0.5  # Сколько секунд ждем форвардера, прежде чем ответить протухшими записями
+STALE_RECHECK = 30  # Сколько секунд после неудачи отвечаем протухшими записями сразу, не дергая форвардера
+STALE_FAILURES_MAX = 10000  # Сколько неудачных вопросов помним (больше - забываем все разом)
 
 
-class DnsCache:
-    """Класс, в котором будет храниться кэш нашего сервака. Весь кэш, по сути, просто лист записей"""
-    def __init__(self):
-        self.cache = []
-
-    def clear_cache(self):
-        """Метод, очищающий кэш от устаревших записей"""
-        to_remove = []
-        """Проходим по кэшу, смотрим, если запись устарела, заносим ее в список на удаление"""
-        for cache_item in self.cache:
-            add_time, resource = cache_item
-            if resource.r_ttl - (time.time() - add_time) < 0:
-                to_remove.append(cache_item)
-        """А потом удаляем нафиг"""
-        for cache_item in to_remove:
-            self.cache.remove(cache_item)
-
-    def get_resources(self, question):
-        """Метод, возвращающий данные из кэша
-        (если они у нас, конечно, имеются)"""
-        self.clear_cache()
-        result = []
-        for _, resource in self.cache:
-            """question является объектом DnsQuestion"""
-            if question.is_true_resource(resource):
-                result.append(resource)
-        return result
+def make_serve_socket(reuse_port=False, port=DNS_PORT):
+    """Создает сокет, на который клиенты шлют запросы (порт другой, чем 53, нужен разве что для бенчмарков).
+    reuse_port - разрешить нескольким процессам слушать 53 порт одновременно (SO_REUSEPORT),
+    тогда ядро само раскидывает запросы между ними"""
+    serve_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Фигачим сокет по IPv4 и UDP
+    if reuse_port:
+        serve_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    serve_socket.settimeout(TIMEOUT)  # Задаем сокету наш таймаут
+    serve_socket.bind(('', port))  # Привязываем его к 53 порту
+    return serve_socket
 
-    def put_resource(self, resource):
-        """Метод, добавляющий данные в кэш"""
-        self.clear_cache()
-        if resource not in map(lambda c: c[1], self.cache):
-            self.cache.append((time.time(), resource))
 
-    def get_status(self):
-        """Метод, выводящий на экран данные обо всех имеющихся записях в кэше нашего сервака"""
-        self.clear_cache()
-        return '\n'.join(['Time: {:5d}s Resource: {:80}'.format(
-            int(resource.r_ttl - (time.time() - add_time)),
-            resource.to_string()
-        ) for add_time, resource in self.cache])
+def check_recursion(forwarders, serve_socket):
+    """Проверка хитрожопости или криворукости пользователя.
+    Видите ли, пользователь может указать в качестве сервера наш сервер.
+    А как мы спросим у себя, если мы не знаем?
+    forwarders - список (ip, порт): проверочный пакет шлем всем сразу, а потом ждем, не придет ли он к нам"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Создаем udp сокет (он только отправляет)
+    check_quest = DnsQuestion('recursion.check.packet.', 1, 1)  # создаем запрос dns
+    check_pack = DNSPacket(
+        0x6969, 0x0000, [check_quest],
+        [], [], []).to_bytes()  # ну и создаем dns пакет, закладывая в него наш запрос
+    deadline = time.monotonic() + TIMEOUT
+    try:
+        for forwarder in forwarders:
+            sock.sendto(check_pack, forwarder)  # Отправляем наш пакет серверу, у которого спрашиваем инфу
+        while time.monotonic() < deadline:
+            response = serve_socket.recv(1024)  # получаем какой-то ответ
+            try:
+                packet = DNSPacket.from_bytes(response)  # распаковываем его в читабельный вид
+            except Exception:
+                continue  # Кто-то прислал мусор - это точно не наш пакет, ждем дальше
+            """Если нам вернулся тот же самый QUESTION, что мы отправили, значит, 
+            пользователь указал сам себя в качестве сервера для запросов
+            Тогда мы выкидываем ошибку"""
+            if packet.question == [check_quest]:
+                raise Exception('В качестве форвардера указан сам сервер')
+    except socket.error:
+        pass
+    finally:
+        sock.close()
 
 
 class DnsServer(threading.Thread):
     """Собственно, наш сервак"""
 
-    def __init__(self, forwarder):
+    def __init__(self, forwarders, engine='threads', cache=None, reuse_port=False, check=True,
+                 prefetch_fraction=PREFETCH_FRACTION, prefetch_concurrency=PREFETCH_CONCURRENCY,
+                 prefetch_rate=PREFETCH_RATE, udp_payload=DEFAULT_UDP_PAYLOAD, hedge=False, port=DNS_PORT,
+                 metrics_port=0, debug_log=0, stale_deadline=STALE_DEADLINE, threads=WORKER_THREADS,
+                 queue_size=QUEUE_SIZE, rate_limit=0, rate_slip=RATE_SLIP, zone_files=(), hosts_files=(),
+                 blocklist=None, block_answer='nxdomain', sinkhole_addresses=SINKHOLE_ADDRESSES, query_log=None):
         super().__init__(name='Server')  # Создаем поток нашего сервака
-        self.forwarder = socket.gethostbyname(forwarder)  # Получаем адрес сервака по имени
-        # (если дали на вход ip, то так и останется ip
-        self.cache = DnsCache()  # Создаем серваку кэш
+        if isinstance(forwarders, str):
+            forwarders = [forwarders]
+        self.forwarders = [parse_forwarder(forwarder) for forwarder in forwarders]  # Получаем адреса
+        # серваков по именам ('хост' или 'хост:порт')
+        self.cache = cache if cache is not None else DnsCache()  # Создаем серваку кэш
+        # (воркеры передают сюда общий кэш, см. DnsWorkers)
+        self.response_cache = ResponseCache(self.cache)  # И кэш готовых ответов поверх него
+        self.chain_cache = ChainCache(self.cache)  # И кэш пройденных цепочек CNAME
+        self.zone_files = list(zone_files)  # Файлы локальных зон и hosts-файлы (см. DnsLocalZones)
+        self.hosts_files = list(hosts_files)
+        self.local_zones = LocalZones.load(self.zone_files, self.hosts_files) \
+            if self.zone_files or self.hosts_files else None  # На эти имена отвечаем сами
+        self.blocklist_path = blocklist  # Скомпилированный блоклист (см. DnsBlocklist)
+        self.blocklist = Blocklist(blocklist) if blocklist else None  # А эти имена блокируем
+        self.block_answer = block_answer  # nxdomain - "такого имени нет", sinkhole - адрес-заглушка
+        self.sinkhole_addresses = list(sinkhole_addresses)
         self.server_runnable = False  # Флаг запуска
-        self.serve_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Фигачим сокет по IPv4 и UDP
-        self.serve_socket.settimeout(TIMEOUT)  # Задаем сокету наш таймаут
-        self.serve_socket.bind(('', 53))  # Привязываем его к 53 порту
+        self.serve_socket = make_serve_socket(reuse_port, port)
+        self.tcp_socket = make_tcp_socket(reuse_port, port)  # Для ответов, которые не влезают в UDP
+        self.udp_payload = udp_payload  # Сколько байт по UDP принимаем и отдаем (EDNS0)
         self.forwarder_on = True  # По умолчанию включаем возможность получения инфы от сервака
-        self.check_recursion()  # Проверяем хитрожопость/криворукость (нужное подчеркнуть) пользователя
-
-    def check_recursion(self):
-        """Проверка хитрожопости или криворукости пользователя.
-        Видите ли, пользователь может указать в качестве сервера наш сервер.
-        А как мы спросим у себя, если мы не знаем?"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Создаем udp сокет
-        sock.settimeout(4)  # устанавливаем ему таймаут
-        check_quest = DnsQuestion('recursion.check.packet.', 1, 1)  # создаем запрос dns
-        check_pack = DNSPacket(
-            0x6969, 0x0000, [check_quest],
-            [], [], []).to_bytes()  # ну и создаем dns пакет, закладывая в него наш запрос
-        sock.sendto(check_pack, (self.forwarder, 53))  # Отправляем наш пакет серверу, у которого спрашиваем инфу
-        try:
-            response = self.serve_socket.recv(1024)  # получаем какой-то ответ
-            packet = DNSPacket.from_bytes(response)  # распаковываем его в читабельный вид
-            """Если нам вернулся тот же самый QUESTION, что мы отправили, значит, 
-            пользователь указал сам себя в качестве сервера для запросов
-            Тогда мы выкидываем ошибку"""
-            if packet.question == [check_quest]:
-                raise Exception('В качестве форвардера указан сам сервер')
-        except socket.error:
-            pass
-        finally:
-            sock.close()
+        self.engine = engine  # Чем обслуживаем клиентов: потоками (threads) или event loop-ом (asyncio)
+        self.hedge = hedge  # Спрашивать ли второго форвардера, если первый задумался
+        self.upstreams = UpstreamSelector(self.forwarders)  # Время ответа и живость форвардеров
+        self.upstream = UpstreamPool(self.upstreams, payload=udp_payload,
+                                     hedge=hedge)  # Пул сокетов для запросов к форвардерам
+        self.flights = SingleFlight()  # Склейка одинаковых запросов к форвардеру
+        self.async_engine = None  # Движок asyncio (если сервак запущен в этом режиме)
+        self.prefetcher = Prefetcher(self, prefetch_fraction, prefetch_concurrency,
+                                     prefetch_rate)  # Заранее обновляет популярные записи
+        self.responses_lock = threading.Lock()
+        self.responses_sent = 0  # Сколько ответов отправили клиентам
+        self.response_bytes = 0  # Сколько байт в них было
+        self.compression_saved = 0  # И сколько байт сэкономило сжатие имен
+        self.metrics = Metrics()  # Счетчики и времена этапов (команда stats)
+        self.metrics.add_source(self.get_metrics)
+        self.metrics_server = MetricsServer(self.metrics, metrics_port) if metrics_port else None  # Они же
+        # по HTTP для Prometheus
+        self.log = DebugLog(debug_log)  # Что происходит с каждым запросом (по умолчанию молчит)
+        self.query_log = QueryLog(query_log, log=self.log) if query_log else None  # Бинарный лог всех
+        # запросов и ответов
+        self.stale_deadline = stale_deadline  # Сколько ждем форвардера, если в кэше есть протухший ответ
+        self.stale_failures = {}  # Вопрос -> когда форвардер последний раз не смог на него ответить
+        self.refreshing = set()  # Вопросы, протухшие записи которых сейчас обновляются
+        self.refreshing_lock = threading.Lock()
+        self.work_queue = WorkQueue(self.serve_queued, threads, queue_size,
+                                    self.worker_failed)  # Очередь и пул потоков (см. DnsOverload)
+        self.miss_queue = WorkQueue(self.serve_miss, MISS_THREADS, MISS_QUEUE_SIZE,
+                                    self.worker_failed)  # Доп. промахи пакета
+        self.queue_size = queue_size  # В режиме asyncio - сколько запросов может обрабатываться одновременно
+        self.admission = Admission(int((threads if engine == 'threads' else queue_size) * MISS_SHARE))  # Сколько
+        # из них могут одновременно ждать форвардера
+        self.rate_limiter = RateLimiter(rate_limit, slip=rate_slip) if rate_limit else None  # Сколько ответов
+        # в секунду получает один клиент
+        if check:
+            check_recursion(self.forwarders, self.serve_socket)  # Проверяем хитрожопость/криворукость
+            # (нужное подчеркнуть) пользователя
 
     def run(self):
         """run является методом класса threading.Trhread. Этот метод, по сути,
@@ -99,157 +146,773 @@ class DnsServer(threading.Thread):
         Работа метода составляет активность потока.
         И мы можем переопределять в своих классах (что здесь, собственно, и сделано)"""
         self.server_runnable = True  # Устанавливаем флаг, что мы таки работаем
+        self.prefetcher.start()
+        if self.query_log is not None:
+            self.query_log.start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.engine == 'asyncio':
+            """В режиме asyncio все клиенты обслуживаются в одном event loop-е прямо в этом потоке"""
+            self.async_engine = AsyncEngine(self)
+            self.async_engine.run()
+            return
+        self.work_queue.start()
+        self.miss_queue.start()
+        TcpListener(self, self.tcp_socket, TIMEOUT).start()  # TCP-клиентов обслуживает отдельный поток
         """А пока работаем, пробуем получать данные"""
         while self.server_runnable:
             try:
-                data, addr = self.serve_socket.recvfrom(1024)
+                data, addr = self.serve_socket.recvfrom(65535)
             except socket.error:
                 continue
-            print('Connection from {}'.format(addr))  # Если с кем-то законнектились, то пишем, с кем
-            threading.Thread(
-                target=self.serve_client, args=(addr, data)).start()  # После чего выделяем работу с ним
-            # в отдельный поток и дальше клиент работает уже с serve_client
+            received = time.perf_counter()  # Для лога запросов
+            self.log.debug('Connection from {}', addr)  # Если с кем-то законнектились, то пишем, с кем
+            if self.rate_limiter is not None and not self.check_rate(data, addr, self.serve_socket.sendto):
+                continue
+            raw_response = self.handle_cached(data, client=(addr, received))  # Готовый ответ отдаем сразу,
+            # без очереди
+            if raw_response is not None:
+                self.send_response(raw_response, addr)
+            elif not self.work_queue.put((addr, data, received)):  # Остальное - в очередь, ее разбирает
+                # пул потоков
+                self.metrics.inc('shed_queries')  # А если очередь полна, запрос выкидываем
+                self.log.debug('Queue is full, dropped query from {}', addr)
+                self.log_query((addr, received), data, None)
+        self.work_queue.stop()  # Доделываем то, что уже в очереди
+        self.miss_queue.stop()
 
     def stop_server(self):
         """Ну, тут все просто, тормозим сервак"""
+        self.prefetcher.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.query_log is not None:
+            self.query_log.stop()  # Дописываем то, что накопилось
         self.serve_socket.close()
+        self.tcp_socket.close()
+        self.upstream.close()
+
+    def shutdown(self):
+        """Сервак закрываем грамотно!"""
+        self.server_runnable = False  # отрубаем сервак от работы с пользователем
+        self.join()  # ждем завершения сервака (сервер наследуется от threading.Thread)
+        """Затем ждем завершения всех второстепеннных потоков"""
+        for thread in threading.enumerate():
+            if thread == threading.main_thread() or thread.daemon:
+                continue  # Служебные фоновые потоки сами остановятся вместе с серваком
+            thread.join()
+        self.stop_server()  # теперь останавливаем сервак
+
+    def run_command(self, cmd):
+        """Метод, выполняющий консольную команду (кроме exit).
+        Возвращает текст, который надо вывести, или None, если команда неизвестная"""
+        if cmd == 'cache':
+            return 'Cache status:\n' + self.cache.get_status()  # кэш в проге является отдельной сущностью
+        if cmd == 'upstream':
+            return 'Upstream status:\n' + self.get_upstream_status()
+        if cmd == 'responses':
+            return 'Responses status:\n' + self.get_responses_status()
+        if cmd == 'stats':
+            return 'Stats:\n' + self.metrics.get_status()
+        if cmd == 'debug_on':
+            self.log.enabled = True
+            return 'Debug log enabled ({:g} lines per second)'.format(self.log.rate)
+        if cmd == 'debug_off':
+            self.log.enabled = False
+            return 'Debug log disabled'
+        if cmd == 'zones':
+            return 'Local zones:\n' + (self.local_zones.get_status() if self.local_zones is not None else 'none')
+        if cmd == 'querylog':
+            return self.query_log.get_status() if self.query_log is not None else 'Query log: off'
+        if cmd == 'blocklist':
+            return self.blocklist.get_status() if self.blocklist is not None else 'Blocklist: none'
+        if cmd == 'reload':
+            results = [result for result in (self.reload_zones(), self.reload_blocklist()) if result is not None]
+            return '\n'.join(results) or 'Nothing to reload: no zone, hosts or blocklist files given'
+        if cmd == 'forwarder_on':
+            self.forwarder_on = True
+            return 'Forwarder enabled'
+        if cmd == 'forwarder_off':
+            self.forwarder_on = False
+            return 'Forwarder disabled'
+        return None
+
+    def reload_zones(self):
+        """Метод, перечитывающий локальные зоны и hosts-файлы. Новое дерево строится сбоку и подменяет
+        старое одним присваиванием, так что запросы не останавливаются. Если в файлах ошибка, остаются старые зоны"""
+        if not self.zone_files and not self.hosts_files:
+            return None
+        try:
+            zones = LocalZones.load(self.zone_files, self.hosts_files)
+        except ZoneError as ex:
+            return 'Reload failed, old zones kept: {}'.format(ex)
+        self.local_zones = zones
+        self.response_cache.clear()  # Готовые ответы могли быть на имена, которые теперь наши
+        return 'Zones reloaded:\n' + zones.get_status()
+
+    def reload_blocklist(self):
+        """Метод, заново открывающий файл блоклиста (DnsBlocklist.py compile подменяет его целиком).
+        Открыть mmap - дело мгновенное, а старый блоклист закроется сам, когда его досмотрят идущие запросы"""
+        if not self.blocklist_path:
+            return None
+        try:
+            blocklist = Blocklist(self.blocklist_path)
+        except (OSError, ValueError) as ex:
+            return 'Blocklist reload failed, old list kept: {}'.format(ex)
+        self.blocklist = blocklist
+        self.response_cache.clear()  # Готовые ответы могли быть на имена, которые теперь заблокированы
+        return 'Blocklist reloaded:\n' + blocklist.get_status()
+
+    def answer_blocked(self, response, question):
+        """Метод, проверяющий имя вопроса по блоклисту. Заблокированное получает NXDOMAIN
+        или адрес-заглушку (смотря по block_answer) - тогда возвращаем True"""
+        blocklist = self.blocklist
+        if blocklist is None or not blocklist.blocked(question.q_name):
+            return False
+        self.metrics.inc('blocked')
+        self.log.debug('Blocked: {}', question.to_string())
+        if self.block_answer == 'sinkhole':
+            response.answer.extend(sinkhole_records(question, self.sinkhole_addresses))
+        else:
+            set_rcode(response, NXDOMAIN)
+        return True
+
+    def answer_local(self, response, question):
+        """Метод, отвечающий на вопрос из локальных зон (авторитетно: с флагом AA, а если имени в нашей зоне нет -
+        NXDOMAIN). Возвращает вопрос, на который еще надо ответить обычным путем: тот же, если имя не наше,
+        или имя, куда ведет CNAME из наших зон в чужие. None - ответили полностью"""
+        zones = self.local_zones
+        if zones is None:
+            return question
+        local = zones.lookup(question)
+        if local is None:
+            return question
+        self.metrics.inc('local_answers')
+        self.log.debug('Local answer: {}', question.to_string())
+        response.answer.extend(local.answer)
+        response.authority.extend(local.authority)
+        if local.target is not None:
+            return DnsQuestion(local.target, question.q_type, question.q_class)
+        response.flags |= FLAG_AA
+        set_rcode(response, local.rcode)
+        return None
+
+    def answer_cached(self, response, question):
+        """Метод, отвечающий на вопрос всем, что есть без форвардера: локальные зоны, блоклист,
+        кэш записей и отрицательных ответов. Возвращает вопрос, который придется задать форвардеру
+        (промах), или None, если ответили"""
+        question = self.answer_local(response, question)  # Сначала смотрим, не наше ли это имя
+        if question is None or self.answer_blocked(response, question):  # И не заблокировано ли оно
+            return None
+        metrics = self.metrics
+        self.prefetcher.hit(question_key(question))  # Считаем популярность вопроса
+        started = time.perf_counter()
+        try:
+            resources = self.get_from_cache(question)  # Сначала пробуем получить ответ из кэша
+            """Если получили ответ из кэша"""
+            if resources:
+                metrics.observe('cache', time.perf_counter() - started)
+                metrics.inc('cache_hits')
+                self.log.debug('In cache: {}', question.to_string())  # Пишем, что у нас есть инфа в кэше
+                response.answer.extend(resources)  # Пакуем в наш ответ информацию из кэша
+                return None
+            negative = self.get_negative(question)  # Может, мы уже знаем, что ответа нет
+        except CnameLoop:
+            self.answer_cname_loop(response, question)
+            return None
+        metrics.observe('cache', time.perf_counter() - started)
+        if negative:
+            metrics.inc('negative_hits')
+            self.log.debug('Negative in cache: {}', question.to_string())
+            response.answer.extend(negative[0])  # Цепочка CNAME до имени, которого нет
+            self.add_negative(response, negative[1])
+            return None
+        """Если таки нет в кэше, придется спрашивать"""
+        metrics.inc('misses')
+        self.log.debug('Ask to forwarder: {}', question.to_string())  # Пишем, что отправляем запрос
+        return question
+
+    def answer_miss(self, response, question, resources):
+        """Метод, вписывающий в ответ то, что по промаху дал resolve_misses. Пусто - значит, форвардер
+        мог ответить NXDOMAIN или NODATA (или промолчал)"""
+        if isinstance(resources, CnameLoop):
+            self.answer_cname_loop(response, question)
+            return
+        if resources:
+            response.answer.extend(resources)
+            return
+        try:
+            negative = self.get_negative(question)
+        except CnameLoop:
+            self.answer_cname_loop(response, question)
+            return
+        if negative:
+            response.answer.extend(negative[0])
+            self.add_negative(response, negative[1])
+
+    def answer_cname_loop(self, response, question):
+        self.metrics.inc('cname_loops')
+        self.log.debug('CNAME loop: {}', question.to_string())
+        set_rcode(response, SERVFAIL)
 
     def get_from_forwarder(self, question):
         """Метод получения данных от сервера"""
         """Если нам запрещено получать инфу от сервера, то возвращаем шиш"""
         if not self.forwarder_on:
             return []
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # создаем udp сокет
-        sock.settimeout(TIMEOUT)  # устанавливаем наш таймаут
-        request = DNSPacket(
-            random.randint(0, 0xffff), 0x0100, [question], [], [], []
-        )  # создаем запрос, запихивая в него запрос пользователя
-        sock.sendto(request.to_bytes(), (self.forwarder, 53))  # отправляем запрос на 53 порт сервака
-        data = None
+        """Если тот же вопрос уже задан форвардеру другим потоком, просто ждем его ответ"""
+        return self.flights.do(question_key(question),
+                               lambda: self.drive(ask_forwarder(self, question))) or []
+
+    def drive(self, steps):
+        """Выполняет генератор из DnsResolve: на каждый его запрос ввода-вывода делаем блокирующий вызов
+        (см. do_io), а ошибку вызова выкидываем обратно в генератор. Возвращает то, что вернул генератор"""
+        send, value = steps.send, None
         try:
-            data, _ = sock.recvfrom(1024)  # пробуем получить какую-нибудь инфу
-        except socket.error:
-            pass
-        if not data:
-            return []  # если ничего не получили, то возвращаем шиш
-        response = DNSPacket.from_bytes(data)  # распаковываем полученные данные
+            while True:
+                try:
+                    kind, argument = send(value)
+                except StopIteration as stop:
+                    return stop.value
+                try:
+                    send, value = steps.send, self.do_io(kind, argument)
+                except Exception as ex:
+                    send, value = steps.throw, ex
+        finally:
+            steps.close()  # Если вылетели посередине, пусть отработают его finally (admission и т.п.)
+
+    def do_io(self, kind, argument):
+        if kind == IO_UPSTREAM:
+            return self.upstream.query(argument)  # спрашиваем через пул сокетов (с таймаутами и перезапросами)
+        if kind == IO_FORWARDER:
+            return self.get_from_forwarder(argument)
+        if kind == IO_MISSES:
+            return self.resolve_misses(argument)
+        return self.wait_refresh(argument)
+
+    def check_rate(self, raw_packet, addr, send):
+        """Метод, проверяющий, не превысил ли клиент свой лимит ответов в секунду (RRL).
+        Сверх лимита каждый rate_slip-й ответ уходит пустым с флагом TC (через send), остальные выкидываются:
+        настоящий клиент переспросит по TCP, а жертва подделанных адресов почти ничего не получит.
+        Для запросов по TCP send - None: переспрашивать там уже негде, так что сверх лимита просто молчим.
+        Возвращает True, если запрос можно обрабатывать"""
+        verdict = self.rate_limiter.check(addr[0])
+        if verdict == ALLOW:
+            return True
+        if verdict == SLIP and send is not None:
+            response = slip_response(raw_packet)
+            if response is not None:
+                send(response, addr)
+                self.metrics.inc('rate_slipped')
+                return False
+        self.metrics.inc('rate_limited')
+        self.log.debug('Rate limited: {}', addr)
+        return False
+
+    def resolve_misses(self, misses):
+        """Метод, спрашивающий у форвардера все промахи одного пакета одновременно: первый - в своем потоке,
+        остальные - в пуле miss_queue. Раньше промахи шли по очереди, и пакет с несколькими вопросами
+        ждал форвардера несколько раз подряд. Если пул занят, оставшиеся промахи спрашиваем сами, по очереди.
+        Возвращает итог fetch_miss по каждому промаху (записи или исключение) в том же порядке"""
+        results = [None] * len(misses)
+
+        def resolve(index):
+            try:
+                results[index] = self.drive(fetch_miss(self, misses[index]))
+            except Exception as ex:
+                results[index] = ex  # Выкинет DnsResolve.resolve_query
+
+        queued = []
+        for index in range(1, len(misses)):
+            done = threading.Event()
+            if self.miss_queue.put((resolve, (index,), done)):
+                queued.append(done)
+            else:
+                resolve(index)
+        if misses:
+            resolve(0)
+        for done in queued:
+            done.wait()
+        return results
+
+    def serve_miss(self, waited, function, args, done):
+        """Обработчик miss_queue: спрашивает один промах для resolve_misses (или обновляет протухшие
+        записи для wait_refresh) и, как бы это ни кончилось, будит ждущего"""
+        try:
+            function(*args)
+        finally:
+            done.set()
+
+    def wait_refresh(self, question):
+        """Запускает обновление протухших записей в пуле miss_queue и ждет его не дольше stale_deadline
+        (см. DnsResolve.get_stale_or_forwarder). Не успело или пул занят - None"""
+        outcome = []
+        done = threading.Event()
+        if not self.miss_queue.put((self.run_refresh, (question, outcome), done)):
+            self.finish_refresh(question)
+            return None
+        return outcome[0] if done.wait(self.stale_deadline) else None
+
+    def run_refresh(self, question, outcome):
+        """Обновление в потоке пула: кладет в outcome то, что вернул refresh_stale"""
+        resources = []
+        try:
+            resources = self.drive(refresh_stale(self, question))
+        finally:
+            outcome.append(resources)
+
+    def start_refresh(self, question):
+        """Отмечает, что протухшие записи вопроса обновляются. False - их уже обновляет кто-то другой"""
+        key = question_key(question)
+        with self.refreshing_lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def finish_refresh(self, question):
+        """Обновление закончено (как угодно): снимаем отметку и отпускаем место в admission"""
+        with self.refreshing_lock:
+            self.refreshing.discard(question_key(question))
+        self.admission.leave()
+
+    def answer_stale(self, question, stale):
+        self.metrics.inc('stale_answers')
+        self.log.debug('Stale answer: {}', question.to_string())
+        return stale
+
+    def recently_failed(self, question):
+        """Не отвечал ли форвардер на этот вопрос в последние STALE_RECHECK секунд"""
+        failed_at = self.stale_failures.get(question_key(question))
+        return failed_at is not None and time.monotonic() - failed_at < STALE_RECHECK
+
+    def note_refresh(self, question, resources):
+        """Запоминает, смог ли форвардер ответить на вопрос (ответ "такого нет" - тоже ответ)"""
+        key = question_key(question)
+        if resources or self.get_negative(question):
+            self.stale_failures.pop(key, None)
+            return
+        if len(self.stale_failures) >= STALE_FAILURES_MAX:
+            self.stale_failures.clear()
+        self.stale_failures[key] = time.monotonic()
+
+    def cache_response(self, response):
+        """Метод, заносящий в кэш все записи из ответа форвардера"""
         for answer in response.answer:
             self.cache.put_resource(answer)  # заносим новые данные в кэш
         for authority in response.authority:
             self.cache.put_resource(authority)  # заносим новые данные в кэш
         for additional in response.additional:
-            self.cache.put_resource(additional)  # заносим новые данные в кэш
-        return self.get_from_cache(question)  # А ПОТОМ ТАКИЕ БЕРЕМ И ИЗ КЭША ВОЗВРАЩАЕМ!
+            if additional.r_type != OPT_TYPE:  # OPT - это не запись, а настройки соединения с форвардером
+                self.cache.put_resource(additional)  # заносим новые данные в кэш
+        negative = find_negative(response)  # Если имени или записей такого типа нет, запоминаем и это
+        if negative is not None:
+            self.cache.put_negative(*negative)
+
+    def get_upstream_status(self):
+        """Метод, выводящий статистику запросов к форвардеру"""
+        sent, saved = self.flights.sent, self.flights.saved
+        if self.async_engine is not None:
+            sent += self.async_engine.flights.sent
+            saved += self.async_engine.flights.saved
+        return 'Sent to forwarder: {}\nSaved by coalescing: {}\n{}\n{}'.format(
+            sent, saved, self.prefetcher.get_status(), self.upstreams.get_status())
+
+    def get_metrics(self):
+        """Числа для метрик, которые считают другие части сервака"""
+        sent, saved = self.flights.sent, self.flights.saved
+        if self.async_engine is not None:
+            sent += self.async_engine.flights.sent
+            saved += self.async_engine.flights.saved
+        result = {
+            'upstream_queries': sent,
+            'upstream_coalesced': saved,
+            'upstream_timeouts': sum(stats.timeouts for stats in self.upstreams.upstreams),
+            'upstream_hedged': self.upstreams.hedged,
+            'prefetched': self.prefetcher.prefetched,
+            'stale_failures': len(self.stale_failures),
+            'queue_depth': self.work_queue.depth() if self.async_engine is None else len(self.async_engine.tasks),
+            'queue_max_depth': self.work_queue.max_depth,
+            'upstream_waiting': self.admission.active,
+            'rate_limited_clients': len(self.rate_limiter.clients) if self.rate_limiter is not None else 0,
+            'response_bytes': self.response_bytes,
+        }
+        result.update(self.cache.get_counters())
+        return result
+
+    def count_response(self, raw_response, compression_saved):
+        """Метод, учитывающий отправленный клиенту ответ в статистике"""
+        with self.responses_lock:
+            self.responses_sent += 1
+            self.response_bytes += len(raw_response)
+            self.compression_saved += compression_saved
+
+    def get_responses_status(self):
+        """Метод, выводящий статистику отправленных ответов"""
+        with self.responses_lock:
+            sent, size, saved = self.responses_sent, self.response_bytes, self.compression_saved
+        return 'Responses sent: {}\nBytes sent: {}\nBytes saved by name compression: {} ({:.1f} per response)'.format(
+            sent, size, saved, saved / sent if sent else 0)
 
-    def get_from_cache(self, question):
-        """Метод получения данных из кэша.
+    def remember_response(self, packet, response, raw_response, generation):
+        """Метод, кладущий собранный ответ в кэш готовых ответов.
+        Запоминаем только ответы на один вопрос, целиком собранные из записей кэша"""
+        if len(packet.question) != 1 or not response.answer or response.authority or response.flags & FLAG_AA:
+            return  # Отрицательные ответы (с SOA в authority) тоже не запоминаем, их время жизни считается иначе,
+            # а ответы из локальных зон и так собираются быстро
+        question = packet.question[0]
+        depends = {question_key(question),
+                   make_key(question.q_name, 5, question.q_class)}  # Вдруг у имени появится CNAME
+        ttl_fields = []
+        resources = response.answer + response.authority + response.additional
+        now = time.time()
+        for offset, resource in zip(response.ttl_offsets, resources):
+            expire_time = self.cache.get_expire_time(resource)
+            if expire_time is None or expire_time <= now:
+                return  # Запись уже успела протухнуть (или это протухшая запись, отданная по serve-stale)
+            ttl_fields.append((offset, expire_time))
+            depends.add(make_key(resource.r_name, resource.r_type, resource.r_class))
+        self.response_cache.put(question_key(question), raw_response, response.compression_saved,
+                                ttl_fields, depends, generation)
+
+    def get_from_cache(self, question, stale=False):
+        """Метод получения данных из кэша (stale - брать и протухшие записи, см. get_stale_or_forwarder).
         На заметочку: здесь метод всегда вроде как возвращает инфу,
         но на самом деле метод get_resources может вернуть нам пустой list.
-        Тогда в методе serve_client if отработает верно и
+        Тогда в методе answer_cached if отработает верно и
         перескочит на получение данных от сервера."""
-        """5 - type of CNAME (каноническое имя)
-        Сначала мы пробуем достать из кэша какие-нибудь записи типа CNAME, 
-        из них вычленить каноническое имя, а уже по нему получить интересующие нас данные"""
-        c_name_question = DnsQuestion(
-            question.q_name, 5, question.q_class)  # Создаем CNAME QUESTION
-        c_name_resources = self.cache.get_resources(c_name_question)  # получаем данные из кэша по этому вопросу
-        for c_name_resource in c_name_resources:
-            canonical_name = \
-                parse_address(c_name_resource.r_data).decode()  # Тут мы парсим каноническое имя из записи типа CNAME
-            result = self.get_from_cache(DnsQuestion(
-                canonical_name, question.q_type, question.q_class))  # По этому имени получаем нормальные данные
-            if result:
-                result.append(c_name_resource)
-                return result  # Ну и возвращаем
-        return self.cache.get_resources(question)  # обычно же мы просто возвращаем что-то из кэша
-
-    def serve_client(self, addr, raw_packet):
-        """Метод работы с клиентами. Каждого клиента метод run
-        выделяет в отдельный поток и перенаправляет этому методу"""
+        """Сначала проходим цепочку CNAME (если она есть) до канонического имени,
+        а уже по нему получаем интересующие нас данные"""
+        target, chain = self.follow_chain(question, stale)
+        resources = self.cache.get_resources(target, stale)
+        if resources and chain:
+            return chain + resources  # Записи CNAME по порядку, потом сами данные
+        return resources  # обычно же мы просто возвращаем что-то из кэша
+
+    def follow_chain(self, question, stale=False):
+        """Метод, проходящий по кэшу цепочку CNAME от имени вопроса.
+        Возвращает (вопрос про каноническое имя, [записи CNAME по порядку]), а если у имени нет CNAME -
+        (тот же вопрос, []). Зацикленная или длиннее MAX_CNAME_CHAIN цепочка - CnameLoop"""
+        """ПОЯСНЕНИЕ! Раньше цепочка проходилась рекурсией заново на каждый вопрос, без всякого предела.
+        Теперь пройденная цепочка запоминается в ChainCache, и вопрос про имя с 3-4 CNAME
+        стоит одну проверку словаря (протухшие записи, понятное дело, не запоминаем)"""
+        if question.q_type == 5:
+            return question, []  # Спрашивают про сам CNAME - по цепочке не идем
+        key = make_key(question.q_name, 5, question.q_class)
+        if not stale:
+            found = self.chain_cache.get(key)
+            if found is not None:
+                return DnsQuestion(found[0], question.q_type, question.q_class), found[1]
+        generation = self.chain_cache.generation
+        name = question.q_name
+        seen = {key[0]}
+        chain = []
+        while True:
+            c_name_resources = self.cache.get_resources(
+                DnsQuestion(name, 5, question.q_class), stale)  # 5 - type of CNAME (каноническое имя)
+            if not c_name_resources:
+                break
+            c_name_resource = c_name_resources[0]  # Других записей (и других CNAME) у такого имени быть не может
+            chain.append(c_name_resource)
+            name = parse_address(c_name_resource.r_data).decode()  # Тут мы парсим каноническое имя из записи
+            if name.lower() in seen or len(chain) > MAX_CNAME_CHAIN:
+                raise CnameLoop(question.q_name)
+            seen.add(name.lower())
+        if chain and not stale:
+            expire_times = [self.cache.get_expire_time(resource) for resource in chain]
+            if None not in expire_times:  # Запись могли вытеснить, пока мы шли по цепочке
+                self.chain_cache.put(key, name, chain, min(expire_times), generation)
+        return DnsQuestion(name, question.q_type, question.q_class), chain
+
+    def get_negative(self, question):
+        """Метод получения отрицательного ответа из кэша (по цепочке CNAME, как в get_from_cache).
+        Возвращает (записи CNAME цепочки, (rcode, soa, время протухания)) или None"""
+        target, chain = self.follow_chain(question)
+        negative = self.cache.get_negative(target)
+        return (list(chain), negative) if negative else None
+
+    @staticmethod
+    def add_negative(response, negative):
+        """Метод, вписывающий в ответ отрицательный ответ из кэша: rcode и запись SOA
+        (с оставшимся временем жизни, как велит RFC 2308)"""
+        rcode, soa, expire_time = negative
+        set_rcode(response, rcode)
+        response.authority.append(DnsResource(
+            soa.r_name, soa.r_type, soa.r_class, max(0, int(expire_time - time.time())), soa.r_data))
+
+    def serve_queued(self, waited, addr, raw_packet, received, reply=None):
+        """Метод работы с клиентами. Запросы, на которые нет готового ответа, метод run
+        кладет в очередь, а потоки пула (см. DnsOverload.WorkQueue) передают их этому методу.
+        reply - куда отдать ответ на запрос, пришедший по TCP (см. DnsTcp.TcpListener): его зовем всегда,
+        с None, если ответа не будет. Для UDP reply нет, ответ уходит через serve_socket"""
+        tcp = reply is not None
+        raw_response = None
+        try:
+            self.metrics.observe('queue', waited)
+            if waited > QUEUE_MAX_WAIT:
+                self.metrics.inc('shed_queries')  # Клиент уже не ждет (или переспросил), не тратим на него время
+                self.log_query((addr, received), raw_packet, None, FLAG_TCP if tcp else 0)
+                return
+            raw_response = self.resolve_query(raw_packet, tcp, client=(addr, received))
+            if raw_response is not None and not tcp:
+                self.send_response(raw_response, addr)
+        finally:
+            if tcp:
+                reply(raw_response)
+
+    def worker_failed(self, ex):
+        """Метод, который зовет WorkQueue, если на запросе упал его обработчик"""
+        self.metrics.inc('errors')
+        self.log.debug('Worker failed: {!r}', ex)
+
+    def send_response(self, raw_response, addr):
+        started = time.perf_counter()
         try:
-            packet = DNSPacket.from_bytes(raw_packet)  # Распаковываем запрос
-            response = DNSPacket(
-                packet.packet_id, 0x8000,
-                packet.question, [], [], []
-            )  # Формируем ответ
-            """Обрабатываем каждый запрос клиента"""
-            for question in packet.question:
-                resources = self.get_from_cache(question)  # Сначала пробуем получить ответ из кэша
-                """Если получили ответ из кэша"""
-                if resources:
-                    print('In cahce: {}'.format(question.to_string()))  # Принтуем, что у нас есть инфа в кэше
-                    response.answer.extend(resources)  # Пакуем в наш ответ информацию из кэша
-                else:
-                    """Если таки нет в кэше, придется спрашивать"""
-                    print('Ask to forwarder: {}'
-                          .format(question.to_string()))  # Принтуем, что отправляем запрос
-                    resources = self.get_from_forwarder(question)  # Делаем запрос серваку, получаем данные
-                    response.answer.extend(resources)  # Пакуем эти данные в ответ
-            raw_response = response.to_bytes()  # Фигачим наш ответ в байты
             self.serve_socket.sendto(raw_response, addr)  # И отправляем обратно
-        except Exception as ex:
-            print(ex)
+        except OSError:
+            return  # Сокет уже закрыли или клиент недоступен
+        self.metrics.observe('send', time.perf_counter() - started)
 
+    def finish_response(self, packet, response, generation, tcp):
+        """Метод, превращающий собранный ответ в байты: запоминает его в кэше готовых ответов,
+        добавляет OPT (если клиент прислал свою) и, если ответ не влезает в UDP-пакет клиента,
+        обрезает его до вопроса с флагом TC - тогда клиент переспросит по TCP"""
+        raw_response = response.to_bytes()  # Фигачим наш ответ в байты
+        self.remember_response(packet, response, raw_response, generation)  # Готовые ответы храним без OPT
+        opt = packet.get_opt()
+        if opt is not None:
+            append_opt(raw_response, self.udp_payload)
+        limit = MAX_TCP_MESSAGE if tcp else packet.udp_limit(self.udp_payload)
+        if len(raw_response) > limit:
+            self.metrics.inc('truncated')
+            raw_response = response.truncated().to_bytes()
+            if opt is not None:
+                append_opt(raw_response, self.udp_payload)
+        self.count_response(raw_response, response.compression_saved)
+        return raw_response
 
-if __name__ == '__main__':
-    forwarder_host = None  # Сервер, с которого будем брать инфу
-    server = None  # наш сервер
+    def check_questions(self, packet):
+        """Метод, отказывающий пакетам со слишком большим числом вопросов: каждый промах - это запрос
+        к форвардеру, и один пакет не должен порождать их сколько угодно. Возвращает ответ FORMERR
+        (без вопросов, как разрешает RFC 1035) или None, если вопросов не больше MAX_QUESTIONS"""
+        if len(packet.question) <= MAX_QUESTIONS:
+            return None
+        self.metrics.inc('formerr')
+        self.log.debug('Too many questions ({}) in a query', len(packet.question))
+        return DNSPacket(packet.packet_id, 0x8000 | FORMERR, [], [], [], []).to_bytes()
+
+    def handle_query(self, raw_packet, tcp=False, client=None):
+        """Метод, отвечающий на сырой запрос (и по UDP, и по TCP). Возвращает сырой ответ или None.
+        Попутно засекает время каждого этапа (метрики stats).
+        client - (адрес клиента, когда пришел запрос по time.perf_counter) для лога запросов"""
+        raw_response = self.handle_cached(raw_packet, tcp, client)
+        if raw_response is not None:
+            return raw_response
+        return self.resolve_query(raw_packet, tcp, client)
+
+    def log_query(self, client, raw_packet, raw_response, flags=0):
+        """Метод, отдающий запрос и ответ в лог запросов (если он включен). raw_response None - запрос выкинули"""
+        if self.query_log is None or client is None:
+            return
+        addr, received = client
+        if raw_response is None:
+            flags |= FLAG_DROPPED
+        self.query_log.record(addr, raw_packet, raw_response, flags, time.perf_counter() - received)
+
+    def handle_cached(self, raw_packet, tcp=False, client=None):
+        """Первая часть handle_query: учитывает запрос и ищет на него готовый ответ -
+        тогда достаточно вписать в него id запроса и времена жизни. Если ответа нет, возвращает None"""
+        metrics = self.metrics
+        metrics.inc('queries')
+        if tcp:
+            metrics.inc('tcp_queries')
+        started = time.perf_counter()
+        cached = self.response_cache.get(raw_packet, self.udp_payload, tcp)
+        if cached is None:
+            return None
+        metrics.observe('cache', time.perf_counter() - started)
+        metrics.inc('response_cache_hits')
+        raw_response, compression_saved, key = cached
+        self.count_response(raw_response, compression_saved)
+        self.prefetcher.hit(key)
+        self.log_query(client, raw_packet, raw_response, FLAG_CACHED | (FLAG_TCP if tcp else 0))
+        return raw_response
+
+    def resolve_query(self, raw_packet, tcp=False, client=None):
+        """Вторая часть handle_query: собирает ответ из кэша записей, а чего там нет - спрашивает у форвардера
+        (см. DnsResolve.resolve_query)"""
+        return self.drive(resolve_query(self, raw_packet, tcp, client))
+
+
+def print_start_error(ex):
+    # выводим ошибки создания сервака
+    print('Не удалось запустить сервер.\n'
+          'Проверте, что программа запускается от имени '
+          'администратора и 53 порт свободен и форвардер'
+          ' указан правильно.')
+    print('Причина ошибки:', ex)
+
+
+def server_options(args):
+    """Настройки сервака из командной строки, которые одинаково передаются и воркерам"""
+    return {
+        'prefetch_fraction': args.prefetch_fraction,
+        'prefetch_concurrency': args.prefetch_concurrency,
+        'prefetch_rate': args.prefetch_rate,
+        'udp_payload': args.udp_payload,
+        'hedge': args.hedge,
+        'port': args.port,
+        'metrics_port': args.metrics_port,
+        'query_log': args.query_log,
+        'debug_log': args.debug_log,
+        'stale_deadline': args.stale_deadline,
+        'threads': args.threads,
+        'queue_size': args.queue_size,
+        'rate_limit': args.rate_limit,
+        'rate_slip': args.rate_slip,
+        'zone_files': args.zone,
+        'hosts_files': args.hosts,
+        'blocklist': args.blocklist,
+        'block_answer': args.block_answer,
+        'sinkhole_addresses': args.sinkhole_address or SINKHOLE_ADDRESSES,
+    }
+
+
+def run_workers(args):
+    """Режим нескольких процессов-воркеров: каждый слушает 53 порт через SO_REUSEPORT,
+    кэш у всех общий, а консольные команды рассылаются всем воркерам"""
+    pool = None
     try:
-        forwarder_host = sys.argv[1]  # получаем адрес сервака от пользователя
-    except IndexError:
-        print('Usage: python DnsServer.py <forwarder>')  # если не передали аргумент, то выход
+        pool = WorkerPool(args.forwarder, args.engine, args.workers, args.shared_cache_slots,
+                          server_options(args), args.stale_window)
+        pool.start()
+    except Exception as ex:
+        print_start_error(ex)
+        if pool is not None:
+            pool.close()
         exit(-1)
+    snapshotter = CacheSnapshotter(pool.cache, args.cache_file, args.snapshot_interval)
+    snapshotter.start()  # Общий кэш грузит и сохраняет главный процесс
+    while True:
+        cmd = input()
+        if cmd == 'exit':
+            pool.stop()  # Каждый воркер грамотно закрывает свой сервак
+            snapshotter.stop()
+            pool.close()
+            print('Bye!')  # Прощаемся, выходим
+            exit()
+        elif cmd == 'cache':
+            print('Cache status:')
+            print(pool.cache.get_status())  # Кэш общий, так что спрашиваем его сами, а не у воркеров
+        else:
+            output = pool.run_command(cmd)
+            if output:
+                print(output)
+
+
+if __name__ == '__main__':
+    server = None  # наш сервер
+    """Разбираем аргументы командной строки. Если не передали форвардер, argparse сам выведет usage и выйдет"""
+    parser = argparse.ArgumentParser(description='Кэширующий DNS-сервер')
+    parser.add_argument('forwarder', nargs='+',
+                        help='серверы, с которых будем брать инфу (хост или хост:порт); '
+                             'каждый запрос идет к самому быстрому из живых')
+    parser.add_argument('--port', type=int, default=DNS_PORT,
+                        help='на каком порту слушать (по умолчанию 53)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='threads - пул из --threads потоков, разбирающих ограниченную очередь '
+                             '(--queue-size) (по умолчанию), asyncio - все запросы в одном event loop-е')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='сколько процессов слушают 53 порт (по умолчанию 1); '
+                             'при нескольких кэш у них общий, в разделяемой памяти')
+    parser.add_argument('--threads', type=int, default=WORKER_THREADS,
+                        help='сколько потоков обрабатывают запросы в режиме threads (по умолчанию 64)')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='сколько запросов может ждать обработки, остальные выкидываются '
+                             '(по умолчанию 1024; в режиме asyncio - сколько обрабатывается одновременно)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='сколько ответов в секунду получает один IP (по умолчанию без ограничения)')
+    parser.add_argument('--rate-slip', type=int, default=RATE_SLIP,
+                        help='каждый какой ответ сверх лимита отдавать пустым с флагом TC, а не выкидывать '
+                             '(по умолчанию 2, 0 - выкидывать все)')
+    parser.add_argument('--cache-memory', type=int, default=DEFAULT_CACHE_MEMORY // (1024 * 1024),
+                        help='сколько мегабайт памяти может занимать кэш (по умолчанию 64)')
+    parser.add_argument('--shared-cache-slots', type=int, default=DEFAULT_SLOTS,
+                        help='сколько записей вмещает общий кэш воркеров')
+    parser.add_argument('--prefetch-fraction', type=float, default=PREFETCH_FRACTION,
+                        help='в какой последней доле TTL заранее обновлять популярные записи '
+                             '(по умолчанию 0.1, 0 - не обновлять)')
+    parser.add_argument('--prefetch-concurrency', type=int, default=PREFETCH_CONCURRENCY,
+                        help='сколько обновлений может идти одновременно')
+    parser.add_argument('--prefetch-rate', type=float, default=PREFETCH_RATE,
+                        help='сколько обновлений в секунду максимум')
+    parser.add_argument('--udp-payload', type=int, default=DEFAULT_UDP_PAYLOAD,
+                        help='сколько байт по UDP принимаем от клиентов и форвардера (EDNS0, по умолчанию 1232)')
+    parser.add_argument('--hedge', action='store_true',
+                        help='если форвардер не ответил за свое обычное время, '
+                             'спрашивать еще и другой и брать первый ответ')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='порт на localhost, где отдавать метрики в формате Prometheus (по умолчанию выключено; '
+                             'у воркеров - этот порт плюс номер воркера)')
+    parser.add_argument('--query-log',
+                        help='писать все запросы и ответы в бинарный лог (файлы по 64 Мб, 10 старых хранятся; '
+                             'смотреть - python DnsQueryLog.py dump, прогнать заново - python bench/replay.py)')
+    parser.add_argument('--debug-log', type=float, default=0,
+                        help='печатать, что происходит с каждым запросом, не больше стольких строк в секунду '
+                             '(по умолчанию выключено, включается и командой debug_on)')
+    parser.add_argument('--stale-window', type=float, default=DEFAULT_STALE_WINDOW,
+                        help='сколько секунд после протухания запись еще хранится, чтобы отвечать ей, '
+                             'когда форвардер лежит или тормозит (по умолчанию сутки, 0 - выключить)')
+    parser.add_argument('--stale-deadline', type=float, default=STALE_DEADLINE,
+                        help='сколько секунд ждать форвардера, прежде чем ответить протухшей записью '
+                             '(по умолчанию 0.5)')
+    parser.add_argument('--zone', action='append', default=[],
+                        help='файл зоны (мастер-файл RFC 1035), на имена из которой отвечаем сами; можно несколько')
+    parser.add_argument('--hosts', action='append', default=[],
+                        help='hosts-файл (IP имя [синонимы...]), на имена из которого отвечаем сами; можно несколько')
+    parser.add_argument('--blocklist',
+                        help='блоклист, скомпилированный командой python DnsBlocklist.py compile')
+    parser.add_argument('--block-answer', choices=['nxdomain', 'sinkhole'], default='nxdomain',
+                        help='что отвечать на заблокированные имена: NXDOMAIN (по умолчанию) или адрес-заглушку')
+    parser.add_argument('--sinkhole-address', action='append',
+                        help='адрес-заглушка для режима sinkhole (IPv4 - для A, IPv6 - для AAAA; '
+                             'можно несколько, по умолчанию 0.0.0.0 и ::)')
+    parser.add_argument('--cache-file', default=DEFAULT_CACHE_FILE,
+                        help='файл, в котором кэш переживает перезапуск (по умолчанию cache)')
+    parser.add_argument('--snapshot-interval', type=float, default=DEFAULT_SNAPSHOT_INTERVAL,
+                        help='раз во сколько секунд сохранять кэш в файл (по умолчанию 60, '
+                             '0 - только при выходе)')
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_workers(args)
     try:
-        server = DnsServer(forwarder_host)  # создаем наш сервак
-        try:
-            with open('cache', 'rb') as file:  # открываем кэш на чтение байтов (файл сериализован)
-                server.cache = pickle.load(file)  # грузим данные из кэша
-        except Exception as ex:
-            print('Can\'t load cache:')  # если словили ошибку на кэше, выведем, что к чему
-            print(ex)
+        server = DnsServer(args.forwarder, args.engine,
+                           cache=DnsCache(args.cache_memory * 1024 * 1024, args.stale_window),
+                           **server_options(args))  # создаем наш сервак
     except Exception as ex:
-        # выводим ошибки создания сервака
-        print('Не удалось запустить сервер.\n'
-              'Проверте, что программа запускается от имени '
-              'администратора и 53 порт свободен и форвардер'
-              ' указан правильно.')
-        print('Причина ошибки:', ex)
+        print_start_error(ex)
         exit(-1)
     server.start()  # запускаем сервак (метод threading.Thread)
+    snapshotter = CacheSnapshotter(server.cache, args.cache_file, args.snapshot_interval)
+    snapshotter.start()  # Кэш из файла догружается уже во время работы
     """Прога работает с консолью и имеет 4 команды:
     exit - завершить работу сервера
     cache - вывести таблицу с информацие о кэше
+    stats - вывести счетчики и времена этапов обработки запросов
+    zones - вывести, какие локальные зоны загружены
+    blocklist - вывести, какой блоклист загружен
+    querylog - вывести статистику лога запросов
+    reload - перечитать файлы локальных зон, hosts-файлы и блоклист
     forwarder_on - включить запросы к форвардеру
     forwarder_off - выключить запросы к форвардеру"""
     """Прога, по сути, смотрит, не появилась ли в консоли какая команда"""
     while True:
         cmd = input()
         if cmd == 'exit':
-            """Сервак закрываем грамотно!"""
-            server.server_runnable = False  # отрубаем сервак от работы с пользователем
-            server.join()  # ждем завершения сервака (сервер наследуется от threading.Thread)
-            """Затем ждем завершения всех второстепеннных потоков"""
-            for thread in threading.enumerate():
-                if thread == threading.main_thread():
-                    continue
-                thread.join()
-            server.stop_server()  # теперь останавливаем сервак
-            """Записываем инфу в кэш, чтобы не потерялась"""
-            try:
-                with open('cache', 'wb') as file:  # Открываем файл на запись байтов
-                    pickle.dump(server.cache, file)  # Сериализуем кэш в файл
-            except Exception as ex:
-                # Ну и, как обычно если ловим ошибку, выводим инфу
-                print('Can\'t save cache:')
-                print(ex)
+            server.shutdown()
+            snapshotter.stop()  # Последний снимок кэша
             print('Bye!')  # Прощаемся, выходим
             exit()
-        elif cmd == 'cache':
-            print('Cache status:')
-            print(server.cache.get_status())  # кэш в проге является отдельной сущностью
-        elif cmd == 'forwarder_on':
-            print('Forwarder enabled')
-            server.forwarder_on = True
-        elif cmd == 'forwarder_off':
-            print('Forwarder disabled')
-            server.forwarder_on = False
+        output = server.run_command(cmd)
+        if output is not None:
+            print(output)
@@ -0,0 +1,285 @@
+import hashlib
+import struct
+import time
+from multiprocessing import shared_memory
+from DNSPacketParser import DnsResource
+from DnsCache import DEFAULT_STALE_WINDOW, NAME_WIDE_TYPE, make_key, negative_key, negative_ttl, stale_copy
+
+
+"""Кэш, общий для всех процессов-воркеров (см. DnsWorkers).
+Лежит в multiprocessing.shared_memory и устроен как хэш-таблица с открытой адресацией:
+память нарезана на слоты фиксированного размера, в каждом слоте одна ресурсная запись.
+Так запись, которую один воркер получил от форвардера, сразу видна всем остальным."""
+"""ПОЯСНЕНИЕ! Таблица поделена на регионы по REGION_SIZE слотов. Ключ записи попадает в один регион
+и ищется только внутри него (линейным пробированием, не дальше MAX_PROBE слотов).
+На каждый регион приходится свой лок (локов меньше, чем регионов, так что один лок
+делят несколько регионов), поэтому воркеры, работающие с разными ключами, почти не мешают друг другу."""
+
+SLOT_SIZE = 512  # Размер слота в байтах. Записи, которые не влезают, общий кэш не хранит
+SLOT_HEADER = struct.Struct('<dQHHIHHBB')  # время протухания, хэш ключа, тип, класс, ttl, длина имени,
+# длина данных, что лежит в слоте (KIND_*), rcode отрицательного ответа
+KIND_RECORD = 0  # Обычная ресурсная запись
+KIND_NEGATIVE = 1  # Отрицательный ответ (см. DnsCache.put_negative): имя, тип и класс - из вопроса,
+# а данные - запакованная запись SOA
+REGION_SIZE = 256  # Слотов в регионе
+MAX_PROBE = 32  # Сколько слотов просматриваем в поисках ключа
+LOCK_COUNT = 64  # Сколько всего локов
+DEFAULT_SLOTS = 65536  # 65536 слотов по 512 байт - 32 Мб
+
+EMPTY = 0.0  # Время протухания пустого слота (в него никогда ничего не клали).
+# Протухшие слоты пустыми не становятся: поиск идет через них дальше, а новая запись может их занять
+# (если запись протухла меньше stale_window секунд назад, то только когда свободных слотов нет)
+
+
+def key_hash(key):
+    """64-битный хэш ключа. Встроенный hash() не годится: в каждом процессе он свой"""
+    name, r_type, r_class = key
+    digest = hashlib.blake2b('{}|{}|{}'.format(name, r_type, r_class).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class SharedDnsCache:
+    """Общий кэш воркеров. Снаружи выглядит так же, как DnsCache"""
+    def __init__(self, name, slots, locks, create=False, stale_window=DEFAULT_STALE_WINDOW):
+        self.stale_window = stale_window  # Сколько протухшие записи годятся для ответа без форвардера
+        self.slots = max(REGION_SIZE, slots - slots % REGION_SIZE)  # Целое число регионов
+        self.regions = self.slots // REGION_SIZE
+        self.locks = locks
+        self.memory = shared_memory.SharedMemory(name=name, create=create, size=self.slots * SLOT_SIZE)
+        """Удалять общую память будет тот, кто ее создал (close(unlink=True)). Воркеры запускаются через spawn
+        и делят трекер ресурсов с главным процессом, так что их подключение утечкой он не считает"""
+        self.buf = self.memory.buf
+        self.listeners = []  # Подписчики на изменения (только те, что в этом процессе)
+
+    @staticmethod
+    def create(context, slots=DEFAULT_SLOTS, stale_window=DEFAULT_STALE_WINDOW):
+        """Создает новый общий кэш. context - контекст multiprocessing, из которого делаем локи"""
+        return SharedDnsCache(None, slots, [context.Lock() for _ in range(LOCK_COUNT)], create=True,
+                              stale_window=stale_window)
+
+    def attach_args(self):
+        """Аргументы, с которыми к этому кэшу подключится другой процесс: SharedDnsCache(*attach_args())"""
+        return self.memory.name, self.slots, self.locks, False, self.stale_window
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+    def add_listener(self, listener):
+        """См. DnsCache.add_listener. Об изменениях, сделанных другими процессами, подписчик не узнает"""
+        self.listeners.append(listener)
+
+    def notify(self, key):
+        for listener in self.listeners:
+            listener(key)
+
+    def locate(self, h):
+        """Возвращает лок и номера слотов, в которых может лежать ключ с хэшем h"""
+        region = (h >> 32) % self.regions
+        base = region * REGION_SIZE
+        start = h % REGION_SIZE
+        return self.locks[region % len(self.locks)], \
+            [base + (start + i) % REGION_SIZE for i in range(MAX_PROBE)]
+
+    def read_resource(self, index, header):
+        """Достает запись из слота. header - уже прочитанный заголовок слота"""
+        _, _, r_type, r_class, r_ttl, name_len, data_len, _, _ = header
+        offset = index * SLOT_SIZE + SLOT_HEADER.size
+        name = bytes(self.buf[offset:offset + name_len]).decode()
+        r_data = bytes(self.buf[offset + name_len:offset + name_len + data_len])
+        return DnsResource(name, r_type, r_class, r_ttl, r_data)
+
+    def find(self, key, h, indexes, now, kind=KIND_RECORD):
+        """Ищет записи по ключу, протухающие не раньше now (вызывать под локом).
+        Возвращает [(номер слота, время протухания, запись, rcode)]"""
+        result = []
+        for index in indexes:
+            header = SLOT_HEADER.unpack_from(self.buf, index * SLOT_SIZE)
+            expire_time, slot_hash = header[0], header[1]
+            if expire_time == EMPTY:
+                break  # Дальше по цепочке ничего нет
+            if slot_hash != h or expire_time < now or header[7] != kind:
+                continue
+            resource = self.read_resource(index, header)
+            if make_key(resource.r_name, resource.r_type, resource.r_class) == key:
+                result.append((index, expire_time, resource, header[8]))
+        return result
+
+    def write_slot(self, index, expire_time, h, resource, kind=KIND_RECORD, rcode=0):
+        """Записывает запись в слот (вызывать под локом)"""
+        name = resource.r_name.encode()
+        r_data = bytes(resource.r_data)
+        offset = index * SLOT_SIZE
+        SLOT_HEADER.pack_into(self.buf, offset, expire_time, h, resource.r_type, resource.r_class,
+                              resource.r_ttl, len(name), len(r_data), kind, rcode)
+        offset += SLOT_HEADER.size
+        self.buf[offset:offset + len(name)] = name
+        self.buf[offset + len(name):offset + len(name) + len(r_data)] = r_data
+
+    def kill_negative(self, key, indexes, now):
+        """Помечает протухшими отрицательные ответы по ключу (вызывать под локом).
+        Пустыми слоты не делаем, иначе оборвем цепочки поиска"""
+        for index, _, _, _ in self.find(key, key_hash(key), indexes, now, KIND_NEGATIVE):
+            struct.pack_into('<d', self.buf, index * SLOT_SIZE, 1.0)
+
+    def get_resources(self, question, stale=False):
+        """Метод, возвращающий данные из кэша (см. DnsCache.get_resources)"""
+        key = make_key(question.q_name, question.q_type, question.q_class)
+        h = key_hash(key)
+        lock, indexes = self.locate(h)
+        now = time.time()
+        with lock:
+            found = self.find(key, h, indexes, now - self.stale_window if stale else now)
+        return [resource if expire_time > now else stale_copy(resource) for _, expire_time, resource, _ in found]
+
+    def get_expire_time(self, resource):
+        """Метод, возвращающий абсолютное время протухания записи (или None, если ее нет в кэше)"""
+        key = make_key(resource.r_name, resource.r_type, resource.r_class)
+        h = key_hash(key)
+        lock, indexes = self.locate(h)
+        r_data = bytes(resource.r_data)
+        with lock:
+            for _, expire_time, cached, _ in self.find(key, h, indexes, time.time()):
+                if cached.r_data == r_data:
+                    return expire_time
+        return None
+
+    def put_resource(self, resource, expire_time=None):
+        """Метод, добавляющий данные в кэш (см. DnsCache.put_resource, уже имеющуюся запись тоже продлеваем)"""
+        key = make_key(resource.r_name, resource.r_type, resource.r_class)
+        name = resource.r_name.encode()
+        r_data = bytes(resource.r_data)
+        if SLOT_HEADER.size + len(name) + len(r_data) > SLOT_SIZE:
+            return  # Не влезает в слот
+        h = key_hash(key)
+        lock, indexes = self.locate(h)
+        now = time.time()
+        if expire_time is None:
+            expire_time = now + resource.r_ttl
+        stale_until = now - self.stale_window
+        with lock:
+            free = None  # Первый слот, который можно занять (пустой или протухший совсем)
+            victim = None  # Если свободных нет - вытесняем запись, которая протухла или протухнет раньше всех
+            victim_expire_time = None
+            for index in indexes:
+                header = SLOT_HEADER.unpack_from(self.buf, index * SLOT_SIZE)
+                slot_expire_time = header[0]
+                if slot_expire_time == EMPTY:
+                    if free is None:
+                        free = index
+                    break
+                if slot_expire_time < stale_until:
+                    if free is None:
+                        free = index
+                    continue
+                if header[1] == h and header[7] == KIND_RECORD:
+                    cached = self.read_resource(index, header)
+                    if cached.r_data == r_data and \
+                            make_key(cached.r_name, cached.r_type, cached.r_class) == key:
+                        if slot_expire_time >= expire_time:
+                            return  # Такая запись уже есть, второй раз не кладем
+                        free = index  # Перезаписываем ее же с новым временем протухания
+                        break
+                    if slot_expire_time < now < expire_time and \
+                            make_key(cached.r_name, cached.r_type, cached.r_class) == key:
+                        """Протухшая запись того же ключа, а пришли свежие данные: ее отдавать уже не надо"""
+                        struct.pack_into('<d', self.buf, index * SLOT_SIZE, 1.0)
+                        if free is None:
+                            free = index
+                        continue
+                if victim is None or slot_expire_time < victim_expire_time:
+                    victim, victim_expire_time = index, slot_expire_time
+            self.write_slot(free if free is not None else victim, expire_time, h, resource)
+            """Раз запись появилась, отрицательные ответы про нее больше не актуальны.
+            Ответ на имя целиком (NXDOMAIN) может лежать в другом регионе - его не трогаем, он просто доживет свое"""
+            self.kill_negative(key, indexes, now)
+        self.notify(key)
+
+    def put_negative(self, question, rcode, soa, expire_time=None):
+        """Метод, добавляющий в кэш отрицательный ответ (см. DnsCache.put_negative)"""
+        key = negative_key(question.q_name, question.q_type, question.q_class, rcode)
+        packed_soa = bytes(soa.to_bytes())
+        if SLOT_HEADER.size + len(key[0].encode()) + len(packed_soa) > SLOT_SIZE:
+            return  # Не влезает в слот
+        h = key_hash(key)
+        lock, indexes = self.locate(h)
+        now = time.time()
+        if expire_time is None:
+            expire_time = now + negative_ttl(soa)
+        stale_until = now - self.stale_window
+        with lock:
+            self.kill_negative(key, indexes, now)
+            free = None  # Как в put_resource: первый пустой слот или слот, протухший совсем
+            # (в том числе только что убитый kill_negative). Протухшие, но еще годные для serve-stale
+            # записи не трогаем, пока есть что вытеснить
+            victim = None
+            victim_expire_time = None
+            for index in indexes:
+                slot_expire_time = SLOT_HEADER.unpack_from(self.buf, index * SLOT_SIZE)[0]
+                if slot_expire_time == EMPTY or slot_expire_time < stale_until:
+                    free = index
+                    break
+                if victim is None or slot_expire_time < victim_expire_time:
+                    victim, victim_expire_time = index, slot_expire_time
+            self.write_slot(free if free is not None else victim, expire_time, h,
+                            DnsResource(key[0], key[1], key[2], soa.r_ttl, packed_soa), KIND_NEGATIVE, rcode)
+
+    def get_negative(self, question):
+        """Метод, возвращающий отрицательный ответ (см. DnsCache.get_negative)"""
+        key = make_key(question.q_name, question.q_type, question.q_class)
+        now = time.time()
+        for negative in (key, (key[0], NAME_WIDE_TYPE, key[2])):
+            h = key_hash(negative)
+            lock, indexes = self.locate(h)
+            with lock:
+                found = self.find(negative, h, indexes, now, KIND_NEGATIVE)
+            if found:
+                _, expire_time, resource, rcode = found[0]
+                soa, _ = DnsResource.parse_resource(memoryview(resource.r_data), 0)
+                return rcode, soa, expire_time
+        return None
+
+    def entries(self):
+        """Метод, возвращающий все записи кэша (в том числе протухшие, но еще годные для serve-stale)
+        в виде списка (время протухания, запись)"""
+        result = []
+        now = time.time() - self.stale_window
+        for region in range(self.regions):
+            with self.locks[region % len(self.locks)]:
+                for index in range(region * REGION_SIZE, (region + 1) * REGION_SIZE):
+                    header = SLOT_HEADER.unpack_from(self.buf, index * SLOT_SIZE)
+                    if header[0] >= now and header[7] == KIND_RECORD:
+                        result.append((header[0], self.read_resource(index, header)))
+        return result
+
+    def negative_entries(self):
+        """Метод, возвращающий все живые отрицательные ответы (см. DnsCache.negative_entries)"""
+        result = []
+        now = time.time()
+        for region in range(self.regions):
+            with self.locks[region % len(self.locks)]:
+                for index in range(region * REGION_SIZE, (region + 1) * REGION_SIZE):
+                    header = SLOT_HEADER.unpack_from(self.buf, index * SLOT_SIZE)
+                    if header[0] >= now and header[7] == KIND_NEGATIVE:
+                        resource = self.read_resource(index, header)
+                        soa, _ = DnsResource.parse_resource(memoryview(resource.r_data), 0)
+                        result.append((header[0], (resource.r_name, resource.r_type, resource.r_class),
+                                       header[8], soa))
+        return result
+
+    def get_counters(self):
+        """Числа для метрик (см. DnsMetrics). Считать занятые слоты - это пробежать весь кэш,
+        поэтому отдаем только размер"""
+        return {'cache_slots': self.slots}
+
+    def get_status(self):
+        """Метод, выводящий на экран данные обо всех имеющихся записях в кэше"""
+        now = time.time()
+        entries = self.entries()
+        return '\n'.join(['Time: {:5d}s Resource: {:80}'.format(
+            int(expire_time - now),
+            resource.to_string()
+        ) for expire_time, resource in entries] + [
+            'Records: {} Memory: {}/{} bytes'.format(len(entries), len(entries) * SLOT_SIZE, self.slots * SLOT_SIZE)])
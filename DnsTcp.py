@@ -0,0 +1,138 @@
+import socket
+import struct
+import threading
+import time
+from DnsQueryLog import FLAG_TCP
+
+
+"""DNS поверх TCP (RFC 1035 4.2.2, RFC 7766). Нужен для ответов, которые не влезают в UDP-пакет:
+на такие по UDP мы отвечаем с флагом TC, и клиент переспрашивает по TCP.
+Каждое сообщение в TCP-потоке предваряется двумя байтами длины. В одном соединении клиент может
+слать запросы конвейером, не дожидаясь ответов, а мы отвечаем на них в любом порядке (по мере готовности)."""
+"""ПОЯСНЕНИЕ! TCP обслуживается с теми же ограничениями, что и UDP: соединений одновременно не больше
+TCP_MAX_CONNECTIONS (лишние сразу закрываем), в одном соединении без ответа висит не больше TCP_MAX_PIPELINE
+запросов (пока их столько, следующий из сокета не читаем), каждый запрос проходит через RateLimiter,
+а промахи разбирает тот же пул потоков (WorkQueue), что и промахи по UDP."""
+
+LENGTH_STRUCT = struct.Struct('>H')
+TCP_IDLE_TIMEOUT = 10  # Сколько держим соединение, в котором ничего не происходит
+TCP_BACKLOG = 128
+TCP_MAX_CONNECTIONS = 128  # Сколько TCP-соединений обслуживаем одновременно
+TCP_MAX_PIPELINE = 16  # Сколько запросов одного соединения могут одновременно ждать ответа
+DNS_PORT = 53
+
+
+def recv_exact(sock, size):
+    """Читает из сокета ровно size байт. Если соединение закрылось раньше, возвращает None"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return data
+
+
+def recv_message(sock):
+    """Читает из TCP-потока одно DNS-сообщение (или None, если соединение закрылось)"""
+    length = recv_exact(sock, LENGTH_STRUCT.size)
+    if length is None:
+        return None
+    return recv_exact(sock, LENGTH_STRUCT.unpack(length)[0])
+
+
+def frame(message):
+    """Заворачивает DNS-сообщение для отправки по TCP"""
+    return LENGTH_STRUCT.pack(len(message)) + message
+
+
+def make_tcp_socket(reuse_port=False, port=DNS_PORT):
+    """Создает слушающий TCP-сокет на 53 (или другом) порту (reuse_port - см. DnsServer.make_serve_socket)"""
+    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Чтобы после перезапуска порт
+    # не висел в TIME_WAIT
+    if reuse_port:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    tcp_socket.bind(('', port))
+    tcp_socket.listen(TCP_BACKLOG)
+    return tcp_socket
+
+
+class TcpListener(threading.Thread):
+    """Поток, принимающий TCP-соединения клиентов (для обычного режима с потоками).
+    Каждое соединение читает свой поток: готовые ответы отдает сам, а промахи кладет в очередь сервака"""
+    def __init__(self, server, tcp_socket, timeout, max_connections=TCP_MAX_CONNECTIONS):
+        super().__init__(name='TcpListener', daemon=True)
+        self.server = server
+        self.tcp_socket = tcp_socket
+        self.tcp_socket.settimeout(timeout)  # Чтобы периодически проверять, не пора ли заканчивать
+        self.connections = threading.BoundedSemaphore(max_connections)
+
+    def run(self):
+        while self.server.server_runnable:
+            try:
+                connection, addr = self.tcp_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # Сокет закрыли
+            if not self.connections.acquire(blocking=False):
+                self.server.metrics.inc('tcp_refused')  # Соединений и так слишком много
+                self.server.log.debug('Too many TCP connections, refused {}', addr)
+                connection.close()
+                continue
+            self.server.log.debug('TCP connection from {}', addr)
+            threading.Thread(target=self.serve_connection, args=(connection, addr), daemon=True).start()
+
+    def serve_connection(self, connection, addr):
+        connection.settimeout(TCP_IDLE_TIMEOUT)
+        write_lock = threading.Lock()  # Ответы пишут разные потоки, а сообщения не должны перемешиваться
+        in_flight = threading.BoundedSemaphore(TCP_MAX_PIPELINE)  # Место для каждого запроса без ответа
+
+        def reply(raw_response):
+            """Отправляет ответ (None - ответа не будет) и освобождает место для следующего запроса"""
+            try:
+                if raw_response is not None:
+                    self.send(connection, write_lock, raw_response)
+            finally:
+                in_flight.release()
+
+        try:
+            while self.server.server_runnable:
+                message = recv_message(connection)
+                if message is None:
+                    break
+                if not in_flight.acquire(timeout=TCP_IDLE_TIMEOUT):
+                    break  # Клиент засыпал нас запросами, а ответы не читает
+                self.serve_message(message, (addr, time.perf_counter()), reply)
+        except OSError:
+            pass  # Таймаут простоя или клиент оборвал соединение
+        for _ in range(TCP_MAX_PIPELINE):
+            in_flight.acquire()  # Доотвечаем на то, что уже спросили, и только потом закрываем
+        connection.close()
+        self.connections.release()
+
+    def serve_message(self, message, client, reply):
+        """Отвечает на одно сообщение: готовый ответ - сразу, промах - через очередь сервака"""
+        server = self.server
+        addr, received = client
+        if server.rate_limiter is not None and not server.check_rate(message, addr, None):
+            reply(None)
+            return
+        raw_response = server.handle_cached(message, tcp=True, client=client)
+        if raw_response is not None:
+            reply(raw_response)
+        elif not server.work_queue.put((addr, message, received, reply)):
+            server.metrics.inc('shed_queries')
+            server.log.debug('Queue is full, dropped TCP query from {}', addr)
+            server.log_query(client, message, None, FLAG_TCP)
+            reply(None)
+
+    def send(self, connection, write_lock, raw_response):
+        try:
+            started = time.perf_counter()
+            with write_lock:
+                connection.sendall(frame(raw_response))
+            self.server.metrics.observe('send', time.perf_counter() - started)
+        except OSError:
+            pass  # Клиент уже ушел
@@ -0,0 +1,460 @@
+import random
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from DNSPacketParser import DNSPacket, HEADER_STRUCT, FLAG_TC, DEFAULT_UDP_PAYLOAD, make_opt
+from DnsCache import make_key
+from DnsTcp import recv_message, frame
+
+
+"""Работа с форвардерами через пул долгоживущих сокетов.
+Раньше на каждый промах кэша открывался новый сокет, отправлялся один пакет,
+поток висел на recvfrom и сокет закрывался. Теперь сокеты открываются один раз,
+запросы раскидываются по ним случайным образом, а ответы разбирает один поток-приемник
+и раздает ждущим по ключу (идентификатор пакета, вопрос)."""
+"""ПОЯСНЕНИЕ! Чтобы не потерять защиту от подделки ответов, идентификаторы пакетов
+случайные, сокеты привязаны к случайным эфемерным портам (порт выбирает ядро)
+и периодически пересоздаются, а ответ принимается только от того форвардера, которому
+ушел запрос, и только если в нем тот же вопрос, что мы задавали."""
+"""Форвардеров может быть несколько. Для каждого считаем сглаженное время ответа (SRTT, как в TCP)
+и подряд идущие таймауты: каждый промах идет к самому быстрому из живых, а тот, кто несколько раз
+подряд промолчал, на время (с растущей паузой) выводится из игры. В режиме hedge, если первый
+форвардер не ответил за свое обычное время (95-й перцентиль последних ответов), тот же вопрос
+уходит второму, и берется ответ, пришедший первым. Второму даем свой полный таймаут, иначе при
+перцентиле, близком к таймауту, ему не оставалось бы времени, и в промолчавшие записывались бы оба.
+Промолчавшим форвардер считается не больше одного раза на вопрос клиента, сколько бы раз мы его
+ни переспрашивали: иначе один потерянный вопрос сразу выводил бы из игры здоровый форвардер."""
+
+UPSTREAM_POOL_SIZE = 4  # Сколько сокетов держим открытыми
+UPSTREAM_TIMEOUT = 0.7  # Сколько ждем ответа на одну попытку
+UPSTREAM_RETRIES = 2  # Сколько раз переспрашиваем, если ответа нет
+UPSTREAM_ROTATE_AFTER = 1000  # После стольких запросов сокет заменяется новым (с новым портом)
+UPSTREAM_TCP_TIMEOUT = 2  # Сколько ждем ответа форвардера по TCP (там ответы не теряются, поэтому ждем дольше)
+UPSTREAM_PORT = 53
+RTT_ALPHA = 0.125  # Вес нового замера в SRTT (как в TCP, RFC 6298)
+RTT_WINDOW = 64  # По скольким последним ответам считаем перцентиль
+UPSTREAM_MAX_FAILURES = 3  # После стольких таймаутов подряд форвардер считается лежащим
+UPSTREAM_BACKOFF = 1  # На сколько секунд выводим его из игры в первый раз (потом вдвое дольше)
+UPSTREAM_MAX_BACKOFF = 30
+UPSTREAM_EXPLORE = 0.02  # С такой вероятностью спрашиваем случайного живого форвардера, а не самого быстрого,
+# чтобы SRTT медленных (или переставших тормозить) не застывал навсегда
+HEDGE_MIN_SAMPLES = 8  # Пока замеров меньше, перцентиль не считаем, а ждем половину таймаута
+HEDGE_MIN_DELAY = 0.005  # Раньше этого второй запрос не шлем, даже если форвардер очень быстрый
+
+
+def parse_forwarder(text):
+    """Разбирает форвардер из командной строки: 'хост' или 'хост:порт'. Возвращает (ip, порт)"""
+    host, _, port = text.partition(':')
+    return socket.gethostbyname(host), int(port) if port else UPSTREAM_PORT  # если дали ip, так и останется ip
+
+
+def question_key(question):
+    """Ключ вопроса, по которому сопоставляются запрос и ответ"""
+    return make_key(question.q_name, question.q_type, question.q_class)
+
+
+def reply_key(data):
+    """Достает из ответа идентификатор пакета и ключ первого вопроса.
+    Если пакет битый или вопросов в нем не один, возвращает None"""
+    try:
+        packet = DNSPacket.from_bytes(data)  # Ответы при этом не распаковываются, только заголовок и вопрос
+        if len(packet.question) != 1:
+            return None
+        return packet.packet_id, question_key(packet.question[0])
+    except Exception:
+        return None
+
+
+def make_request(packet_id, question, payload=DEFAULT_UDP_PAYLOAD):
+    """Собирает запрос к форвардеру (флаг RD выставлен). В OPT объявляем, что по UDP принимаем до payload байт"""
+    return bytes(DNSPacket(packet_id, 0x0100, [question], [], [], [make_opt(payload)]).to_bytes())
+
+
+def is_truncated(data):
+    """Проверяет флаг TC в ответе: ответ не влез в UDP, и за ним надо идти по TCP"""
+    return len(data) >= HEADER_STRUCT.size and bool(HEADER_STRUCT.unpack_from(data, 0)[1] & FLAG_TC)
+
+
+def new_packet_id(pending, key):
+    """Случайный идентификатор, который не занят другим запросом с тем же вопросом"""
+    while True:
+        packet_id = random.randint(0, 0xffff)
+        if (packet_id, key) not in pending:
+            return packet_id
+
+
+class Waiter:
+    """Ожидание ответа на один запрос к форвардеру"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+    def set(self, data):
+        self.response = data
+        self.event.set()
+
+
+class UpstreamStats:
+    """Статистика одного форвардера. Меняется только под локом UpstreamSelector-а"""
+    def __init__(self, address):
+        self.address = address  # (ip, порт)
+        self.srtt = None  # Сглаженное время ответа (None - еще ни разу не отвечал)
+        self.samples = deque(maxlen=RTT_WINDOW)  # Последние времена ответа, для перцентиля
+        self.sent = 0  # Сколько запросов ушло
+        self.answered = 0  # Сколько ответов пришло
+        self.timeouts = 0  # Сколько раз не дождались
+        self.failures = 0  # Сколько таймаутов подряд
+        self.down_until = 0  # До какого момента (monotonic) считаем форвардер лежащим
+
+    def p95(self):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95)]
+
+    def to_string(self, now):
+        state = 'down for {:.1f}s'.format(self.down_until - now) if self.down_until > now else 'up'
+        p95 = self.p95()
+        return '{}:{} - {}, srtt {}, p95 {}, sent {}, answered {}, timeouts {}'.format(
+            self.address[0], self.address[1], state,
+            '-' if self.srtt is None else '{:.1f} ms'.format(self.srtt * 1000),
+            '-' if p95 is None else '{:.1f} ms'.format(p95 * 1000),
+            self.sent, self.answered, self.timeouts)
+
+
+class UpstreamSelector:
+    """Выбор форвардера по времени ответа и живости. Общий для пула потоков и пула asyncio,
+    чтобы замеры, сделанные одним, учитывал и другой"""
+    def __init__(self, addresses, timeout=UPSTREAM_TIMEOUT):
+        self.upstreams = [UpstreamStats(address) for address in addresses]
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hedged = 0  # Сколько раз слали второй запрос
+        self.hedge_wins = 0  # Сколько раз второй ответил раньше первого
+
+    def choose(self, exclude=()):
+        """Самый быстрый из живых форвардеров, кроме exclude (если кроме них никого нет - любой).
+        Еще не отвечавшие считаются самыми быстрыми, чтобы каждый поскорее получил свой замер.
+        Если лежат все, берем того, кто встанет раньше всех"""
+        candidates = [stats for stats in self.upstreams if stats not in exclude] or self.upstreams
+        now = time.monotonic()
+        with self.lock:
+            alive = [stats for stats in candidates if stats.down_until <= now]
+            if not alive:
+                return min(candidates, key=lambda stats: stats.down_until)
+            if len(alive) > 1 and random.random() < UPSTREAM_EXPLORE:
+                return random.choice(alive)
+            return min(alive, key=lambda stats: stats.srtt or 0)
+
+    def other(self, stats):
+        """Форвардер для второго (hedge) запроса или None, если других нет"""
+        if len(self.upstreams) < 2:
+            return None
+        return self.choose(exclude=(stats,))
+
+    def sent(self, stats):
+        with self.lock:
+            stats.sent += 1
+
+    def answered(self, stats, rtt):
+        """Учитывает ответ форвардера, пришедший через rtt секунд после запроса"""
+        with self.lock:
+            stats.answered += 1
+            stats.failures = 0
+            stats.down_until = 0
+            stats.srtt = rtt if stats.srtt is None else stats.srtt + (rtt - stats.srtt) * RTT_ALPHA
+            stats.samples.append(rtt)
+
+    def failed(self, stats):
+        """Учитывает таймаут. SRTT при этом растет так, будто ответ пришел через весь таймаут:
+        тогда и форвардер, теряющий часть пакетов, уступает место тем, кто не теряет"""
+        with self.lock:
+            stats.timeouts += 1
+            stats.failures += 1
+            stats.srtt = self.timeout if stats.srtt is None else stats.srtt + (self.timeout - stats.srtt) * RTT_ALPHA
+            if stats.failures >= UPSTREAM_MAX_FAILURES:
+                backoff = UPSTREAM_BACKOFF * 2 ** (stats.failures - UPSTREAM_MAX_FAILURES)
+                stats.down_until = time.monotonic() + min(backoff, UPSTREAM_MAX_BACKOFF)
+
+    def hedge_delay(self, stats):
+        """Сколько ждем первого форвардера, прежде чем спросить второго"""
+        with self.lock:
+            p95 = stats.p95()
+        if p95 is None:
+            return self.timeout / 2
+        return min(max(p95, HEDGE_MIN_DELAY), self.timeout)
+
+    def count_hedge(self, won):
+        with self.lock:
+            self.hedged += 1
+            if won:
+                self.hedge_wins += 1
+
+    def get_status(self):
+        now = time.monotonic()
+        with self.lock:
+            lines = [stats.to_string(now) for stats in self.upstreams]
+            lines.append('Hedged: {}\nWon by hedge: {}'.format(self.hedged, self.hedge_wins))
+        return '\n'.join(lines)
+
+
+class UpstreamPool:
+    """Пул сокетов для общения с форвардерами (для обычного режима с потоками).
+    Сокеты не привязаны к форвардеру: через любой из них можно спросить любого"""
+    def __init__(self, selector, size=UPSTREAM_POOL_SIZE, timeout=UPSTREAM_TIMEOUT,
+                 retries=UPSTREAM_RETRIES, rotate_after=UPSTREAM_ROTATE_AFTER, payload=DEFAULT_UDP_PAYLOAD,
+                 hedge=False):
+        self.upstreams = selector  # Кого из форвардеров спрашивать
+        self.payload = payload  # Какой размер UDP-ответа объявляем форвардеру
+        self.hedge = hedge  # Слать ли второй запрос другому форвардеру, если первый задумался
+        self.tcp = {stats.address: TcpUpstream(stats.address, payload)
+                    for stats in selector.upstreams}  # Сюда идем, если ответ не влез в UDP
+        self.timeout = timeout
+        self.retries = retries
+        self.rotate_after = rotate_after
+        self.pending = {}  # (packet_id, ключ вопроса) -> (Waiter, UpstreamStats, когда отправили)
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.sockets = [self.open_socket() for _ in range(size)]
+        self.uses = [0] * size  # Сколько запросов ушло через каждый сокет
+        self.to_rotate = set()  # Номера сокетов, которые пора пересоздать
+        self.retiring = []  # (deadline, сокет) - старые сокеты, ждущие опоздавших ответов
+        self.running = True
+        """С selector-ом работает только поток-приемник, остальные потоки его не трогают"""
+        self.receiver = threading.Thread(
+            target=self.receive_loop, name='UpstreamReceiver', daemon=True)
+        self.receiver.start()
+
+    def open_socket(self):
+        """Создает сокет на случайном эфемерном порту и регистрирует его в selector-е"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', 0))  # Порт 0 - пусть ядро выберет случайный
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ)
+        return sock
+
+    def query(self, question):
+        """Задает вопрос форвардерам и возвращает сырой ответ (или None, если не дождались).
+        На каждую попытку свой таймаут, при молчании переспрашиваем (по возможности другого форвардера)
+        с новым идентификатором"""
+        key = question_key(question)
+        waiter = Waiter()  # Общий на все запросы по этому вопросу: кто первый ответил, того и берем
+        sent = []  # Ключи всех отправленных запросов, чтобы потом убрать их из pending
+        tried = []
+        try:
+            for _ in range(self.retries + 1):
+                primary = self.upstreams.choose(exclude=tried)
+                attempt = [primary]
+                self.send_query(primary, question, key, waiter, sent)
+                wait = self.timeout
+                if self.hedge:
+                    delay = self.upstreams.hedge_delay(primary)
+                    second = None
+                    if not waiter.event.wait(delay):
+                        second = self.upstreams.other(primary)
+                    if second is not None:
+                        attempt.append(second)
+                        self.send_query(second, question, key, waiter, sent)
+                    else:
+                        wait -= delay  # Второго не спросили - первый ждем до конца его таймаута
+                if waiter.event.wait(wait):
+                    data, stats = waiter.response
+                    if len(attempt) > 1:
+                        self.upstreams.count_hedge(stats is not primary)
+                    if is_truncated(data):
+                        return self.tcp[stats.address].query(question)  # Ответ обрезан - переспрашиваем по TCP
+                    return data
+                for stats in attempt:
+                    if stats not in tried:
+                        self.upstreams.failed(stats)
+                tried.extend(attempt)
+            return None
+        finally:
+            with self.lock:
+                for match in sent:
+                    self.pending.pop(match, None)
+
+    def send_query(self, stats, question, key, waiter, sent):
+        with self.lock:
+            packet_id = new_packet_id(self.pending, key)
+            self.pending[(packet_id, key)] = (waiter, stats, time.monotonic())
+        sent.append((packet_id, key))
+        self.upstreams.sent(stats)
+        try:
+            self.send(make_request(packet_id, question, self.payload), stats.address)
+        except OSError:
+            pass  # Сокет могли закрыть под нами - для нас это как потерянный пакет
+
+    def send(self, data, address):
+        """Отправляет запрос через случайный сокет пула"""
+        index = random.randrange(len(self.sockets))
+        self.sockets[index].sendto(data, address)
+        self.uses[index] += 1
+        if self.uses[index] >= self.rotate_after:
+            self.to_rotate.add(index)  # Пересоздаст поток-приемник
+
+    def rotate(self):
+        """Заменяет заезженные сокеты новыми. Старый сокет еще какое-то время
+        слушаем, чтобы не потерять ответы на уже отправленные через него запросы"""
+        while self.to_rotate:
+            index = self.to_rotate.pop()
+            old = self.sockets[index]
+            self.sockets[index] = self.open_socket()
+            self.uses[index] = 0
+            self.retiring.append((time.monotonic() + self.timeout, old))
+        now = time.monotonic()
+        while self.retiring and self.retiring[0][0] < now:
+            _, old = self.retiring.pop(0)
+            self.selector.unregister(old)
+            old.close()
+
+    def receive_loop(self):
+        """Поток-приемник: читает ответы со всех сокетов пула и будит тех, кто их ждет"""
+        while self.running:
+            self.rotate()
+            for selector_key, _ in self.selector.select(0.5):
+                sock = selector_key.fileobj
+                while True:
+                    try:
+                        data, addr = sock.recvfrom(65535)
+                    except (BlockingIOError, OSError):
+                        break
+                    match = reply_key(data)
+                    if match is None:
+                        continue
+                    with self.lock:
+                        entry = self.pending.get(match)
+                        if entry is None or entry[1].address != addr:
+                            continue  # Ответ не от того форвардера, которого спрашивали, игнорируем
+                        del self.pending[match]
+                    waiter, stats, sent_at = entry
+                    self.upstreams.answered(stats, time.monotonic() - sent_at)
+                    if not waiter.event.is_set():
+                        waiter.set((data, stats))
+
+    def close(self):
+        """Останавливает поток-приемник и закрывает сокеты"""
+        self.running = False
+        self.receiver.join()
+        for sock in self.sockets + [old for _, old in self.retiring]:
+            sock.close()
+        self.selector.close()
+        for tcp in self.tcp.values():
+            tcp.close()
+
+
+class TcpUpstream:
+    """Долгоживущее TCP-соединение с форвардером. Запросы идут по нему конвейером: каждый поток
+    пишет свой запрос и ждет, а поток-читатель раздает ответы по ключу (идентификатор пакета, вопрос).
+    Соединение открывается при первом запросе и переоткрывается, если форвардер его закрыл"""
+    def __init__(self, address, payload=DEFAULT_UDP_PAYLOAD, timeout=UPSTREAM_TCP_TIMEOUT):
+        self.address = address
+        self.payload = payload
+        self.timeout = timeout
+        self.lock = threading.Lock()  # Защищает соединение и pending (и не дает запросам перемешаться при записи)
+        self.sock = None
+        self.pending = {}  # (packet_id, ключ вопроса) -> Waiter
+
+    def connect(self):
+        """Открывает соединение и запускает для него поток-читатель. Вызывать под локом"""
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.settimeout(None)  # Читатель ждет ответов сколько угодно, таймауты считают сами запросы
+        self.sock = sock
+        threading.Thread(target=self.receive_loop, args=(sock,), name='UpstreamTcpReceiver', daemon=True).start()
+
+    def query(self, question):
+        """Задает вопрос форвардеру по TCP и возвращает сырой ответ (или None).
+        Если соединение оборвалось (форвардер закрывает простаивающие), один раз пробуем через новое"""
+        key = question_key(question)
+        for _ in range(2):
+            waiter = Waiter()
+            with self.lock:
+                packet_id = new_packet_id(self.pending, key)
+                self.pending[(packet_id, key)] = waiter
+            sock = None
+            try:
+                with self.lock:
+                    if self.sock is None:
+                        self.connect()
+                    sock = self.sock
+                    sock.sendall(frame(make_request(packet_id, question, self.payload)))
+                if waiter.event.wait(self.timeout) and waiter.response is not None:
+                    return waiter.response
+            except OSError:
+                with self.lock:
+                    self.drop(sock)  # Заодно разбудит и нас, и мы попробуем еще раз через новое соединение
+            finally:
+                with self.lock:
+                    self.pending.pop((packet_id, key), None)
+            if not waiter.event.is_set():
+                return None  # Просто не дождались - второй раз ждать столько же смысла нет
+        return None
+
+    def drop(self, sock):
+        """Забывает соединение (если оно все еще текущее) и будит всех, кто ждал по нему ответа. Вызывать под локом"""
+        if sock is None or sock is not self.sock:
+            return
+        self.sock = None
+        sock.close()
+        for waiter in self.pending.values():
+            waiter.set(None)
+
+    def receive_loop(self, sock):
+        """Поток-читатель одного соединения"""
+        while True:
+            try:
+                data = recv_message(sock)
+            except OSError:
+                data = None
+            if data is None:
+                with self.lock:
+                    self.drop(sock)
+                return
+            match = reply_key(data)
+            if match is None:
+                continue
+            with self.lock:
+                waiter = self.pending.pop(match, None)
+            if waiter is not None:
+                waiter.set(bytes(data))
+
+    def close(self):
+        with self.lock:
+            self.drop(self.sock)
+
+
+class SingleFlight:
+    """Склейка одинаковых промахов кэша (single-flight).
+    Когда популярная запись протухает, все потоки, которые ее спросили, промахиваются одновременно.
+    Чтобы они не завалили форвардер одинаковыми запросами, к форвардеру идет только первый,
+    а остальные ждут его результат"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # ключ вопроса -> Waiter, в который первый поток положит результат
+        self.sent = 0  # Сколько запросов реально ушло к форвардеру
+        self.saved = 0  # Сколько запросов к форвардеру мы сэкономили
+
+    def do(self, key, function):
+        """Вызывает function для ключа, если по нему еще никто не работает,
+        иначе ждет и возвращает результат того, кто работает"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Waiter()
+                self.sent += 1
+            else:
+                self.saved += 1
+        if not leader:
+            flight.event.wait()
+            return flight.response
+        result = None
+        try:
+            result = function()
+            return result
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.set(result)  # Будим всех ждущих (даже если у нас все упало - тогда им достанется None)
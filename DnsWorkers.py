@@ -0,0 +1,109 @@
+import multiprocessing
+from DnsCache import DEFAULT_STALE_WINDOW
+from DnsSharedCache import SharedDnsCache, DEFAULT_SLOTS
+from DnsUpstream import parse_forwarder
+from DnsTcp import DNS_PORT
+
+
+"""Режим нескольких процессов-воркеров. Из-за GIL один процесс питона упирается в одно ядро,
+сколько потоков ему ни дай. Поэтому запускаем несколько процессов, и каждый вешает свой сокет
+на 53 порт с SO_REUSEPORT - ядро само раскидывает запросы клиентов между ними.
+Кэш у воркеров общий (DnsSharedCache), так что ответ, полученный одним воркером от форвардера,
+сразу достается и остальным. Консоль остается у главного процесса, он рассылает команды воркерам по Pipe."""
+"""ПОЯСНЕНИЕ! Кэш готовых ответов (ResponseCache) у каждого воркера свой. Об изменениях в общем кэше,
+сделанных другими воркерами, он не узнает, поэтому готовый ответ может прожить до истечения своего TTL."""
+
+
+def worker_main(index, forwarders, engine, cache_args, options, connection):
+    """Точка входа процесса-воркера"""
+    import DnsServer  # Импортируем здесь, иначе DnsServer и DnsWorkers импортируют друг друга
+    cache = SharedDnsCache(*cache_args)
+    if options.get('metrics_port'):
+        options = dict(options, metrics_port=options['metrics_port'] + index)  # Порт метрик у каждого свой
+    if options.get('query_log'):
+        options = dict(options, query_log='{}-{}'.format(options['query_log'], index))  # И лог запросов
+    try:
+        """Рекурсию уже проверил главный процесс, второй раз не проверяем"""
+        server = DnsServer.DnsServer(forwarders, engine, cache=cache, reuse_port=True, check=False,
+                                     **options)
+    except Exception as ex:
+        connection.send(str(ex))  # Рассказываем главному процессу, почему не взлетели
+        cache.close()
+        return
+    server.start()
+    connection.send(None)  # Все хорошо, готовы работать
+    while True:
+        cmd = connection.recv()
+        if cmd == 'exit':
+            server.shutdown()
+            cache.close()
+            connection.send('Worker {} stopped'.format(index))
+            return
+        connection.send(server.run_command(cmd))
+
+
+class WorkerPool:
+    """Пачка процессов-воркеров с общим кэшем"""
+    def __init__(self, forwarders, engine='threads', workers=2, slots=DEFAULT_SLOTS, options=None,
+                 stale_window=DEFAULT_STALE_WINDOW):
+        self.forwarders = forwarders
+        self.engine = engine
+        self.workers = workers
+        self.options = options or {}  # Остальные настройки сервака (см. DnsServer.server_options)
+        """spawn, а не fork: у главного процесса к этому моменту уже могут быть потоки и открытые сокеты"""
+        self.context = multiprocessing.get_context('spawn')
+        self.cache = SharedDnsCache.create(self.context, slots, stale_window)
+        self.processes = []
+        self.connections = []  # Концы Pipe-ов на стороне главного процесса
+
+    def start(self):
+        """Проверяет рекурсию и запускает воркеров. Если хоть один не взлетел - выкидываем ошибку"""
+        import DnsServer  # См. worker_main
+        """Проверяем на временном сокете: с SO_REUSEPORT он не помешает воркерам занять порт"""
+        serve_socket = DnsServer.make_serve_socket(reuse_port=True, port=self.options.get('port', DNS_PORT))
+        try:
+            DnsServer.check_recursion([parse_forwarder(forwarder) for forwarder in self.forwarders],
+                                      serve_socket)
+        finally:
+            serve_socket.close()
+        for index in range(self.workers):
+            parent_connection, child_connection = self.context.Pipe()
+            process = self.context.Process(
+                target=worker_main, name='Worker-{}'.format(index),
+                args=(index, self.forwarders, self.engine, self.cache.attach_args(), self.options,
+                      child_connection))
+            process.start()
+            self.processes.append(process)
+            self.connections.append(parent_connection)
+        errors = [error for error in (connection.recv() for connection in self.connections) if error]
+        if errors:
+            self.stop()
+            raise Exception(errors[0])
+
+    def run_command(self, cmd):
+        """Рассылает команду всем воркерам и собирает их ответы в один текст"""
+        output = []
+        for index, connection in enumerate(self.connections):
+            connection.send(cmd)
+            reply = connection.recv()
+            if reply is not None:
+                output.append('Worker {}: {}'.format(index, reply))
+        return '\n'.join(output) or None
+
+    def stop(self):
+        """Грамотно закрывает всех воркеров"""
+        for process, connection in zip(self.processes, self.connections):
+            if process.is_alive():
+                try:
+                    connection.send('exit')
+                    connection.recv()
+                except (EOFError, OSError):
+                    pass  # Воркер уже умер сам
+            process.join()
+            connection.close()
+        self.processes = []
+        self.connections = []
+
+    def close(self):
+        """Удаляет общую память. Вызывать после stop"""
+        self.cache.close(unlink=True)
@@ -0,0 +1,28 @@
+import json
+import sys
+
+
+"""Сравнение двух прогонов бенчмарка (JSON от micro_bench.py, load_bench.py или replay.py).
+Запуск: python bench/compare.py before.json after.json"""
+
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python bench/compare.py before.json after.json')
+        exit(-1)
+    before, after = load(sys.argv[1]), load(sys.argv[2])
+    if before['benchmark'] != after['benchmark']:
+        print('Warning: comparing {} with {}'.format(before['benchmark'], after['benchmark']))
+    print('{:40s} {:>12s} {:>12s} {:>8s}'.format('', before['run']['commit'] or 'before',
+                                                 after['run']['commit'] or 'after', 'change'))
+    for name, old in before['results'].items():
+        new = after['results'].get(name)
+        if old is None or new is None:
+            continue
+        change = '{:+.1f}%'.format((new - old) / old * 100) if old else ''
+        print('{:40s} {:12.3f} {:12.3f} {:>8s}'.format(name, old, new, change))
@@ -0,0 +1,179 @@
+import argparse
+import heapq
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DNSPacketParser import DNSPacket, DnsResource, MAX_TCP_MESSAGE
+from DnsTcp import recv_message, frame
+
+
+"""Поддельный форвардер для бенчмарков: отвечает на все сам, с заданной задержкой, потерями
+и размером ответа, чтобы прогоны не зависели ни от сети, ни от настоящих DNS-серваков.
+На любой вопрос отдает answers A-записей (и, если задано, TXT-запись на txt байт).
+Ответ, который не влезает в UDP клиента, уходит с флагом TC, а полный ответ можно забрать по TCP.
+Запуск отдельно: python bench/fake_upstream.py [--upstream-port 5300] [--latency 20] [--loss 0.01] ...
+Из load_bench.py запускается в том же процессе (класс FakeUpstream)."""
+
+FAKE_TTL = 30
+
+
+class FakeUpstream:
+    """Поддельный форвардер. Задержка делается не потоком на запрос, а кучей отложенных ответов,
+    которую разбирает один поток-отправитель: так тысячи запросов в секунду не плодят тысячи потоков"""
+    def __init__(self, host='127.0.0.1', port=5300, latency=0, jitter=0, loss=0, answers=1, txt=0,
+                 ttl=FAKE_TTL, seed=None):
+        self.latency = latency  # Задержка ответа в секундах
+        self.jitter = jitter  # К задержке добавляется случайное число от 0 до jitter
+        self.loss = loss  # Доля запросов, на которые не отвечаем
+        self.answers = answers
+        self.txt = txt
+        self.ttl = ttl
+        self.random = random.Random(seed)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, port))
+        self.udp.settimeout(0.5)  # Чтобы поток-приемник замечал остановку
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((host, port))
+        self.tcp.listen(16)
+        self.tcp.settimeout(0.5)
+        self.address = self.udp.getsockname()
+        self.queue = []  # Куча из (когда отправить, порядковый номер, ответ, адрес)
+        self.queue_lock = threading.Condition()
+        self.running = False
+        self.queries = 0  # Сколько запросов пришло (и по UDP, и по TCP)
+        self.dropped = 0  # Сколько из них мы "потеряли"
+        self.truncated = 0  # Сколько ответов ушло с флагом TC
+
+    def start(self):
+        self.running = True
+        for target in (self.receive_loop, self.send_loop, self.accept_loop):
+            threading.Thread(target=target, name='FakeUpstream', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        with self.queue_lock:
+            self.queue_lock.notify()
+        self.udp.close()
+        self.tcp.close()
+
+    def make_response(self, data):
+        """Собирает полный ответ на запрос. Битые запросы игнорируем (None)"""
+        try:
+            request = DNSPacket.from_bytes(data, lazy=False)
+            question = request.question[0]
+        except Exception:
+            return None, None
+        answer = [DnsResource(question.q_name, 1, 1, self.ttl, bytes([10, 0, i >> 8 & 0xff, i & 0xff]))
+                  for i in range(self.answers)]
+        if self.txt:
+            chunks = bytearray()
+            for start in range(0, self.txt, 255):  # В TXT строки не длиннее 255 байт
+                chunk = b'x' * min(255, self.txt - start)
+                chunks.append(len(chunk))
+                chunks.extend(chunk)
+            answer.append(DnsResource(question.q_name, 16, 1, self.ttl, bytes(chunks)))
+        response = DNSPacket(request.packet_id, 0x8180, [question], answer, [], [])
+        return request, response
+
+    def receive_loop(self):
+        while self.running:
+            try:
+                data, addr = self.udp.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self.queries += 1
+            if self.loss and self.random.random() < self.loss:
+                self.dropped += 1
+                continue
+            request, response = self.make_response(data)
+            if response is None:
+                continue
+            raw = response.to_bytes()
+            if len(raw) > request.udp_limit(MAX_TCP_MESSAGE):  # Сколько клиент готов принять по UDP
+                self.truncated += 1
+                raw = response.truncated().to_bytes()
+            delay = self.latency + self.random.random() * self.jitter
+            with self.queue_lock:
+                heapq.heappush(self.queue, (time.monotonic() + delay, self.queries, bytes(raw), addr))
+                self.queue_lock.notify()
+
+    def send_loop(self):
+        while self.running:
+            with self.queue_lock:
+                while self.running and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    self.queue_lock.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                if not self.running:
+                    return
+                _, _, raw, addr = heapq.heappop(self.queue)
+            try:
+                self.udp.sendto(raw, addr)
+            except OSError:
+                return
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                connection, _ = self.tcp.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            threading.Thread(target=self.serve_tcp, args=(connection,), daemon=True).start()
+
+    def serve_tcp(self, connection):
+        """По TCP ответы не теряем и отдаем целиком (задержка та же)"""
+        try:
+            while True:
+                data = recv_message(connection)
+                if data is None:
+                    break
+                self.queries += 1
+                _, response = self.make_response(bytes(data))
+                if response is None:
+                    continue
+                time.sleep(self.latency + self.random.random() * self.jitter)
+                connection.sendall(frame(bytes(response.to_bytes())))
+        except OSError:
+            pass
+        connection.close()
+
+
+def add_arguments(parser):
+    """Параметры поддельного форвардера (их же принимает load_bench.py)"""
+    parser.add_argument('--upstream-port', type=int, default=5300, help='порт поддельного форвардера')
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=0, help='случайная добавка к задержке, до стольких мс')
+    parser.add_argument('--loss', type=float, default=0, help='доля запросов, которые теряются (0..1)')
+    parser.add_argument('--answers', type=int, default=1, help='сколько A-записей в ответе')
+    parser.add_argument('--txt', type=int, default=0, help='добавить в ответ TXT-запись на столько байт')
+    parser.add_argument('--ttl', type=int, default=FAKE_TTL, help='TTL записей в ответе')
+
+
+def from_arguments(args, seed=None):
+    return FakeUpstream('127.0.0.1', args.upstream_port, args.latency / 1000, args.jitter / 1000, args.loss,
+                        args.answers, args.txt, args.ttl, seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Поддельный форвардер для бенчмарков')
+    add_arguments(parser)
+    parser.add_argument('--seed', type=int, default=None, help='зерно для потерь и задержек')
+    args = parser.parse_args()
+    upstream = from_arguments(args, args.seed).start()
+    print('Fake upstream on {}:{}'.format(*upstream.address))
+    try:
+        while True:
+            time.sleep(5)
+            print('queries {}, dropped {}, truncated {}'.format(upstream.queries, upstream.dropped,
+                                                               upstream.truncated))
+    except KeyboardInterrupt:
+        upstream.stop()
@@ -0,0 +1,258 @@
+import argparse
+import bisect
+import itertools
+import os
+import random
+import selectors
+import shlex
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DNSPacketParser import DNSPacket, DnsQuestion
+from fake_upstream import add_arguments, from_arguments
+from results import REPO_DIR, write_results
+
+
+"""Нагрузочный бенчмарк целиком на localhost: поднимает поддельный форвардер (fake_upstream.py),
+запускает DnsServer на отдельном порту и гоняет по нему запросы с распределением имен по Зипфу
+(немного очень популярных имен и длинный хвост редких - как у настоящих клиентов).
+Считает QPS, перцентили задержки, долю попаданий в кэш и память сервака.
+Запуск: python bench/load_bench.py [--duration 10] [--concurrency 64] [--json results.json]"""
+"""ПОЯСНЕНИЕ! Попадания в кэш считаем снаружи: каждый запрос, дошедший до поддельного форвардера, -
+это промах (или упреждающее обновление), остальные отвеченные запросы - попадания.
+Зерно случайности фиксировано, так что последовательность запросов от прогона к прогону одна и та же."""
+
+BENCH_PORT = 5353
+READY_TIMEOUT = 15  # Сколько ждем, пока сервак начнет отвечать
+NAME_TEMPLATE = 'n{}.zipf.bench.'
+ID_STRUCT = struct.Struct('>H')
+
+
+def zipf_weights(count, exponent):
+    """Накопленные веса рангов 1..count для распределения Зипфа (вероятность ранга k ~ 1 / k^exponent)"""
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def make_queries(names, exponent, seed):
+    """Бесконечная воспроизводимая последовательность запросов (без идентификатора - его вписываем при отправке)"""
+    rng = random.Random(seed)
+    weights = zipf_weights(names, exponent)
+    total = weights[-1]
+    templates = {}
+    while True:
+        rank = bisect.bisect_left(weights, rng.random() * total)
+        template = templates.get(rank)
+        if template is None:
+            question = DnsQuestion(NAME_TEMPLATE.format(rank), 1, 1)
+            template = templates[rank] = bytes(DNSPacket(0, 0x0100, [question], [], [], []).to_bytes())
+        yield template
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def process_rss(pid):
+    """Память процесса и всех его потомков (воркеров), в байтах. None, если /proc нет (не Linux)"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as file:
+            rss = next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmRSS:'))
+        try:
+            with open('/proc/{}/task/{}/children'.format(pid, pid)) as file:
+                children = [int(child) for child in file.read().split()]
+        except OSError:
+            children = []
+        return rss + sum(process_rss(child) or 0 for child in children)
+    except (OSError, StopIteration, ValueError):
+        return None
+
+
+class RssSampler(threading.Thread):
+    """Раз в interval секунд смотрит память сервака, запоминает максимум"""
+    def __init__(self, pid, interval=0.2):
+        super().__init__(name='RssSampler', daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.last = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = process_rss(self.pid)
+            if rss is not None:
+                self.last = rss
+                self.peak = max(self.peak or 0, rss)
+
+
+def ask(address, name, timeout):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(bytes(DNSPacket(1, 0x0100, [DnsQuestion(name, 1, 1)], [], [], []).to_bytes()), address)
+        sock.recv(65535)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def wait_ready(address, process):
+    """Ждет, пока сервак начнет отвечать (при старте он пару секунд проверяет, не указан ли форвардером он сам)"""
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise Exception('Server exited with code {}'.format(process.returncode))
+        if ask(address, 'ready.bench.', 0.5):
+            return
+    raise Exception('Server is not answering on {}:{}'.format(*address))
+
+
+def generate_load(address, queries, duration, concurrency, timeout):
+    """Держит concurrency запросов в полете в течение duration секунд.
+    Возвращает (отправлено, задержки отвеченных в секундах, потеряно, сколько секунд шла нагрузка)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    in_flight = {}  # идентификатор -> когда отправили (словарь упорядочен по времени отправки)
+    free_ids = list(range(0x10000))
+    random.Random(0).shuffle(free_ids)
+    latencies = []
+    sent = lost = 0
+    started = time.monotonic()
+    stop_at = started + duration
+    while True:
+        now = time.monotonic()
+        if now >= stop_at and not in_flight:
+            break
+        while in_flight:  # Выкидываем тех, кто не дождался
+            packet_id, sent_at = next(iter(in_flight.items()))
+            if now - sent_at < timeout:
+                break
+            del in_flight[packet_id]
+            free_ids.append(packet_id)
+            lost += 1
+        while now < stop_at and len(in_flight) < concurrency:
+            packet_id = free_ids.pop()
+            try:
+                sock.sendto(ID_STRUCT.pack(packet_id) + next(queries)[2:], address)
+            except BlockingIOError:
+                free_ids.append(packet_id)
+                break
+            in_flight[packet_id] = time.monotonic()
+            sent += 1
+        if not selector.select(0.01):
+            continue
+        while True:
+            try:
+                data = sock.recv(65535)
+            except BlockingIOError:
+                break
+            received_at = time.monotonic()
+            packet_id = ID_STRUCT.unpack_from(data, 0)[0]
+            sent_at = in_flight.pop(packet_id, None)
+            if sent_at is not None:
+                latencies.append(received_at - sent_at)
+                free_ids.append(packet_id)
+    selector.close()
+    sock.close()
+    return sent, latencies, lost, time.monotonic() - started
+
+
+def start_server(args, cache_dir):
+    command = [sys.executable, os.path.join(REPO_DIR, 'DnsServer.py'), '127.0.0.1:{}'.format(args.upstream_port),
+               '--port', str(args.port), '--engine', args.engine,
+               '--cache-file', os.path.join(cache_dir, 'cache'), '--snapshot-interval', '0']
+    command += shlex.split(args.server_args)
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+
+
+def stop_server(process):
+    try:
+        process.communicate('exit\n', timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run(args):
+    upstream = from_arguments(args, args.seed).start()
+    address = ('127.0.0.1', args.port)
+    cache_dir = tempfile.mkdtemp(prefix='dns-bench-')  # Каждый прогон - с пустым кэшем
+    process = None if args.external else start_server(args, cache_dir)
+    sampler = None
+    try:
+        wait_ready(address, process)
+        if process is not None:
+            sampler = RssSampler(process.pid)
+            sampler.start()
+        queries = make_queries(args.names, args.zipf, args.seed)
+        if args.warmup > 0:
+            generate_load(address, queries, args.warmup, args.concurrency, args.timeout)
+        upstream_before = upstream.queries
+        sent, latencies, lost, elapsed = generate_load(address, queries, args.duration, args.concurrency,
+                                                       args.timeout)
+        upstream_queries = upstream.queries - upstream_before
+    finally:
+        if sampler is not None:
+            sampler.stopped.set()
+        if process is not None:
+            stop_server(process)
+        upstream.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    latencies.sort()
+    answered = len(latencies)
+
+    def ms(value):
+        return None if value is None else value * 1000
+
+    return {
+        'sent': sent,
+        'answered': answered,
+        'lost': lost,
+        'qps': answered / elapsed,
+        'latency_p50_ms': ms(percentile(latencies, 0.5)),
+        'latency_p99_ms': ms(percentile(latencies, 0.99)),
+        'latency_p999_ms': ms(percentile(latencies, 0.999)),
+        'upstream_queries': upstream_queries,
+        'cache_hit_ratio': max(0.0, 1 - upstream_queries / answered) if answered else None,
+        'rss_peak_mb': sampler.peak / 2 ** 20 if sampler and sampler.peak else None,
+        'rss_end_mb': sampler.last / 2 ** 20 if sampler and sampler.last else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный бенчмарк DnsServer на localhost')
+    parser.add_argument('--port', type=int, default=BENCH_PORT, help='порт, на котором запускаем сервак')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--server-args', default='', help='дополнительные параметры серваку, одной строкой')
+    parser.add_argument('--external', action='store_true',
+                        help='не запускать сервак, а грузить уже запущенный на --port '
+                             '(форвардером у него должен быть 127.0.0.1:--upstream-port)')
+    parser.add_argument('--duration', type=float, default=10, help='сколько секунд грузим')
+    parser.add_argument('--warmup', type=float, default=0, help='сколько секунд грузим до замера')
+    parser.add_argument('--concurrency', type=int, default=64, help='сколько запросов держим в полете')
+    parser.add_argument('--timeout', type=float, default=2, help='через сколько секунд считаем запрос потерянным')
+    parser.add_argument('--names', type=int, default=10000, help='сколько разных имен спрашиваем')
+    parser.add_argument('--zipf', type=float, default=1.1, help='показатель распределения Зипфа')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='куда записать результаты')
+    add_arguments(parser)
+    args = parser.parse_args()
+    results = run(args)
+    for name, value in results.items():
+        print('{:20s} {}'.format(name, '-' if value is None else round(value, 3)))
+    if args.json:
+        write_results(args.json, 'load', vars(args), results)
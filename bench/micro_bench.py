@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, parse_address, pack_address
+from DnsCache import DnsCache, ResponseCache, make_key, parse_request_key
+from parser_bench import make_response
+from results import write_results
+
+
+"""Микробенчмарки горячего пути: парсинг и сборка пакетов, имена, операции обоих кэшей.
+Каждая операция меряется несколькими прогонами, берется лучший (меньше зависит от шума).
+Запуск: python bench/micro_bench.py [--number N] [--json results.json]"""
+
+CACHE_RECORDS = 10000  # Сколько записей в кэше, по которому меряем поиск
+
+
+def bench(results, name, function, number):
+    seconds = min(timeit.repeat(function, number=number, repeat=5))
+    results[name] = seconds / number * 1e6
+    print('{:40s} {:8.2f} us/op'.format(name, results[name]))
+
+
+def make_request(name):
+    return bytes(DNSPacket(0x4242, 0x0100, [DnsQuestion(name, 1, 1)], [], [], []).to_bytes())
+
+
+def fill_cache(cache, count):
+    """Кладет в кэш count имен по одной A-записи и возвращает вопросы к ним"""
+    questions = []
+    for i in range(count):
+        name = 'host{}.bench.example.'.format(i)
+        cache.put_resource(DnsResource(name, 1, 1, 3600, bytes([10, 0, i >> 8 & 0xff, i & 0xff])))
+        questions.append(DnsQuestion(name, 1, 1))
+    return questions
+
+
+def remember(cache, response_cache, question):
+    """Собирает ответ из кэша и кладет его в кэш готовых ответов (как DnsServer.remember_response)"""
+    resources = cache.get_resources(question)
+    response = DNSPacket(0, 0x8180, [question], resources, [], [])
+    raw = response.to_bytes()
+    ttl_fields = [(offset, cache.get_expire_time(resource)) for offset, resource in zip(response.ttl_offsets,
+                                                                                         resources)]
+    response_cache.put(make_key(question.q_name, 1, 1), raw, response.compression_saved, ttl_fields,
+                       {make_key(question.q_name, 1, 1)}, response_cache.generation)
+
+
+def run(number):
+    results = {}
+    raw = make_response()
+    packet = DNSPacket.from_bytes(raw, lazy=False)
+    name = pack_address('edge7.cdn.example.net.')
+    bench(results, 'DNSPacket.from_bytes (header + question)', lambda: DNSPacket.from_bytes(raw), number)
+    bench(results, 'DNSPacket.from_bytes (full)', lambda: DNSPacket.from_bytes(raw, lazy=False), number)
+    bench(results, 'DNSPacket.to_bytes', packet.to_bytes, number)
+    bench(results, 'parse_address', lambda: parse_address(name), number)
+    bench(results, 'pack_address', lambda: pack_address('edge7.cdn.example.net.'), number)
+
+    cache = DnsCache()
+    response_cache = ResponseCache(cache)
+    questions = fill_cache(cache, CACHE_RECORDS)
+    hit, miss = questions[CACHE_RECORDS // 2], DnsQuestion('missing.bench.example.', 1, 1)
+    bench(results, 'DnsCache.get_resources (hit)', lambda: cache.get_resources(hit), number)
+    bench(results, 'DnsCache.get_resources (miss)', lambda: cache.get_resources(miss), number)
+    resource = cache.get_resources(hit)[0]
+    bench(results, 'DnsCache.put_resource (refresh)', lambda: cache.put_resource(resource), number)
+    fresh = [DnsResource('new{}.bench.example.'.format(i), 1, 1, 3600, b'\x0a\x00\x00\x01')
+             for i in range(number * 5)]
+    inserts = iter(fresh)
+    bench(results, 'DnsCache.put_resource (new name)', lambda: cache.put_resource(next(inserts)), number)
+
+    remember(cache, response_cache, hit)
+    request = make_request(hit.q_name)
+    bench(results, 'parse_request_key', lambda: parse_request_key(request), number)
+    bench(results, 'ResponseCache.get (hit)', lambda: response_cache.get(request), number)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Микробенчмарки парсера и кэша')
+    parser.add_argument('--number', type=int, default=5000, help='сколько вызовов в одном прогоне')
+    parser.add_argument('--json', help='куда записать результаты (мкс на операцию)')
+    args = parser.parse_args()
+    results = run(args.number)
+    if args.json:
+        write_results(args.json, 'micro', {'number': args.number, 'cache_records': CACHE_RECORDS}, results)
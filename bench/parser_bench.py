@@ -0,0 +1,129 @@
+import io
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, DNS_HEADER_FORMAT, pack_address
+
+
+"""Микробенчмарк парсера: сравниваем DNSPacket.from_bytes на memoryview
+со старым парсером на io.BytesIO (он скопирован ниже как эталон).
+Запуск: python bench/parser_bench.py [число повторов]"""
+
+
+# Старый парсер, как он был до перехода на memoryview
+def legacy_parse_address(stream):
+    name = bytearray()
+    while True:
+        n = stream.read(1)[0]
+        if n & 0xC0:
+            m = stream.read(1)[0]
+            sub_name_offset = ((n & 0x3F) << 8) | m
+            current_offset = stream.tell()
+            stream.seek(sub_name_offset)
+            sub_name = legacy_parse_address(stream)
+            stream.seek(current_offset)
+            name.extend(sub_name)
+            return name
+        if not n:
+            break
+        name.extend(stream.read(n))
+        name.extend(b'.')
+    return name
+
+
+def legacy_parse_resource(stream):
+    r_name = legacy_parse_address(stream).decode()
+    r_type, r_class, r_ttl, r_len = struct.unpack('>HHIH', stream.read(10))
+    if r_type in [2, 5]:
+        r_data = pack_address(legacy_parse_address(stream).decode())
+    else:
+        r_data = stream.read(r_len)
+    return DnsResource(r_name, r_type, r_class, r_ttl, r_data)
+
+
+def legacy_from_bytes(raw_packet):
+    stream = io.BytesIO(raw_packet)
+    packet_id, flags, q_count, an_count, ns_count, ar_count = \
+        struct.unpack(DNS_HEADER_FORMAT, stream.read(12))
+    questions = []
+    for i in range(q_count):
+        q_name = legacy_parse_address(stream).decode()
+        q_type, q_class = struct.unpack('>HH', stream.read(4))
+        questions.append(DnsQuestion(q_name, q_type, q_class))
+    sections = []
+    for count in (an_count, ns_count, ar_count):
+        sections.append([legacy_parse_resource(stream) for i in range(count)])
+    return DNSPacket(packet_id, flags, questions, *sections)
+
+
+class PacketBuilder:
+    """Простенький сборщик пакета со сжатием имен, чтобы бенчмарк парсил
+    такой же пакет, какой приходит от настоящих серваков"""
+    def __init__(self):
+        self.data = bytearray(12)
+        self.offsets = {}  # суффикс имени -> смещение в пакете
+
+    def name(self, name):
+        labels = name.rstrip('.').split('.')
+        result = bytearray()
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:])
+            if suffix in self.offsets:
+                result += struct.pack('>H', 0xC000 | self.offsets[suffix])
+                return result
+            self.offsets[suffix] = len(self.data) + len(result)
+            result.append(len(labels[i]))
+            result += labels[i].encode()
+        result.append(0)
+        return result
+
+    def resource(self, name, r_type, ttl, r_data):
+        self.data += self.name(name)
+        if r_type in (2, 5):
+            header_offset = len(self.data)
+            self.data += bytes(10)
+            r_data = self.name(r_data)
+            struct.pack_into('>HHIH', self.data, header_offset, r_type, 1, ttl, len(r_data))
+        else:
+            self.data += struct.pack('>HHIH', r_type, 1, ttl, len(r_data))
+        self.data += r_data
+
+
+def make_response():
+    """Типичный ответ CDN: цепочка CNAME, несколько A, NS в authority и glue в additional,
+    все имена сжаты указателями"""
+    builder = PacketBuilder()
+    builder.data += builder.name('www.example.com.') + struct.pack('>HH', 1, 1)
+    builder.resource('www.example.com.', 5, 300, 'www.example.com.cdn.net.')
+    builder.resource('www.example.com.cdn.net.', 5, 60, 'edge7.cdn.net.')
+    for i in range(4):
+        builder.resource('edge7.cdn.net.', 1, 20, bytes([10, 0, 0, i]))
+    for i in range(2):
+        builder.resource('cdn.net.', 2, 3600, 'ns{}.cdn.net.'.format(i))
+    for i in range(2):
+        builder.resource('ns{}.cdn.net.'.format(i), 1, 3600, bytes([192, 0, 2, i]))
+    struct.pack_into(DNS_HEADER_FORMAT, builder.data, 0, 0x1234, 0x8180, 1, 6, 2, 2)
+    return bytes(builder.data)
+
+
+def bench(name, function, raw, number):
+    """Берем лучший из нескольких прогонов, чтобы меньше зависеть от шума"""
+    seconds = min(timeit.repeat(lambda: function(raw), number=number, repeat=5))
+    print('{:40s} {:8.2f} us/packet'.format(name, seconds / number * 1e6))
+    return seconds
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    raw = make_response()
+    """Убеждаемся, что оба парсера понимают пакет одинаково"""
+    new, old = DNSPacket.from_bytes(raw, lazy=False), legacy_from_bytes(raw)
+    assert [(r.r_name, r.r_type, r.r_ttl, bytes(r.r_data)) for r in new.answer + new.authority + new.additional] == \
+        [(r.r_name, r.r_type, r.r_ttl, bytes(r.r_data)) for r in old.answer + old.authority + old.additional]
+    legacy = bench('legacy BytesIO parser (full)', legacy_from_bytes, raw, number)
+    full = bench('memoryview parser (full)', lambda r: DNSPacket.from_bytes(r, lazy=False), raw, number)
+    lazy = bench('memoryview parser (header + question)', DNSPacket.from_bytes, raw, number)
+    print('speedup full: {:.1f}x, header + question: {:.1f}x'.format(legacy / full, legacy / lazy))
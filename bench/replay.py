@@ -0,0 +1,170 @@
+import argparse
+import os
+import random
+import selectors
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DnsQueryLog import read_log, FLAG_CACHED
+from fake_upstream import add_arguments, from_arguments
+from load_bench import BENCH_PORT, ID_STRUCT, RssSampler, percentile, wait_ready, start_server, stop_server
+from results import write_results
+
+
+"""Повтор настоящего трафика: берет бинарный лог запросов (DnsServer --query-log) и шлет те же запросы
+серваку в том же темпе (или в --speed раз быстрее; --speed 0 - так быстро, как сервак успевает отвечать).
+Как и load_bench.py, по умолчанию сам поднимает поддельный форвардер и сервак на localhost.
+Запуск: python bench/replay.py querylog.1 querylog [--speed 1] [--json results.json]"""
+"""ПОЯСНЕНИЕ! Нагрузка открытая: запрос уходит в свое время, даже если сервак не ответил на предыдущие
+(иначе тормозящий сервак сам бы себе снижал нагрузку, а в жизни клиенты так не делают).
+Но в полете одновременно не больше --concurrency запросов: при --speed 0 иначе весь лог разом
+переполнил бы буфер сокета сервака, и ядро выкинуло бы часть запросов. Запросы, пришедшие в лог по TCP,
+повторяются по UDP.
+Имена в логе настоящие, а отвечает на них поддельный форвардер, так что доля попаданий в кэш
+и задержки - как на том же трафике, но без сети и настоящих DNS-серваков."""
+
+
+def read_logs(paths, totals):
+    """Записи из всех файлов лога по порядку. По дороге считает, сколько их и сколько отвечено из кэша"""
+    for path in paths:
+        for record in read_log(path):
+            if len(record.query) < ID_STRUCT.size:
+                continue
+            totals['records'] += 1
+            totals['cached'] += bool(record.flags & FLAG_CACHED)
+            totals['span'] = record.time - totals.setdefault('first', record.time)
+            yield record
+
+
+def replay(address, records, speed, concurrency, timeout):
+    """Шлет запросы из records в темпе лога, ускоренном в speed раз.
+    Возвращает (отправлено, задержки отвеченных в секундах, потеряно, сколько секунд шла нагрузка)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    in_flight = {}  # идентификатор -> когда отправили (словарь упорядочен по времени отправки)
+    free_ids = list(range(0x10000))
+    random.Random(0).shuffle(free_ids)
+    latencies = []
+    sent = lost = 0
+    pending = next(records, None)
+    first = pending.time if pending is not None else 0
+    started = time.monotonic()
+    while pending is not None or in_flight:
+        now = time.monotonic()
+        while in_flight:  # Выкидываем тех, кто не дождался
+            packet_id, sent_at = next(iter(in_flight.items()))
+            if now - sent_at < timeout:
+                break
+            del in_flight[packet_id]
+            free_ids.append(packet_id)
+            lost += 1
+        while pending is not None and free_ids and len(in_flight) < concurrency:
+            if speed and started + (pending.time - first) / speed > now:
+                break  # Этому запросу еще рано
+            packet_id = free_ids.pop()
+            try:
+                sock.sendto(ID_STRUCT.pack(packet_id) + pending.query[ID_STRUCT.size:], address)
+            except BlockingIOError:
+                free_ids.append(packet_id)
+                break
+            in_flight[packet_id] = time.monotonic()
+            sent += 1
+            pending = next(records, None)
+        wait = 0.01
+        if speed and pending is not None:
+            wait = max(0, min(wait, started + (pending.time - first) / speed - time.monotonic()))
+        if not selector.select(wait):
+            continue
+        while True:
+            try:
+                data = sock.recv(65535)
+            except BlockingIOError:
+                break
+            received_at = time.monotonic()
+            packet_id = ID_STRUCT.unpack_from(data, 0)[0]
+            sent_at = in_flight.pop(packet_id, None)
+            if sent_at is not None:
+                latencies.append(received_at - sent_at)
+                free_ids.append(packet_id)
+    selector.close()
+    sock.close()
+    return sent, latencies, lost, time.monotonic() - started
+
+
+def run(args):
+    upstream = None if args.external else from_arguments(args).start()
+    address = ('127.0.0.1', args.port)
+    cache_dir = tempfile.mkdtemp(prefix='dns-replay-')  # Каждый прогон - с пустым кэшем
+    process = None if args.external else start_server(args, cache_dir)
+    sampler = None
+    totals = {'records': 0, 'cached': 0, 'span': 0}
+    try:
+        wait_ready(address, process)
+        if process is not None:
+            sampler = RssSampler(process.pid)
+            sampler.start()
+        upstream_before = upstream.queries if upstream is not None else 0
+        sent, latencies, lost, elapsed = replay(address, read_logs(args.logs, totals), args.speed,
+                                                args.concurrency, args.timeout)
+        upstream_queries = upstream.queries - upstream_before if upstream is not None else None
+    finally:
+        if sampler is not None:
+            sampler.stopped.set()
+        if process is not None:
+            stop_server(process)
+        if upstream is not None:
+            upstream.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    latencies.sort()
+    answered = len(latencies)
+
+    def ms(value):
+        return None if value is None else value * 1000
+
+    return {
+        'sent': sent,
+        'answered': answered,
+        'lost': lost,
+        'qps': answered / elapsed if elapsed else None,
+        'log_seconds': totals['span'],
+        'replay_seconds': elapsed,
+        'latency_p50_ms': ms(percentile(latencies, 0.5)),
+        'latency_p99_ms': ms(percentile(latencies, 0.99)),
+        'latency_p999_ms': ms(percentile(latencies, 0.999)),
+        'upstream_queries': upstream_queries,
+        'cache_hit_ratio': max(0.0, 1 - upstream_queries / answered) if answered and upstream_queries is not None
+        else None,
+        'logged_cache_hit_ratio': totals['cached'] / totals['records'] if totals['records'] else None,
+        'rss_peak_mb': sampler.peak / 2 ** 20 if sampler and sampler.peak else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Повтор трафика из лога запросов DnsServer --query-log')
+    parser.add_argument('logs', nargs='+', help='файлы лога (старые первыми: querylog.2 querylog.1 querylog)')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='во сколько раз быстрее, чем в логе (по умолчанию 1; 0 - так быстро, как получится)')
+    parser.add_argument('--port', type=int, default=BENCH_PORT, help='порт, на котором запускаем сервак')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--server-args', default='', help='дополнительные параметры серваку, одной строкой')
+    parser.add_argument('--external', action='store_true',
+                        help='не запускать сервак и поддельный форвардер, а слать запросы уже запущенному '
+                             'серваку на --port')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='сколько запросов может быть в полете (по умолчанию 64)')
+    parser.add_argument('--timeout', type=float, default=2, help='через сколько секунд считаем запрос потерянным')
+    parser.add_argument('--json', help='куда записать результаты')
+    add_arguments(parser)
+    args = parser.parse_args()
+    results = run(args)
+    for name, value in results.items():
+        print('{:24s} {}'.format(name, '-' if value is None else round(value, 3)))
+    if args.json:
+        write_results(args.json, 'replay', vars(args), results)
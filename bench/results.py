@@ -0,0 +1,39 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+"""Общее для бенчмарков: результаты пишутся в JSON вместе с тем, на чем и когда их намеряли,
+чтобы прогоны до и после изменения можно было сравнить (bench/compare.py)."""
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def git_commit():
+    """Коммит, на котором запущен бенчмарк (или None, если это не git-репозиторий)"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_info():
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def write_results(path, benchmark, config, results):
+    """Пишет результаты в файл path. Числа в results - то, что сравнивает compare.py"""
+    with open(path, 'w') as file:
+        json.dump({'benchmark': benchmark, 'run': run_info(), 'config': config, 'results': results},
+                  file, indent=2, ensure_ascii=False)
+    print('Results written to {}'.format(path), file=sys.stderr)
@@ -0,0 +1,86 @@
+import socket
+import struct
+import threading
+import time
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, HEADER_STRUCT, make_opt, pack_address
+
+
+"""Общее для тестов: сборка записей и пакетов и поддельный форвардер на localhost"""
+
+
+def a_record(name, ttl=60, last_byte=1):
+    """Запись A с адресом 10.0.0.last_byte"""
+    return DnsResource(name, 1, 1, ttl, bytes((10, 0, 0, last_byte)))
+
+
+def soa_record(zone, ttl=3600, minimum=300):
+    """Запись SOA зоны (serial, refresh, retry, expire - какие-нибудь, MINIMUM - minimum)"""
+    r_data = pack_address('ns1.' + zone) + pack_address('hostmaster.' + zone) + \
+        struct.pack('>IIIII', 2024010101, 3600, 900, 604800, minimum)
+    return DnsResource(zone, 6, 1, ttl, bytes(r_data))
+
+
+def header(q_count=1, an_count=0):
+    """Заголовок ответа с заданным числом вопросов и ответов - для пакетов, собранных руками"""
+    return bytearray(HEADER_STRUCT.pack(0x1234, 0x8180, q_count, an_count, 0, 0))
+
+
+def query(name, q_type=1, packet_id=0x4242, edns=None):
+    """Сырой запрос клиента с одним вопросом. edns - размер UDP-пакета в OPT (без него OPT не кладем)"""
+    return bytes(DNSPacket(packet_id, 0x0100, [DnsQuestion(name, q_type, 1)], [], [],
+                           [make_opt(edns)] if edns else []).to_bytes())
+
+
+def response(question, answers=(), authority=(), rcode=0, packet_id=1):
+    """Ответ форвардера на один вопрос"""
+    return DNSPacket(packet_id, 0x8180 | rcode, [question], list(answers), list(authority), [])
+
+
+def reply(request, answers=(), authority=(), rcode=0):
+    """Ответ на разобранный запрос request: тот же идентификатор и тот же вопрос"""
+    return response(request.question[0], answers, authority, rcode, request.packet_id)
+
+
+def wait_until(condition, timeout=2):
+    """Ждет, пока condition() не станет истинным (другие потоки делают свое дело). False - не дождались"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class FakeUpstream(threading.Thread):
+    """Поддельный форвардер. На каждый запрос зовет answer(разобранный запрос) и отправляет, что она вернула
+    (DNSPacket или сырые байты), None - промолчать. По умолчанию отвечает записью A 10.0.0.1"""
+    def __init__(self, answer=None):
+        super().__init__(name='FakeUpstream', daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.05)
+        self.address = self.sock.getsockname()
+        self.answer = answer or (lambda request: reply(request, [a_record(request.question[0].q_name)]))
+        self.requests = []  # (разобранный запрос, адрес, с которого он пришел)
+        self.running = True
+        self.start()
+
+    def run(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            request = DNSPacket.from_bytes(data)
+            self.requests.append((request, addr))
+            response = self.answer(request)
+            if response is None:
+                continue
+            if isinstance(response, DNSPacket):
+                response = response.to_bytes()
+            self.sock.sendto(bytes(response), addr)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
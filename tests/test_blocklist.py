@@ -0,0 +1,172 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from DNSPacketParser import DnsQuestion
+from DnsBlocklist import Blocklist, compile_feeds, parse_feed_line, name_hash, bloom_bits, sinkhole_records, \
+    KIND_EXACT, KIND_SUBTREE, BLOCKED_TTL
+
+
+"""Тесты блоклиста: разбор фидов, компиляция и поиск через фильтр Блума и массив хэшей"""
+
+FEED = '''# adblock и просто домены - с поддоменами
+ads.example.com
+||tracker.example.net^
+*.malware.test
+Ads.Example.com.
+! комментарий adblock
+0.0.0.0 exact.example.org another.example.org
+127.0.0.1 localhost
+not a domain line
+'''
+
+
+class FeedLineTest(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(parse_feed_line('Ads.Example.COM.'), [('ads.example.com', KIND_SUBTREE)])
+        self.assertEqual(parse_feed_line('||tracker.example.net^'), [('tracker.example.net', KIND_SUBTREE)])
+        self.assertEqual(parse_feed_line('*.malware.test'), [('malware.test', KIND_SUBTREE)])
+        self.assertEqual(parse_feed_line('0.0.0.0 a.example b.example # x'),
+                         [('a.example', KIND_EXACT), ('b.example', KIND_EXACT)])
+        self.assertEqual(parse_feed_line('127.0.0.1 localhost'), [])
+        self.assertEqual(parse_feed_line('# comment'), [])
+        self.assertEqual(parse_feed_line('! adblock comment'), [])
+        self.assertIsNone(parse_feed_line('two words'))
+        self.assertIsNone(parse_feed_line('under..dots.com'))
+
+
+class BlocklistTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        feed = os.path.join(cls.directory, 'feed.txt')
+        with open(feed, 'w', encoding='utf-8') as file:
+            file.write(FEED)
+        cls.path = os.path.join(cls.directory, 'blocklist.bin')
+        cls.rules, cls.skipped = compile_feeds([feed], cls.path)
+        cls.blocklist = Blocklist(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_compiled(self):
+        self.assertEqual(self.rules, 5)  # Повтор ads.example.com в другом регистре не считается
+        self.assertEqual(self.skipped, 1)
+        self.assertEqual(self.blocklist.entries, 5)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_subtree_rules(self):
+        for name in ('ads.example.com', 'ADS.example.com.', 'x.ads.example.com', 'a.b.c.ads.example.com',
+                     'tracker.example.net', 'pixel.tracker.example.net', 'malware.test', 'x.malware.test'):
+            self.assertTrue(self.blocklist.blocked(name), name)
+
+    def test_exact_rules(self):
+        self.assertTrue(self.blocklist.blocked('exact.example.org'))
+        self.assertTrue(self.blocklist.blocked('another.example.org.'))
+        self.assertFalse(self.blocklist.blocked('sub.exact.example.org'))  # Строки hosts - только само имя
+
+    def test_allowed(self):
+        for name in ('example.com', 'com', 'notads.example.com', 'ads.example.com.evil.org', 'example.org',
+                     'localhost', '', '.'):
+            self.assertFalse(self.blocklist.blocked(name), name)
+
+    def test_keys_sorted_and_in_bloom(self):
+        keys = list(self.blocklist.keys)
+        self.assertEqual(keys, sorted(keys))
+        for key in keys:
+            self.assertTrue(all(self.blocklist.bloom[bit >> 3] >> (bit & 7) & 1
+                                for bit in bloom_bits(key, self.blocklist.bits, self.blocklist.hashes)))
+            self.assertTrue(self.blocklist.contains(key))
+        self.assertEqual(set(keys), {name_hash('ads.example.com') | KIND_SUBTREE,
+                                     name_hash('tracker.example.net') | KIND_SUBTREE,
+                                     name_hash('malware.test') | KIND_SUBTREE,
+                                     name_hash('exact.example.org') | KIND_EXACT,
+                                     name_hash('another.example.org') | KIND_EXACT})
+
+    def test_kind_matters(self):
+        self.assertFalse(self.blocklist.contains(name_hash('exact.example.org') | KIND_SUBTREE))
+        self.assertFalse(self.blocklist.contains(name_hash('ads.example.com') | KIND_EXACT))
+
+
+class LargeBlocklistTest(unittest.TestCase):
+    """Фильтр Блума на десятках тысяч имен: ложные "может быть" редки, и их отсекает массив хэшей"""
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        feed = os.path.join(cls.directory, 'feed.txt')
+        cls.names = ['host{}.blocked{}.test'.format(i, i % 97) for i in range(20000)]
+        with open(feed, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(cls.names))
+        cls.path = os.path.join(cls.directory, 'blocklist.bin')
+        compile_feeds([feed], cls.path)
+        cls.blocklist = Blocklist(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_all_blocked(self):
+        for name in self.names:
+            self.assertTrue(self.blocklist.blocked(name))
+
+    def test_bloom_false_positives(self):
+        rng = random.Random(1)
+        maybe = 0
+        trials = 20000
+        for _ in range(trials):
+            key = rng.getrandbits(64) & ~1 | KIND_SUBTREE
+            if all(self.blocklist.bloom[bit >> 3] >> (bit & 7) & 1
+                   for bit in bloom_bits(key, self.blocklist.bits, self.blocklist.hashes)):
+                maybe += 1
+            self.assertFalse(self.blocklist.contains(key))  # "Может быть" фильтра проверяет массив
+        self.assertLess(maybe / trials, 0.03)
+
+    def test_unrelated_names(self):
+        self.assertFalse(any(self.blocklist.blocked('host{}.allowed.test'.format(i)) for i in range(2000)))
+
+
+class BlocklistFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def test_not_a_blocklist(self):
+        with self.assertRaises(ValueError):
+            Blocklist(self.write('junk.bin', b'x' * 100))
+
+    def test_truncated(self):
+        feed = self.write('feed.txt', b'ads.example.com\n')
+        path = os.path.join(self.directory, 'blocklist.bin')
+        compile_feeds([feed], path)
+        with open(path, 'rb') as file:
+            data = file.read()
+        with self.assertRaises(ValueError):
+            Blocklist(self.write('short.bin', data[:-3]))
+
+    def test_empty(self):
+        path = os.path.join(self.directory, 'empty.bin')
+        self.assertEqual(compile_feeds([self.write('feed.txt', b'# nothing\n')], path), (0, 0))
+        self.assertFalse(Blocklist(path).blocked('ads.example.com'))
+
+
+class SinkholeTest(unittest.TestCase):
+    def test_records_by_type(self):
+        addresses = ('0.0.0.0', '::')
+        record, = sinkhole_records(DnsQuestion('ads.example.com.', 1, 1), addresses)
+        self.assertEqual((record.r_name, record.r_ttl, bytes(record.r_data)),
+                         ('ads.example.com.', BLOCKED_TTL, bytes(4)))
+        record, = sinkhole_records(DnsQuestion('ads.example.com.', 28, 1), addresses)
+        self.assertEqual(bytes(record.r_data), bytes(16))
+        self.assertEqual(sinkhole_records(DnsQuestion('ads.example.com.', 15, 1), addresses), [])  # NODATA
+
+
+if __name__ == '__main__':
+    unittest.main()
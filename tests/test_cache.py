@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+from DNSPacketParser import DnsQuestion
+from DnsCache import DnsCache, make_key, record_size, bucket_size
+from tests.helpers import a_record
+
+
+"""Тесты кэша записей: поиск по ключу (имя, тип, класс), выкидывание протухших записей через кучу
+и вытеснение давно не использованных ключей, когда кэш не влезает в память"""
+
+NOW = 1000000.0
+
+
+class DnsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DnsCache(stale_window=0)  # Протухшее выкидываем сразу (serve-stale - в test_serve_stale)
+        self.now = NOW
+        patcher = mock.patch('DnsCache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, name, q_type=1):
+        return self.cache.get_resources(DnsQuestion(name, q_type, 1))
+
+    def test_lookup_by_key(self):
+        self.cache.put_resource(a_record('www.e1.ru.', 60))
+        self.assertEqual(self.get('WWW.E1.RU.'), [a_record('www.e1.ru.', 60)])  # Имена регистронезависимы
+        self.assertEqual(self.get('www.e1.ru.', q_type=28), [])
+        self.assertEqual(self.get('e1.ru.'), [])
+
+    def test_duplicate_is_stored_once(self):
+        self.cache.put_resource(a_record('www.e1.ru.', 60))
+        self.cache.put_resource(a_record('www.e1.ru.', 60))
+        self.cache.put_resource(a_record('www.e1.ru.', 60, last_byte=2))
+        self.assertEqual(len(self.get('www.e1.ru.')), 2)
+
+    def test_records_expire_one_by_one(self):
+        for index, ttl in enumerate((30, 10, 50, 20, 40)):
+            self.cache.put_resource(a_record('www.e1.ru.', ttl, last_byte=index))
+        for elapsed in range(1, 60, 5):
+            self.now = NOW + elapsed
+            self.assertEqual(sorted(record.r_ttl for record in self.get('www.e1.ru.')),
+                             [ttl for ttl in (10, 20, 30, 40, 50) if ttl > elapsed])
+
+    def test_expired_record_can_be_cached_again(self):
+        self.cache.put_resource(a_record('www.e1.ru.', 10))
+        self.now = NOW + 20
+        self.assertEqual(self.get('www.e1.ru.'), [])
+        self.cache.put_resource(a_record('www.e1.ru.', 10))
+        self.now = NOW + 25
+        self.assertEqual(len(self.get('www.e1.ru.')), 1)  # Хвост старой записи в куче не выкинул новую
+
+    def test_other_keys_survive(self):
+        self.cache.put_resource(a_record('short.e1.ru.', 10))
+        self.cache.put_resource(a_record('long.e1.ru.', 100))
+        self.now = NOW + 50
+        self.assertEqual(self.get('short.e1.ru.'), [])
+        self.assertEqual(len(self.get('long.e1.ru.')), 1)
+        self.assertEqual(len(self.cache.expire_heap), 1)  # Протухшее снято с кучи
+
+
+def key_size(name):
+    """Сколько памяти кэш насчитывает на ключ с одной записью A"""
+    return record_size(a_record(name, 60)) + bucket_size(make_key(name, 1, 1))
+
+
+class LruEvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.size = key_size('host0.e1.ru.')  # У всех hostN.e1.ru. с однозначным N размер одинаковый
+        self.cache = DnsCache(max_memory=self.size * 3 + self.size // 2)
+        self.changed = []
+        self.cache.add_listener(self.changed.append)
+
+    def put(self, index):
+        self.cache.put_resource(a_record('host{}.e1.ru.'.format(index), 60))
+
+    def cached(self):
+        return [index for index in range(10)
+                if self.cache.get_resources(DnsQuestion('host{}.e1.ru.'.format(index), 1, 1))]
+
+    def test_memory_accounting(self):
+        self.put(0)
+        self.put(1)
+        self.put(1)  # Повтор места не занимает
+        self.assertEqual(self.cache.memory, 2 * self.size)
+        self.assertEqual(self.cache.records, 2)
+
+    def test_least_recently_used_key_goes_first(self):
+        for index in range(3):
+            self.put(index)
+        self.cache.get_resources(DnsQuestion('host0.e1.ru.', 1, 1))  # host0 теперь использован недавно
+        self.put(3)
+        self.assertEqual(self.changed[-1], make_key('host1.e1.ru.', 1, 1))  # Ответы из host1 надо выкинуть
+        self.assertEqual(self.cache.evicted, 1)
+        self.assertEqual(self.cached(), [0, 2, 3])
+        self.assertLessEqual(self.cache.memory, self.cache.max_memory)
+
+    def test_heap_is_rebuilt(self):
+        """Вытесненные записи с большим TTL не копятся в куче хвостами"""
+        for index in range(5000):
+            self.cache.put_resource(a_record('host{}.e1.ru.'.format(index % 10), 3600, last_byte=index % 250))
+            self.assertLessEqual(len(self.cache.expire_heap), 2 * self.cache.records + 1025)
+        self.assertLessEqual(self.cache.memory, self.cache.max_memory)
+
+    def test_unlimited(self):
+        self.cache = DnsCache(max_memory=None)
+        for index in range(10):
+            self.put(index)
+        self.assertEqual(self.cached(), list(range(10)))
+        self.assertEqual(self.cache.evicted, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from DNSPacketParser import DnsQuestion
+from DnsCache import DnsCache, NXDOMAIN
+from DnsCacheFile import FILE_MAGIC, ENTRY_STRUCT, save_snapshot, load_snapshot
+from tests.helpers import a_record, soa_record
+
+
+"""Тесты снимков кэша: что записали, то и прочитали, а протухшее и битое - пропустили"""
+
+NOW = 1000000.0
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.now = NOW
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cache')
+
+    def restored(self, cache):
+        save_snapshot(cache, self.path)
+        restored = DnsCache()
+        return restored, load_snapshot(restored, self.path)
+
+    def test_round_trip(self):
+        cache = DnsCache()
+        cache.put_resource(a_record('www.e1.ru.', ttl=60))
+        cache.put_resource(a_record('www.e1.ru.', ttl=600, last_byte=2))
+        cache.put_negative(DnsQuestion('nope.e1.ru.', 1, 1), NXDOMAIN, soa_record('e1.ru.'))
+        restored, count = self.restored(cache)
+        self.assertEqual(count, 3)
+        self.assertEqual(sorted(restored.entries(), key=lambda entry: entry[0]),
+                         sorted(cache.entries(), key=lambda entry: entry[0]))  # Времена протухания - те же
+        rcode, soa, expire_time = restored.get_negative(DnsQuestion('nope.e1.ru.', 28, 1))
+        self.assertEqual((rcode, soa, expire_time), (NXDOMAIN, soa_record('e1.ru.'), NOW + 300))
+
+    def test_expired_entries_skipped(self):
+        cache = DnsCache()
+        cache.put_resource(a_record('short.e1.ru.', ttl=10))
+        cache.put_resource(a_record('long.e1.ru.', ttl=600))
+        save_snapshot(cache, self.path)
+        self.now = NOW + 60  # Сервак полежал минуту
+        restored = DnsCache(stale_window=0)
+        self.assertEqual(load_snapshot(restored, self.path), 1)
+        self.assertEqual(restored.get_resources(DnsQuestion('short.e1.ru.', 1, 1)), [])
+        self.assertEqual(len(restored.get_resources(DnsQuestion('long.e1.ru.', 1, 1))), 1)
+
+    def test_stale_records_kept_for_stale_window(self):
+        cache = DnsCache(stale_window=100)
+        cache.put_resource(a_record('www.e1.ru.', ttl=10))
+        cache.put_negative(DnsQuestion('nope.e1.ru.', 1, 1), NXDOMAIN, soa_record('e1.ru.', minimum=10))
+        save_snapshot(cache, self.path)
+        self.now = NOW + 60
+        restored = DnsCache(stale_window=100)
+        self.assertEqual(load_snapshot(restored, self.path), 1)  # Отрицательные ответы протухшими не отдаем
+        self.assertEqual(restored.get_resources(DnsQuestion('www.e1.ru.', 1, 1)), [])
+        self.assertEqual(len(restored.get_resources(DnsQuestion('www.e1.ru.', 1, 1), stale=True)), 1)
+        self.now = NOW + 120
+        self.assertEqual(load_snapshot(DnsCache(stale_window=100), self.path), 0)
+
+    def test_truncated_tail_dropped(self):
+        cache = DnsCache()
+        cache.put_resource(a_record('www.e1.ru.'))
+        cache.put_resource(a_record('mail.e1.ru.'))
+        save_snapshot(cache, self.path)
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 3)
+        self.assertEqual(load_snapshot(DnsCache(), self.path), 1)
+
+    def test_header_only(self):
+        save_snapshot(DnsCache(), self.path)
+        self.assertEqual(os.path.getsize(self.path), len(FILE_MAGIC))
+        self.assertEqual(load_snapshot(DnsCache(), self.path), 0)
+        with open(self.path, 'ab') as file:
+            file.write(bytes(ENTRY_STRUCT.size - 1))  # Даже заголовка записи не хватает
+        self.assertEqual(load_snapshot(DnsCache(), self.path), 0)
+
+    def test_not_a_cache_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'\x80\x04pickle')  # Файл старого формата
+        with self.assertRaises(ValueError):
+            load_snapshot(DnsCache(), self.path)
+
+    def test_replaced_atomically(self):
+        save_snapshot(DnsCache(), self.path)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from unittest import mock
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, pack_address
+from DnsCache import ChainCache, CnameLoop, DnsCache, FORMERR, MAX_CNAME_CHAIN, make_key
+from DnsOverload import MAX_QUESTIONS
+from DnsServer import DnsServer
+from tests.helpers import a_record
+
+
+"""Тесты кэша цепочек CNAME (проход цепочки, запоминание и инвалидация при изменении любого ее звена)
+и ограничения числа вопросов в пакете"""
+
+NOW = 1000000.0
+QUESTION = DnsQuestion('www.e1.ru.', 1, 1)
+
+
+def cname(name, target, ttl=300):
+    return DnsResource(name, 5, 1, ttl, pack_address(target))
+
+
+class ChainCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DnsCache()
+        self.chains = ChainCache(self.cache, max_size=2)
+        self.key = make_key('www.e1.ru.', 5, 1)
+        self.chain = [cname('www.e1.ru.', 'cdn.e1.ru.')]
+
+    def test_put_and_get(self):
+        self.chains.put(self.key, 'cdn.e1.ru.', self.chain, NOW + 60, self.chains.generation)
+        with mock.patch('DnsCache.time.time', return_value=NOW):
+            self.assertEqual(self.chains.get(self.key), ('cdn.e1.ru.', self.chain))
+        with mock.patch('DnsCache.time.time', return_value=NOW + 60):
+            self.assertIsNone(self.chains.get(self.key))  # Протухла самая короткоживущая запись
+
+    def test_stale_generation_not_stored(self):
+        generation = self.chains.generation
+        self.cache.put_resource(cname('other.e1.ru.', 'x.e1.ru.'))  # Пока шли по цепочке, что-то поменялось
+        self.chains.put(self.key, 'cdn.e1.ru.', self.chain, NOW + 60, generation)
+        self.assertEqual(self.chains.entries, {})
+
+    def test_only_cname_changes_invalidate(self):
+        self.chains.put(self.key, 'cdn.e1.ru.', self.chain, NOW + 60, self.chains.generation)
+        self.cache.put_resource(a_record('cdn.e1.ru.'))
+        self.assertIn(self.key, self.chains.entries)
+        self.cache.put_resource(cname('cdn.e1.ru.', 'edge.cdn.net.'))  # У конца цепочки появился свой CNAME
+        self.assertEqual(self.chains.entries, {})
+
+    def test_size_bounded(self):
+        for index in range(5):
+            key = make_key('host{}.e1.ru.'.format(index), 5, 1)
+            self.chains.put(key, 'cdn.e1.ru.', self.chain, NOW + 60, self.chains.generation)
+            self.assertLessEqual(len(self.chains.entries), 2)
+
+
+class FollowChainTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DnsServer(['127.0.0.1'], check=False, port=0)
+        self.addCleanup(self.server.stop_server)
+
+    def put(self, *resources):
+        for resource in resources:
+            self.server.cache.put_resource(resource)
+
+    def test_chain_in_order(self):
+        self.put(cname('www.e1.ru.', 'cdn.e1.ru.'), cname('cdn.e1.ru.', 'edge.cdn.net.'), a_record('edge.cdn.net.'))
+        self.assertEqual([(resource.r_name, resource.r_type) for resource in self.server.get_from_cache(QUESTION)],
+                         [('www.e1.ru.', 5), ('cdn.e1.ru.', 5), ('edge.cdn.net.', 1)])
+        target, chain = self.server.follow_chain(QUESTION)
+        self.assertEqual((target.q_name, len(chain)), ('edge.cdn.net.', 2))
+        self.assertIn(make_key('www.e1.ru.', 5, 1), self.server.chain_cache.entries)
+
+    def test_new_link_seen(self):
+        self.put(cname('www.e1.ru.', 'cdn.e1.ru.'))
+        self.assertEqual(self.server.follow_chain(QUESTION)[0].q_name, 'cdn.e1.ru.')
+        self.put(cname('cdn.e1.ru.', 'edge.cdn.net.'))  # Цепочка удлинилась - запомненная уже неверна
+        self.assertEqual(self.server.follow_chain(QUESTION)[0].q_name, 'edge.cdn.net.')
+
+    def test_no_cname(self):
+        self.assertEqual(self.server.follow_chain(QUESTION), (QUESTION, []))
+
+    def test_loop(self):
+        self.put(cname('www.e1.ru.', 'cdn.e1.ru.'), cname('cdn.e1.ru.', 'WWW.e1.ru.'))
+        with self.assertRaises(CnameLoop):
+            self.server.follow_chain(QUESTION)
+
+    def test_too_long(self):
+        for index in range(MAX_CNAME_CHAIN + 1):
+            self.put(cname('host{}.e1.ru.'.format(index), 'host{}.e1.ru.'.format(index + 1)))
+        with self.assertRaises(CnameLoop):
+            self.server.follow_chain(DnsQuestion('host0.e1.ru.', 1, 1))
+
+
+class QuestionLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DnsServer(['127.0.0.1'], check=False, port=0)
+        self.addCleanup(self.server.stop_server)
+
+    def packet(self, count):
+        questions = [DnsQuestion('host{}.e1.ru.'.format(index), 1, 1) for index in range(count)]
+        return DNSPacket(0x4242, 0x0100, questions, [], [], [])
+
+    def test_too_many_questions(self):
+        answer = DNSPacket.from_bytes(self.server.check_questions(self.packet(MAX_QUESTIONS + 1)))
+        self.assertEqual((answer.packet_id, answer.flags & 0xF, answer.question), (0x4242, FORMERR, []))
+        self.assertEqual(self.server.metrics.counters['formerr'], 1)
+
+    def test_allowed(self):
+        self.assertIsNone(self.server.check_questions(self.packet(MAX_QUESTIONS)))
+
+
+if __name__ == '__main__':
+    unittest.main()
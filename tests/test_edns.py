@@ -0,0 +1,74 @@
+import socket
+import unittest
+from DNSPacketParser import DNSPacket, DnsQuestion, FLAG_TC, MIN_UDP_PAYLOAD, OPT_TYPE, \
+    append_opt, make_opt, read_opt_payload
+from DnsTcp import frame, recv_message
+from tests.helpers import a_record, query, response
+
+
+"""Тесты EDNS0 (размер UDP-пакета в OPT, флаг TC) и кадрирования сообщений для DNS поверх TCP"""
+
+QUESTION = DnsQuestion('www.e1.ru.', 1, 1)
+
+
+class EdnsTest(unittest.TestCase):
+    def test_opt_round_trip(self):
+        parsed = DNSPacket.from_bytes(query('www.e1.ru.', edns=4096))
+        opt = parsed.get_opt()
+        self.assertEqual((opt.r_name, opt.r_type, opt.r_class), ('', OPT_TYPE, 4096))
+
+    def test_read_opt_payload(self):
+        raw = bytes(make_opt(1232).to_bytes())
+        self.assertEqual(read_opt_payload(raw, 0), (1232, len(raw)))
+        self.assertIsNone(read_opt_payload(bytes(a_record('www.e1.ru.').to_bytes()), 0))
+        self.assertIsNone(read_opt_payload(raw[:-1], 0))
+
+    def test_append_opt(self):
+        raw = append_opt(bytearray(query('www.e1.ru.')), 1232)
+        self.assertEqual(DNSPacket.from_bytes(raw).get_opt().r_class, 1232)
+
+    def test_udp_limit(self):
+        self.assertEqual(DNSPacket.from_bytes(query('www.e1.ru.')).udp_limit(), MIN_UDP_PAYLOAD)
+        self.assertEqual(DNSPacket.from_bytes(query('www.e1.ru.', edns=4096)).udp_limit(1232), 1232)
+        self.assertEqual(DNSPacket.from_bytes(query('www.e1.ru.', edns=1000)).udp_limit(1232), 1000)
+        self.assertEqual(DNSPacket.from_bytes(query('www.e1.ru.', edns=100)).udp_limit(1232), MIN_UDP_PAYLOAD)
+
+    def test_truncated(self):
+        answers = [a_record('www.e1.ru.', last_byte=i) for i in range(40)]
+        packet = response(QUESTION, answers)
+        packet.additional.append(make_opt())
+        truncated = DNSPacket.from_bytes(packet.truncated().to_bytes())
+        self.assertTrue(truncated.flags & FLAG_TC)
+        self.assertEqual((len(truncated.question), truncated.answer), (1, []))
+        self.assertEqual(truncated.get_opt().r_type, OPT_TYPE)
+        self.assertEqual(packet.packet_id, truncated.packet_id)
+
+
+class TcpFramingTest(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.addCleanup(self.left.close)
+        self.addCleanup(self.right.close)
+
+    def test_pipelined_messages(self):
+        first, second = query('www.e1.ru.'), query('mail.e1.ru.', packet_id=7)
+        self.left.sendall(frame(first) + frame(second))
+        self.assertEqual(recv_message(self.right), first)
+        self.assertEqual(recv_message(self.right), second)
+
+    def test_message_in_pieces(self):
+        framed = frame(query('www.e1.ru.'))
+        self.left.sendall(framed[:1])
+        self.left.sendall(framed[1:5])
+        self.left.sendall(framed[5:])
+        self.assertEqual(recv_message(self.right), framed[2:])
+
+    def test_closed_connection(self):
+        self.left.sendall(frame(query('www.e1.ru.'))[:5])  # Оборвалось посреди сообщения
+        self.left.close()
+        self.assertIsNone(recv_message(self.right))
+        self.assertIsNone(recv_message(self.right))
+
+
+if __name__ == '__main__':
+    unittest.main()
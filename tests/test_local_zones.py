@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import unittest
+from DNSPacketParser import DnsQuestion, pack_address
+from DnsCache import NXDOMAIN, SERVFAIL
+from DnsLocalZones import LocalZones, ZoneError, CNAME_TYPE, NS_TYPE, SOA_TYPE, PTR_TYPE, ANY_TYPE
+
+
+"""Тесты локальных зон: точные имена, шаблоны "*", NXDOMAIN/NODATA, делегирование, CNAME и hosts-файлы"""
+
+ZONE = '''$ORIGIN corp.example.
+$TTL 1h
+@   IN SOA ns1 hostmaster (
+        2024010101 ; serial
+        3600 900 1w 300 )
+    IN NS ns1
+ns1      A 10.0.0.1
+www  60  A 10.0.0.10
+         A 10.0.0.11
+alias    CNAME www
+ext      CNAME w.elsewhere.org.
+loop1    CNAME loop2
+loop2    CNAME loop1
+*.apps   A 10.0.1.1
+fixed.apps A 10.0.1.2
+sub      NS ns.sub
+ns.sub   A 10.0.2.1
+'''
+HOSTS = '''# hosts
+192.168.1.50  printer.lan printer
+'''
+
+
+class LocalZonesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.zone_file = cls.write('corp.zone', ZONE)
+        cls.hosts_file = cls.write('hosts', HOSTS)
+        cls.zones = LocalZones.load([cls.zone_file], [cls.hosts_file])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def write(cls, name, text):
+        path = os.path.join(cls.directory, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        return path
+
+    def lookup(self, name, q_type=1):
+        return self.zones.lookup(DnsQuestion(name, q_type, 1))
+
+    def test_exact_name(self):
+        answer = self.lookup('www.corp.example.')
+        self.assertEqual(answer.rcode, 0)
+        self.assertEqual(sorted((bytes(record.r_data), record.r_ttl) for record in answer.answer),
+                         [(bytes([10, 0, 0, 10]), 60), (bytes([10, 0, 0, 11]), 3600)])  # Без своего TTL - $TTL
+
+    def test_case_insensitive(self):
+        answer = self.lookup('WWW.Corp.Example.')
+        self.assertEqual(len(answer.answer), 2)
+        self.assertEqual(answer.answer[0].r_name, 'WWW.Corp.Example.')  # Имя как в вопросе
+
+    def test_nxdomain_with_soa(self):
+        answer = self.lookup('nope.corp.example.')
+        self.assertEqual(answer.rcode, NXDOMAIN)
+        self.assertEqual(answer.answer, [])
+        soa, = answer.authority
+        self.assertEqual((soa.r_name, soa.r_type), ('corp.example.', SOA_TYPE))
+        self.assertEqual(soa.r_ttl, 300)  # Меньшее из TTL SOA и MINIMUM (RFC 2308)
+
+    def test_nodata(self):
+        answer = self.lookup('www.corp.example.', 28)
+        self.assertEqual(answer.rcode, 0)
+        self.assertEqual(answer.answer, [])
+        self.assertEqual([record.r_type for record in answer.authority], [SOA_TYPE])
+
+    def test_wildcard(self):
+        answer = self.lookup('anything.apps.corp.example.')
+        record, = answer.answer
+        self.assertEqual(record.r_name, 'anything.apps.corp.example.')
+        self.assertEqual(bytes(record.r_data), bytes([10, 0, 1, 1]))
+
+    def test_wildcard_does_not_hide_existing_name(self):
+        record, = self.lookup('fixed.apps.corp.example.').answer
+        self.assertEqual(bytes(record.r_data), bytes([10, 0, 1, 2]))
+
+    def test_wildcard_only_at_closest_encloser(self):
+        """Шаблон отвечает за имена, которых нет, ниже ближайшего существующего предка"""
+        self.assertEqual(self.lookup('a.b.apps.corp.example.').answer[0].r_name, 'a.b.apps.corp.example.')
+        self.assertEqual(self.lookup('x.www.corp.example.').rcode, NXDOMAIN)
+
+    def test_delegation(self):
+        self.assertIsNone(self.lookup('sub.corp.example.'))
+        self.assertIsNone(self.lookup('host.sub.corp.example.'))
+        self.assertIsNone(self.lookup('ns.sub.corp.example.'))  # Glue отдаем не мы, а тот, кому делегировали
+
+    def test_apex(self):
+        answer = self.lookup('corp.example.', NS_TYPE)
+        self.assertEqual([bytes(record.r_data) for record in answer.answer], [pack_address('ns1.corp.example.')])
+        self.assertEqual(len(self.lookup('corp.example.', ANY_TYPE).answer), 2)
+
+    def test_outside_zones(self):
+        self.assertIsNone(self.lookup('example.'))
+        self.assertIsNone(self.lookup('www.example.org.'))
+
+    def test_cname_inside_zone(self):
+        answer = self.lookup('alias.corp.example.')
+        self.assertEqual([record.r_type for record in answer.answer], [CNAME_TYPE, 1, 1])
+        self.assertIsNone(answer.target)
+        self.assertEqual([record.r_type for record in self.lookup('alias.corp.example.', CNAME_TYPE).answer],
+                         [CNAME_TYPE])
+
+    def test_cname_out_of_zone(self):
+        answer = self.lookup('ext.corp.example.')
+        self.assertEqual([record.r_type for record in answer.answer], [CNAME_TYPE])
+        self.assertEqual(answer.target, 'w.elsewhere.org.')  # Дальше - обычным путем
+
+    def test_cname_loop(self):
+        self.assertEqual(self.lookup('loop1.corp.example.').rcode, SERVFAIL)
+
+    def test_hosts(self):
+        record, = self.lookup('printer.').answer
+        self.assertEqual(bytes(record.r_data), bytes([192, 168, 1, 50]))
+        record, = self.lookup('50.1.168.192.in-addr.arpa.', PTR_TYPE).answer
+        self.assertEqual(bytes(record.r_data), pack_address('printer.lan.'))
+        self.assertIsNone(self.lookup('other.lan.'))  # hosts-файл - не зона, NXDOMAIN за соседей не отвечаем
+
+    def test_other_class(self):
+        self.assertIsNone(self.zones.lookup(DnsQuestion('www.corp.example.', 1, 3)))
+
+    def test_errors(self):
+        for name, text in (('nosoa.zone', '$ORIGIN a.example.\nwww A 10.0.0.1\n'),
+                           ('outside.zone', ZONE + 'www.other.org. A 10.0.0.1\n'),
+                           ('paren.zone', ZONE + 'x TXT ( "a"\n'),
+                           ('type.zone', ZONE + 'x HINFO a b\n')):
+            with self.assertRaises(ZoneError):
+                LocalZones.load([self.write(name, text)])
+        with self.assertRaises(ZoneError):
+            LocalZones.load([], [self.write('bad.hosts', '300.1.1.1 host\n')])
+        with self.assertRaises(ZoneError):
+            LocalZones.load([os.path.join(self.directory, 'missing.zone')])
+
+
+if __name__ == '__main__':
+    unittest.main()
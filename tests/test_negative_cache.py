@@ -0,0 +1,102 @@
+import unittest
+from unittest import mock
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, pack_address
+from DnsCache import DnsCache, NOERROR, NXDOMAIN, SERVFAIL, find_negative, negative_ttl, set_rcode
+from DnsServer import DnsServer
+from tests.helpers import a_record, response, soa_record
+
+
+"""Тесты отрицательного кэша (RFC 2308): что считается NXDOMAIN/NODATA и сколько его помнить"""
+
+NOW = 1000000.0
+QUESTION = DnsQuestion('Nope.E1.ru.', 1, 1)
+SOA = soa_record('e1.ru.', ttl=3600, minimum=300)
+
+
+class FindNegativeTest(unittest.TestCase):
+    def test_ttl_is_smaller_of_soa_ttl_and_minimum(self):
+        self.assertEqual(negative_ttl(soa_record('e1.ru.', ttl=3600, minimum=300)), 300)
+        self.assertEqual(negative_ttl(soa_record('e1.ru.', ttl=60, minimum=300)), 60)
+
+    def test_nxdomain(self):
+        question, rcode, soa = find_negative(response(QUESTION, authority=[SOA], rcode=NXDOMAIN))
+        self.assertEqual((question.q_name, question.q_type, rcode), ('nope.e1.ru.', 1, NXDOMAIN))
+        self.assertEqual(soa, SOA)
+
+    def test_nodata(self):
+        question, rcode, _ = find_negative(response(QUESTION, [a_record('other.e1.ru.')], [SOA]))
+        self.assertEqual((question.q_name, rcode), ('nope.e1.ru.', 0))
+
+    def test_not_negative(self):
+        self.assertIsNone(find_negative(response(QUESTION, [a_record('nope.e1.ru.')], [SOA])))
+        self.assertIsNone(find_negative(response(QUESTION, authority=[SOA], rcode=SERVFAIL)))  # Ошибки не кэшируем
+        self.assertIsNone(find_negative(response(QUESTION, rcode=NXDOMAIN)))  # Без SOA - неизвестно, сколько помнить
+
+    def test_negative_answer_for_end_of_cname_chain(self):
+        chain = [DnsResource('nope.e1.ru.', 5, 1, 60, pack_address('cdn.e1.ru.')),
+                 DnsResource('cdn.e1.ru.', 5, 1, 60, pack_address('gone.cdn.net.'))]
+        question, rcode, _ = find_negative(response(QUESTION, chain, [SOA], rcode=NXDOMAIN))
+        self.assertEqual((question.q_name, rcode), ('gone.cdn.net.', NXDOMAIN))
+
+    def test_cname_loop_in_answer(self):
+        loop = [DnsResource('nope.e1.ru.', 5, 1, 60, pack_address('loop.e1.ru.')),
+                DnsResource('loop.e1.ru.', 5, 1, 60, pack_address('nope.e1.ru.'))]
+        self.assertIsNotNone(find_negative(response(QUESTION, loop, [SOA])))  # Главное - не зависнуть
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DnsCache()
+        self.now = NOW
+        patcher = mock.patch('DnsCache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_nxdomain_covers_every_type(self):
+        self.cache.put_negative(QUESTION, NXDOMAIN, SOA)
+        rcode, soa, expire_time = self.cache.get_negative(DnsQuestion('nope.e1.ru.', 28, 1))
+        self.assertEqual((rcode, soa, expire_time), (NXDOMAIN, SOA, NOW + 300))
+
+    def test_nodata_covers_one_type(self):
+        self.cache.put_negative(QUESTION, 0, SOA)
+        self.assertIsNotNone(self.cache.get_negative(QUESTION))
+        self.assertIsNone(self.cache.get_negative(DnsQuestion('nope.e1.ru.', 28, 1)))
+
+    def test_expires(self):
+        self.cache.put_negative(QUESTION, NXDOMAIN, SOA)
+        self.now = NOW + 299
+        self.assertIsNotNone(self.cache.get_negative(QUESTION))
+        self.now = NOW + 301
+        self.assertIsNone(self.cache.get_negative(QUESTION))
+
+    def test_real_record_drops_negative(self):
+        self.cache.put_negative(QUESTION, NXDOMAIN, SOA)
+        self.cache.put_resource(a_record('nope.e1.ru.'))
+        self.assertIsNone(self.cache.get_negative(QUESTION))
+
+    def test_answer_carries_rcode_and_remaining_ttl(self):
+        answer = DNSPacket(1, 0x8000, [QUESTION], [], [], [])
+        with mock.patch('DnsServer.time.time', return_value=NOW + 100):
+            DnsServer.add_negative(answer, (NXDOMAIN, SOA, NOW + 300))
+        self.assertEqual(answer.flags & 0xF, NXDOMAIN)
+        self.assertEqual([(record.r_type, record.r_ttl) for record in answer.authority], [(6, 200)])
+
+
+class SetRcodeTest(unittest.TestCase):
+    def rcode_after(self, *rcodes):
+        answer = DNSPacket(1, 0x8580, [QUESTION, QUESTION], [], [], [])  # QR, AA, RD, RA
+        for rcode in rcodes:
+            set_rcode(answer, rcode)
+        self.assertEqual(answer.flags & ~0xF, 0x8580)  # Остальные флаги не тронуты
+        return answer.flags & 0xF
+
+    def test_worst_wins(self):
+        self.assertEqual(self.rcode_after(NXDOMAIN, SERVFAIL), SERVFAIL)  # А не NXDOMAIN | SERVFAIL = 3
+        self.assertEqual(self.rcode_after(SERVFAIL, NXDOMAIN), SERVFAIL)
+        self.assertEqual(self.rcode_after(NOERROR, NXDOMAIN, NOERROR), NXDOMAIN)
+        self.assertEqual(self.rcode_after(NXDOMAIN, NXDOMAIN), NXDOMAIN)
+        self.assertEqual(self.rcode_after(NOERROR), NOERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
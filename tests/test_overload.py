@@ -0,0 +1,158 @@
+import threading
+import unittest
+from unittest import mock
+from DNSPacketParser import DNSPacket, FLAG_TC
+from DnsOverload import Admission, RateLimiter, WorkQueue, slip_response, ALLOW, SLIP, DROP
+from tests.helpers import query, wait_until
+
+
+"""Тесты защиты от перегрузки: лимит ответов клиенту, ограниченная очередь и admission"""
+
+
+class Clock:
+    """Подменяет time.monotonic в DnsOverload, чтобы ведра пополнялись, когда скажем"""
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('DnsOverload.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_limit(self):
+        limiter = RateLimiter(5, slip=0)
+        self.assertEqual([limiter.check('10.0.0.1') for _ in range(6)], [ALLOW] * 5 + [DROP])
+        self.assertEqual(limiter.check('10.0.0.2'), ALLOW)  # У каждого IP свое ведро
+
+    def test_refill(self):
+        limiter = RateLimiter(10, slip=0)
+        for _ in range(10):
+            limiter.check('10.0.0.1')
+        self.assertEqual(limiter.check('10.0.0.1'), DROP)
+        self.clock.now += 0.25  # 2.5 жетона
+        self.assertEqual([limiter.check('10.0.0.1') for _ in range(3)], [ALLOW, ALLOW, DROP])
+
+    def test_slip_every_nth(self):
+        limiter = RateLimiter(1, slip=2)
+        self.assertEqual([limiter.check('10.0.0.1') for _ in range(5)], [ALLOW, DROP, SLIP, DROP, SLIP])
+
+    def test_burst_floor(self):
+        """При rate < 1 ведро все равно вмещает хотя бы один ответ"""
+        limiter = RateLimiter(0.5, slip=0)
+        self.assertEqual(limiter.burst, 1.0)
+        self.assertEqual([limiter.check('10.0.0.1') for _ in range(2)], [ALLOW, DROP])
+        self.clock.now += 2
+        self.assertEqual(limiter.check('10.0.0.1'), ALLOW)
+
+    def test_table_is_bounded(self):
+        limiter = RateLimiter(10, max_clients=4)
+        for i in range(20):
+            limiter.check('10.0.0.{}'.format(i))
+            self.assertLessEqual(len(limiter.clients), 4)
+
+    def test_prune_keeps_throttled_clients(self):
+        limiter = RateLimiter(1, slip=0, max_clients=2)
+        limiter.check('10.0.0.1')
+        self.clock.now += 5  # Ведро первого снова полное - его можно забыть
+        limiter.check('10.0.0.2')
+        limiter.check('10.0.0.3')
+        self.assertNotIn('10.0.0.1', limiter.clients)
+        self.assertEqual(limiter.check('10.0.0.2'), DROP)  # А второго помним, его ведро пустое
+
+
+class SlipResponseTest(unittest.TestCase):
+    def test_truncated_answer_with_question(self):
+        packet = DNSPacket.from_bytes(slip_response(query('www.e1.ru.', packet_id=0x1234)))
+        self.assertEqual(packet.packet_id, 0x1234)
+        self.assertTrue(packet.flags & 0x8000)
+        self.assertTrue(packet.flags & FLAG_TC)
+        self.assertTrue(packet.flags & 0x0100)  # RD как в запросе
+        self.assertEqual(packet.question[0].q_name, 'www.e1.ru.')
+        self.assertEqual(packet.answer, [])
+
+    def test_garbage(self):
+        self.assertIsNone(slip_response(b'\x00\x01garbage'))
+
+
+class WorkQueueTest(unittest.TestCase):
+    def test_put_fails_when_full(self):
+        release = threading.Event()
+        queue = WorkQueue(lambda waited, item: release.wait(), threads=1, size=2)
+        queue.start()
+        try:
+            self.assertTrue(queue.put((1,)))  # Его сразу заберет поток и повиснет
+            self.assertTrue(wait_until(lambda: not queue.depth()))
+            self.assertTrue(queue.put((2,)))
+            self.assertTrue(queue.put((3,)))
+            self.assertFalse(queue.put((4,)))
+            self.assertEqual(queue.max_depth, 2)
+        finally:
+            release.set()
+            queue.stop()
+
+    def test_stop_drains_queue(self):
+        done = []
+        queue = WorkQueue(lambda waited, item: done.append(item), threads=2, size=100)
+        queue.start()
+        for i in range(50):
+            self.assertTrue(queue.put((i,)))
+        queue.stop()
+        self.assertEqual(sorted(done), list(range(50)))
+        self.assertFalse(queue.put((50,)))  # Остановленный пул новое не берет
+
+    def test_not_started(self):
+        queue = WorkQueue(lambda waited, item: None, threads=1, size=10)
+        self.assertFalse(queue.put((1,)))
+
+    def test_handler_gets_wait_time(self):
+        waits = []
+        queue = WorkQueue(lambda waited, a, b: waits.append((waited, a, b)), threads=1, size=10)
+        queue.start()
+        queue.put((1, 2))
+        queue.stop()
+        self.assertEqual(len(waits), 1)
+        self.assertGreaterEqual(waits[0][0], 0)
+        self.assertEqual(waits[0][1:], (1, 2))
+
+    def test_handler_error_costs_one_item(self):
+        done = []
+        errors = []
+
+        def handler(waited, item):
+            if item == 0:
+                raise ValueError('bad item')
+            done.append(item)
+
+        queue = WorkQueue(handler, threads=1, size=10, on_error=errors.append)
+        queue.start()
+        for i in range(3):
+            queue.put((i,))
+        queue.stop()
+        self.assertEqual(done, [1, 2])  # Единственный поток пережил кривой элемент
+        self.assertEqual([str(ex) for ex in errors], ['bad item'])
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_limit(self):
+        admission = Admission(2)
+        self.assertTrue(admission.try_enter())
+        self.assertTrue(admission.try_enter())
+        self.assertFalse(admission.try_enter())
+        admission.leave()
+        self.assertTrue(admission.try_enter())
+        self.assertEqual(admission.active, 2)
+
+    def test_at_least_one(self):
+        admission = Admission(0)
+        self.assertTrue(admission.try_enter())
+        self.assertFalse(admission.try_enter())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import struct
+import unittest
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, MAX_POINTER_JUMPS, pack_address, read_labels, \
+    read_name, read_wire_name
+from tests.helpers import header
+
+
+"""Тесты разбора пакетов: указатели сжатия имен и защита от зацикленных указателей"""
+
+
+class CompressionTest(unittest.TestCase):
+    def test_round_trip_compresses_repeated_names(self):
+        packet = DNSPacket(1, 0x8180, [DnsQuestion('www.e1.ru.', 1, 1)], [
+            DnsResource('www.e1.ru.', 5, 1, 300, pack_address('cdn.e1.ru.')),
+            DnsResource('cdn.e1.ru.', 1, 1, 60, b'\x01\x02\x03\x04'),
+        ], [], [])
+        raw = packet.to_bytes()
+        self.assertGreater(packet.compression_saved, 0)
+        parsed = DNSPacket.from_bytes(bytes(raw))
+        self.assertEqual(parsed.question[0].q_name, 'www.e1.ru.')
+        self.assertEqual([answer.r_name for answer in parsed.answer], ['www.e1.ru.', 'cdn.e1.ru.'])
+        self.assertEqual(parsed.answer[0].r_data, pack_address('cdn.e1.ru.'))  # Имя в данных развернуто
+        self.assertEqual(parsed.answer[1].r_data, b'\x01\x02\x03\x04')
+
+    def test_pointer_to_earlier_name(self):
+        buf = header() + b'\x02e1\x02ru\x00'
+        start = len(buf)
+        buf += b'\x03www\xc0\x0c'
+        labels, end = read_labels(memoryview(buf), start)
+        self.assertEqual([bytes(label) for label in labels], [b'www', b'e1', b'ru'])
+        self.assertEqual(end, len(buf))  # Смещение за указателем, а не за тем, куда он привел
+        self.assertEqual(read_name(memoryview(buf), start, {})[0], 'www.e1.ru.')
+        self.assertEqual(read_wire_name(memoryview(buf), start), (b'\x03www\x02e1\x02ru\x00', len(buf)))
+
+    def test_root_name(self):
+        self.assertEqual(read_name(memoryview(b'\x00'), 0), ('', 1))
+
+
+class PointerLoopTest(unittest.TestCase):
+    def assertRejected(self, buf, offset):
+        for read in (lambda: read_labels(memoryview(buf), offset),
+                     lambda: read_name(memoryview(buf), offset, {}),
+                     lambda: read_wire_name(memoryview(buf), offset)):
+            with self.assertRaises(ValueError):
+                read()
+
+    def test_pointer_to_itself(self):
+        self.assertRejected(header() + b'\xc0\x0c', 12)
+
+    def test_forward_pointer(self):
+        self.assertRejected(header() + b'\xc0\x0e\x00', 12)
+
+    def test_two_pointers_to_each_other(self):
+        buf = header() + b'\xc0\x0e\xc0\x0c'
+        self.assertRejected(buf, 12)
+        self.assertRejected(buf, 14)
+
+    def test_too_many_jumps(self):
+        """Каждый указатель смотрит назад, на предыдущий, но цепочка длиннее MAX_POINTER_JUMPS"""
+        buf = header() + b'\x00'
+        for _ in range(MAX_POINTER_JUMPS + 2):  # read_name первый указатель проходит сам
+            buf += struct.pack('>H', 0xC000 | (len(buf) - (1 if len(buf) == 13 else 2)))
+        self.assertRejected(buf, len(buf) - 2)
+
+    def test_name_too_long(self):
+        buf = header() + b'\x3f' + b'a' * 63
+        buf += b'\x3f' + b'b' * 63 + b'\x3f' + b'c' * 63 + b'\x3f' + b'd' * 63 + b'\x00'
+        self.assertRejected(buf, 12)
+
+    def test_bad_label_length(self):
+        self.assertRejected(header() + b'\x80abc\x00', 12)
+
+    def test_loop_in_answer_section(self):
+        raw = header(an_count=1) + b'\x02e1\x02ru\x00' + struct.pack('>HH', 1, 1)
+        raw += b'\xc0' + bytes([len(raw)]) + struct.pack('>HHIH', 1, 1, 60, 4) + b'\x01\x02\x03\x04'
+        packet = DNSPacket.from_bytes(bytes(raw))  # Вопрос цел, а ответы разбираются лениво
+        self.assertEqual(packet.question[0].q_name, 'e1.ru.')
+        with self.assertRaises(ValueError):
+            packet.answer
+
+
+if __name__ == '__main__':
+    unittest.main()
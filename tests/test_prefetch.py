@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import unittest
+from DNSPacketParser import DnsQuestion
+from DnsMetrics import Metrics, DebugLog
+from DnsOverload import Admission
+from DnsPrefetch import Prefetcher
+
+
+"""Тесты упреждающего обновления: через какой движок идет обновление, admission и ошибки"""
+
+KEY = ('www.e1.ru.', 1, 1)
+
+
+class FakeServer:
+    """Ровно то, что Prefetcher берет у сервака"""
+    def __init__(self, get_from_forwarder=None, admission=1):
+        self.asked = []
+        self.get_from_forwarder = get_from_forwarder or self.asked.append
+        self.admission = Admission(admission)
+        self.metrics = Metrics()
+        self.log = DebugLog()
+        self.async_engine = None
+
+
+class FakeEngine:
+    """Движок asyncio с настоящим event loop-ом в отдельном потоке"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.asked = []
+
+    async def get_from_forwarder(self, question):
+        self.asked.append((question, threading.current_thread()))
+        return []
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class PrefetchRefreshTest(unittest.TestCase):
+    def refresh(self, server):
+        prefetcher = Prefetcher(server, concurrency=1)
+        self.assertTrue(prefetcher.acquire())
+        prefetcher.refresh(KEY)
+        self.assertEqual(server.admission.active, 0)  # Место в admission отпущено
+        self.assertTrue(prefetcher.slots.acquire(blocking=False))  # И слот обновлятора тоже
+        return prefetcher
+
+    def test_threads_engine(self):
+        server = FakeServer()
+        self.assertEqual(self.refresh(server).prefetched, 1)
+        self.assertEqual(server.asked, [DnsQuestion(*KEY)])
+
+    def test_asyncio_engine(self):
+        server = FakeServer()
+        server.async_engine = engine = FakeEngine()
+        self.addCleanup(engine.close)
+        self.refresh(server)
+        self.assertEqual(server.asked, [])
+        (question, thread), = engine.asked
+        self.assertEqual((question, thread), (DnsQuestion(*KEY), engine.thread))  # Спросили из event loop-а
+
+    def test_error_counted(self):
+        def get_from_forwarder(question):
+            raise OSError('network is down')
+
+        server = FakeServer(get_from_forwarder)
+        self.assertEqual(self.refresh(server).prefetched, 0)
+        self.assertEqual(server.metrics.counters['errors'], 1)
+
+    def test_waits_for_admission(self):
+        server = FakeServer()
+        prefetcher = Prefetcher(server, concurrency=2)
+        self.assertTrue(server.admission.try_enter())  # Единственное место занял промах клиента
+        self.assertFalse(prefetcher.acquire())
+        self.assertTrue(prefetcher.slots.acquire(blocking=False))
+        self.assertTrue(prefetcher.slots.acquire(blocking=False))  # Слот при отказе вернули
+        server.admission.leave()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from DNSPacketParser import DnsQuestion
+from DnsQueryLog import QueryLog, FLAG_CACHED, FLAG_DROPPED, FLAG_TCP, describe, read_log
+from tests.helpers import a_record, query, response
+
+
+"""Тесты лога запросов: запись, чтение обратно, ротация и недописанный хвост"""
+
+NOW = 1000000.0
+
+
+class QueryLogTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'querylog')
+        self.query = query('www.e1.ru.')
+        self.response = bytes(response(DnsQuestion('www.e1.ru.', 1, 1), [a_record('www.e1.ru.')]).to_bytes())
+
+    def open(self, **kwargs):
+        log = QueryLog(self.path, **kwargs)
+        log.open_file()  # Без потока: пишем сами через flush
+        return log
+
+    def test_round_trip(self):
+        log = self.open()
+        with mock.patch('DnsQueryLog.time.time', return_value=NOW):
+            log.record(('10.0.0.1', 5353), self.query, self.response, FLAG_CACHED, 0.0005)
+            log.record(('2001:db8::1', 53), self.query, None, FLAG_TCP | FLAG_DROPPED, 0.25)
+        log.stop()
+        first, second = read_log(self.path)
+        self.assertEqual((first.address, first.port, first.flags), ('10.0.0.1', 5353, FLAG_CACHED))
+        self.assertEqual((first.query, first.response), (self.query, self.response))
+        self.assertAlmostEqual(first.time, NOW - 0.0005)
+        self.assertAlmostEqual(first.latency, 0.0005)
+        self.assertEqual((second.address, second.response), ('2001:db8::1', b''))
+        self.assertIn('www.e1.ru. 1', describe(first))
+        self.assertIn('tcp,dropped', describe(second))
+        self.assertEqual(log.written, 2)
+
+    def test_appends_to_existing_file(self):
+        for _ in range(2):
+            log = self.open()
+            log.record(('10.0.0.1', 53), self.query, self.response, 0, 0.001)
+            log.stop()
+        self.assertEqual(len(list(read_log(self.path))), 2)
+
+    def test_rotation(self):
+        log = self.open(max_bytes=300, max_files=2)
+        for index in range(10):
+            log.record(('10.0.0.{}'.format(index), 53), self.query, self.response, 0, 0.001)
+            log.flush()
+        log.stop()
+        self.assertGreater(log.rotations, 2)
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))  # Самые старые пропали
+        for path in (self.path, self.path + '.1', self.path + '.2'):
+            self.assertLess(os.path.getsize(path), 300 + 200)
+        newest = [record.address for record in read_log(self.path)]
+        self.assertEqual(newest[-1], '10.0.0.9')
+
+    def test_truncated_tail_skipped(self):
+        log = self.open()
+        for _ in range(3):
+            log.record(('10.0.0.1', 53), self.query, self.response, 0, 0.001)
+        log.stop()
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 5)  # Сервак упал посреди записи
+        self.assertEqual(len(list(read_log(self.path))), 2)
+
+    def test_not_a_log(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'garbage!')
+        with self.assertRaises(ValueError):
+            list(read_log(self.path))
+
+    def test_dropped_when_buffer_full(self):
+        log = self.open(buffer_size=2)
+        for _ in range(5):
+            log.record(('10.0.0.1', 53), self.query, self.response, 0, 0.001)
+        log.stop()
+        self.assertEqual((log.written, log.dropped), (2, 3))
+
+    def test_write_failure_logged(self):
+        debug_log = mock.Mock()
+        log = QueryLog(self.path, log=debug_log)
+        log.file = mock.Mock(tell=mock.Mock(return_value=0), write=mock.Mock(side_effect=OSError('disk full')))
+        log.record(('10.0.0.1', 53), self.query, self.response, 0, 0.001)
+        log.flush()
+        self.assertEqual((log.written, log.dropped), (0, 1))
+        debug_log.debug.assert_called_once()  # В отладочный лог сервака, а не print на каждый flush
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+from DNSPacketParser import DNSPacket, DnsQuestion
+from DnsAsyncEngine import AsyncEngine, AsyncUpstreamPool
+from DnsResolve import resolve_miss, IO_FORWARDER
+from DnsServer import DnsServer
+from tests.helpers import FakeUpstream
+
+
+"""Тесты общей логики движков (DnsResolve): ее генераторы одинаково гоняют и потоки, и asyncio"""
+
+QUESTIONS = [DnsQuestion('www.e1.ru.', 1, 1), DnsQuestion('mail.e1.ru.', 1, 1)]
+
+
+class ResolveStepsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DnsServer(['127.0.0.1'], check=False, port=0)
+        self.addCleanup(self.server.stop_server)
+
+    def test_forwarder_error_thrown_in(self):
+        steps = resolve_miss(self.server, QUESTIONS[0])
+        self.assertEqual(next(steps), (IO_FORWARDER, QUESTIONS[0]))
+        self.assertEqual(self.server.admission.active, 1)
+        with self.assertRaises(OSError):
+            steps.throw(OSError('forwarder is gone'))
+        self.assertEqual(self.server.admission.active, 0)  # Место в admission отпустил сам генератор
+
+    def test_abandoned_steps_release_admission(self):
+        steps = resolve_miss(self.server, QUESTIONS[0])
+        next(steps)
+        steps.close()  # Так делает drive, если корутину отменили
+        self.assertEqual(self.server.admission.active, 0)
+
+
+class BothEnginesTest(unittest.TestCase):
+    def setUp(self):
+        self.upstream = FakeUpstream()
+        self.addCleanup(self.upstream.stop)
+        self.server = DnsServer(['{}:{}'.format(*self.upstream.address)], check=False, port=0)
+        self.addCleanup(self.server.stop_server)
+        self.packet = DNSPacket(0x4242, 0x0100, QUESTIONS, [], [], []).to_bytes()
+
+    def names(self, raw_response):
+        return sorted(answer.r_name for answer in DNSPacket.from_bytes(raw_response).answer)
+
+    def test_threads(self):
+        self.server.miss_queue.start()
+        self.addCleanup(self.server.miss_queue.stop)
+        self.assertEqual(self.names(self.server.resolve_query(self.packet)), ['mail.e1.ru.', 'www.e1.ru.'])
+
+    def test_asyncio(self):
+        async def main():
+            loop = asyncio.get_running_loop()
+            engine = AsyncEngine(self.server)
+            engine.loop = engine.flights.loop = loop
+            engine.upstream = AsyncUpstreamPool(loop, self.server.upstreams, payload=self.server.udp_payload)
+            await engine.upstream.start()
+            try:
+                return await engine.resolve_query(self.packet)
+            finally:
+                engine.upstream.close()
+
+        self.assertEqual(self.names(asyncio.run(main())), ['mail.e1.ru.', 'www.e1.ru.'])
+        self.assertEqual(len(self.upstream.requests), 2)
@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+from DNSPacketParser import DNSPacket, DnsQuestion, DnsResource, HEADER_STRUCT, MIN_UDP_PAYLOAD, OPT_TYPE, \
+    pack_address
+from DnsCache import DnsCache, ResponseCache, TTL_STRUCT, make_key
+from tests.helpers import query, response
+
+
+"""Тесты кэша готовых ответов: подстановка идентификатора и оставшихся времен жизни в шаблон"""
+
+NOW = 1000000.0
+QUESTION = DnsQuestion('www.e1.ru.', 1, 1)
+CHAIN = [DnsResource('www.e1.ru.', 5, 1, 300, pack_address('cdn.e1.ru.')),
+         DnsResource('cdn.e1.ru.', 1, 1, 60, b'\x01\x02\x03\x04')]
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DnsCache()
+        self.responses = ResponseCache(self.cache)
+        self.key = make_key('www.e1.ru.', 1, 1)
+
+    def put(self, answers, expire_times, generation=None):
+        packet = response(QUESTION, answers)
+        raw = packet.to_bytes()
+        ttl_fields = list(zip(packet.ttl_offsets, expire_times))
+        depends = {make_key(answer.r_name, answer.r_type, answer.r_class) for answer in answers}
+        self.responses.put(self.key, raw, packet.compression_saved, ttl_fields, depends,
+                           self.responses.generation if generation is None else generation)
+        return packet
+
+    def get(self, raw_request, now, **kwargs):
+        with mock.patch('DnsCache.time.time', return_value=now):
+            return self.responses.get(raw_request, **kwargs)
+
+    def test_ttl_patched_per_record(self):
+        packet = self.put(CHAIN, [NOW + 300, NOW + 60])
+        raw = self.get(query('www.e1.ru.'), NOW + 20)[0]
+        self.assertEqual([TTL_STRUCT.unpack_from(raw, offset)[0] for offset in packet.ttl_offsets], [280, 40])
+        parsed = DNSPacket.from_bytes(raw)
+        self.assertEqual([answer.r_ttl for answer in parsed.answer], [280, 40])
+        self.assertEqual(parsed.answer[1].r_data, b'\x01\x02\x03\x04')
+
+    def test_id_and_question_case_taken_from_request(self):
+        self.put([DnsResource('www.e1.ru.', 1, 1, 60, b'\x01\x02\x03\x04')], [NOW + 60])
+        parsed = DNSPacket.from_bytes(self.get(query('WWW.E1.ru.', packet_id=0xBEEF), NOW)[0])
+        self.assertEqual(parsed.packet_id, 0xBEEF)
+        self.assertEqual(parsed.question[0].q_name, 'WWW.E1.ru.')
+
+    def test_template_is_not_modified(self):
+        self.put([DnsResource('www.e1.ru.', 1, 1, 60, b'\x01\x02\x03\x04')], [NOW + 60])
+        first = self.get(query('www.e1.ru.', packet_id=1), NOW + 10)[0]
+        second = self.get(query('www.e1.ru.', packet_id=2), NOW + 30)[0]
+        self.assertEqual(DNSPacket.from_bytes(first).answer[0].r_ttl, 50)
+        self.assertEqual(DNSPacket.from_bytes(second).answer[0].r_ttl, 30)
+
+    def test_expired_by_shortest_record(self):
+        self.put(CHAIN, [NOW + 300, NOW + 60])
+        self.assertIsNotNone(self.get(query('www.e1.ru.'), NOW + 59))
+        self.assertIsNone(self.get(query('www.e1.ru.'), NOW + 60))
+
+    def test_not_simple_query(self):
+        self.put(CHAIN, [NOW + 300, NOW + 60])
+        two_questions = DNSPacket(1, 0x0100, [QUESTION, QUESTION], [], [], []).to_bytes()
+        self.assertIsNone(self.get(bytes(two_questions), NOW))
+        self.assertIsNone(self.get(b'\x00\x01', NOW))  # Обрывок пакета
+
+    def test_stale_generation_not_stored(self):
+        generation = self.responses.generation
+        self.responses.invalidate(make_key('other.ru.', 1, 1))
+        self.put([DnsResource('www.e1.ru.', 1, 1, 60, b'\x01\x02\x03\x04')], [NOW + 60], generation)
+        self.assertIsNone(self.get(query('www.e1.ru.'), NOW))
+
+    def test_invalidated_when_record_changes(self):
+        self.put(CHAIN, [NOW + 300, NOW + 60])
+        self.cache.put_resource(DnsResource('cdn.e1.ru.', 1, 1, 60, b'\x05\x06\x07\x08'))
+        self.assertIsNone(self.get(query('www.e1.ru.'), NOW))
+
+    def test_edns_client_gets_opt(self):
+        self.put([DnsResource('www.e1.ru.', 1, 1, 60, b'\x01\x02\x03\x04')], [NOW + 60])
+        raw, _, _ = self.get(query('www.e1.ru.', edns=4096), NOW, payload=1232)
+        parsed = DNSPacket.from_bytes(raw)
+        self.assertEqual([(additional.r_type, additional.r_class) for additional in parsed.additional],
+                         [(OPT_TYPE, 1232)])
+
+    def test_too_big_for_udp(self):
+        answers = [DnsResource('www.e1.ru.', 1, 1, 60, bytes([10, 0, i // 256, i % 256])) for i in range(40)]
+        packet = self.put(answers, [NOW + 60] * len(answers))
+        self.assertGreater(len(packet.to_bytes()), MIN_UDP_PAYLOAD)
+        self.assertIsNone(self.get(query('www.e1.ru.'), NOW))  # Обрезать его будет обычный путь
+        raw, _, _ = self.get(query('www.e1.ru.'), NOW, tcp=True)
+        self.assertEqual(HEADER_STRUCT.unpack_from(raw, 0)[3], len(answers))
+
+
+if __name__ == '__main__':
+    unittest.main()
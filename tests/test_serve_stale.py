@@ -0,0 +1,130 @@
+import threading
+import unittest
+from unittest import mock
+from DNSPacketParser import DnsQuestion
+from DnsCache import DnsCache, STALE_TTL
+from DnsServer import DnsServer, STALE_RECHECK
+from DnsResolve import get_stale_or_forwarder
+from DnsUpstream import question_key
+from tests.helpers import a_record, wait_until
+
+
+"""Тесты serve-stale (RFC 8767): протухшие записи хранятся еще stale_window секунд
+и отдаются, если форвардер не успел ответить за stale_deadline"""
+
+NOW = 1000000.0
+QUESTION = DnsQuestion('www.e1.ru.', 1, 1)
+
+
+class StaleCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DnsCache(stale_window=100)
+        self.now = NOW
+        patcher = mock.patch('DnsCache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_expired_record_kept_for_stale_window(self):
+        self.cache.put_resource(a_record('www.e1.ru.', ttl=10))
+        self.now = NOW + 50
+        self.assertEqual(self.cache.get_resources(QUESTION), [])
+        stale = self.cache.get_resources(QUESTION, stale=True)
+        self.assertEqual([(resource.r_data, resource.r_ttl) for resource in stale],
+                         [(b'\x0a\x00\x00\x01', STALE_TTL)])
+        self.now = NOW + 111
+        self.assertEqual(self.cache.get_resources(QUESTION, stale=True), [])
+        self.assertEqual((self.cache.records, len(self.cache.cache)), (0, 0))
+
+    def test_fresh_record_drops_stale(self):
+        self.cache.put_resource(a_record('www.e1.ru.', ttl=10, last_byte=1))
+        self.now = NOW + 50
+        self.cache.put_resource(a_record('www.e1.ru.', ttl=10, last_byte=2))
+        self.assertEqual([resource.r_data for resource in self.cache.get_resources(QUESTION, stale=True)],
+                         [b'\x0a\x00\x00\x02'])
+        self.assertEqual(self.cache.records, 1)
+
+
+class StaleOrForwarderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DnsServer(['127.0.0.1'], check=False, port=0, stale_deadline=0.1)
+        self.addCleanup(self.server.stop_server)
+        self.server.miss_queue.start()  # Обновления идут в нем
+        self.addCleanup(self.server.miss_queue.stop)
+        self.stale = [a_record('www.e1.ru.', ttl=STALE_TTL)]
+        self.fresh = [a_record('www.e1.ru.', last_byte=2)]
+        self.asked = []
+
+    def forwarder(self, answer, release=None):
+        def get_from_forwarder(question):
+            self.asked.append(question)
+            if release is not None:
+                release.wait(2)
+            return answer
+        self.server.get_from_forwarder = get_from_forwarder
+
+    def ask(self):
+        """Как resolve_miss: место в admission занимаем мы, а отпускает get_stale_or_forwarder"""
+        self.assertTrue(self.server.admission.try_enter())
+        return self.server.drive(get_stale_or_forwarder(self.server, QUESTION, self.stale))
+
+    def test_forwarder_in_time(self):
+        self.forwarder(self.fresh)
+        self.assertEqual(self.ask(), self.fresh)
+        self.assertEqual(self.server.metrics.counters['stale_answers'], 0)
+
+    def test_forwarder_too_slow(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.forwarder(self.fresh, release)
+        self.assertEqual(self.ask(), self.stale)
+        self.assertEqual(self.server.metrics.counters['stale_answers'], 1)
+        self.assertFalse(self.server.recently_failed(QUESTION))  # Не ответил вовремя - еще не значит, что лежит
+
+    def test_one_refresh_per_question(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.forwarder(self.fresh, release)
+        self.assertEqual(self.ask(), self.stale)
+        self.assertEqual(self.ask(), self.stale)  # Уже обновляется - форвардера второй раз не дергаем
+        self.assertEqual(len(self.asked), 1)
+        self.assertEqual(self.server.admission.active, 1)  # Место держит поток обновления
+        release.set()
+        self.assertTrue(wait_until(lambda: self.server.admission.active == 0))
+        self.assertEqual(self.server.refreshing, set())
+
+    def test_failure_remembered(self):
+        self.forwarder([])
+        self.assertEqual(self.ask(), self.stale)
+        self.assertTrue(self.server.recently_failed(QUESTION))
+        self.assertEqual(self.ask(), self.stale)
+        self.assertEqual(len(self.asked), 1)  # Второй раз форвардера не дергали
+        self.assertEqual(self.server.admission.active, 0)
+        failed_at = self.server.stale_failures[question_key(QUESTION)]
+        with mock.patch('DnsServer.time.monotonic', return_value=failed_at + STALE_RECHECK):
+            self.assertFalse(self.server.recently_failed(QUESTION))
+
+    def test_refresh_error(self):
+        def get_from_forwarder(question):
+            raise ValueError('broken answer')
+
+        self.server.get_from_forwarder = get_from_forwarder
+        self.assertEqual(self.ask(), self.stale)
+        self.assertEqual(self.server.metrics.counters['errors'], 1)
+        self.assertEqual((self.server.admission.active, self.server.refreshing), (0, set()))
+
+    def test_no_free_thread(self):
+        self.forwarder(self.fresh)
+        self.server.miss_queue.stop()  # Пул не берет обновление - как будто он переполнен
+        self.assertEqual(self.ask(), self.stale)
+        self.assertEqual(self.asked, [])
+        self.assertEqual((self.server.admission.active, self.server.refreshing), (0, set()))
+
+    def test_forwarder_off(self):
+        self.forwarder(self.fresh)
+        self.server.forwarder_on = False
+        self.assertEqual(self.ask(), self.stale)
+        self.assertEqual(self.asked, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from DNSPacketParser import DNSPacket, DnsQuestion
+from DnsAsyncEngine import AsyncSingleFlight
+from DnsUpstream import UpstreamPool, UpstreamSelector, SingleFlight, UPSTREAM_MAX_FAILURES
+from tests.helpers import FakeUpstream, a_record, reply, wait_until
+
+
+"""Тесты работы с форвардерами: пул сокетов (ответы по ключу, перезапросы, смена сокетов),
+выбор форвардера по времени ответа, hedge-запросы и склейка одинаковых запросов"""
+
+QUESTION = DnsQuestion('www.e1.ru.', 1, 1)
+
+
+class UpstreamPoolTest(unittest.TestCase):
+    def start(self, answer=None, **kwargs):
+        upstream = FakeUpstream(answer)
+        self.addCleanup(upstream.stop)
+        pool = UpstreamPool(UpstreamSelector([upstream.address]), **kwargs)
+        self.addCleanup(pool.close)
+        return upstream, pool
+
+    def test_answer(self):
+        upstream, pool = self.start()
+        response = DNSPacket.from_bytes(pool.query(QUESTION))
+        self.assertEqual(response.question, [QUESTION])
+        self.assertEqual(response.answer, [a_record('www.e1.ru.')])
+        self.assertEqual(response.packet_id, upstream.requests[0][0].packet_id)
+
+    def test_retry_after_lost_packet(self):
+        def answer(request):
+            return reply(request, [a_record('www.e1.ru.')]) if len(upstream.requests) > 1 else None
+
+        upstream, pool = self.start(answer, timeout=0.2, retries=2)
+        self.assertIsNotNone(pool.query(QUESTION))
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertEqual(pool.pending, {})
+
+    def test_gives_up(self):
+        upstream, pool = self.start(lambda request: None, timeout=0.1, retries=1)
+        self.assertIsNone(pool.query(QUESTION))
+        self.assertEqual(len(upstream.requests), 2)  # Первая попытка и один перезапрос
+        self.assertEqual(pool.pending, {})
+
+    def test_one_failure_per_question(self):
+        upstream, pool = self.start(lambda request: None, timeout=0.05, retries=2)
+        self.assertIsNone(pool.query(QUESTION))
+        self.assertEqual(len(upstream.requests), 3)
+        stats = pool.upstreams.upstreams[0]
+        self.assertEqual((stats.timeouts, stats.failures, stats.down_until), (1, 1, 0))
+
+    def test_reply_must_match_query(self):
+        def answer(request):
+            request.packet_id ^= 1  # Чужой идентификатор - как подделанный ответ
+            return reply(request, [a_record('www.e1.ru.')])
+
+        upstream, pool = self.start(answer, timeout=0.1, retries=0)
+        self.assertIsNone(pool.query(QUESTION))
+
+    def test_other_question_ignored(self):
+        def answer(request):
+            request.question = [DnsQuestion('evil.e1.ru.', 1, 1)]
+            return reply(request, [a_record('evil.e1.ru.')])
+
+        upstream, pool = self.start(answer, timeout=0.1, retries=0)
+        self.assertIsNone(pool.query(QUESTION))
+
+    def test_sockets_rotate(self):
+        upstream, pool = self.start(size=1, rotate_after=2)
+        for index in range(8):
+            self.assertIsNotNone(pool.query(DnsQuestion('host{}.e1.ru.'.format(index), 1, 1)))
+        ports = {addr[1] for _, addr in upstream.requests}
+        self.assertGreater(len(ports), 1)  # Запросы ушли с разных сокетов
+        self.assertEqual(len(pool.sockets), 1)
+
+
+class UpstreamSelectorTest(unittest.TestCase):
+    def setUp(self):
+        self.selector = UpstreamSelector([('10.0.0.1', 53), ('10.0.0.2', 53), ('10.0.0.3', 53)], timeout=0.5)
+        self.first, self.second, self.third = self.selector.upstreams
+        self.now = 100.0
+        for patcher in (mock.patch('DnsUpstream.time.monotonic', lambda: self.now),
+                        mock.patch('DnsUpstream.random.random', return_value=1.0)):  # Без случайных разведок
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_fastest_chosen(self):
+        self.selector.answered(self.first, 0.05)
+        self.selector.answered(self.second, 0.01)
+        self.assertIs(self.selector.choose(), self.third)  # Еще не отвечавший - чтобы получил свой замер
+        self.selector.answered(self.third, 0.03)
+        self.assertIs(self.selector.choose(), self.second)
+        self.assertIs(self.selector.choose(exclude=(self.second,)), self.third)
+
+    def test_srtt_smoothed(self):
+        self.selector.answered(self.first, 0.1)
+        self.selector.answered(self.first, 0.9)
+        self.assertAlmostEqual(self.first.srtt, 0.2)
+        self.selector.failed(self.first)  # Таймаут считается ответом через весь таймаут
+        self.assertAlmostEqual(self.first.srtt, 0.2375)
+
+    def test_backoff_after_failures(self):
+        for stats in (self.second, self.third):
+            self.selector.answered(stats, 0.1)
+        for _ in range(UPSTREAM_MAX_FAILURES - 1):
+            self.selector.failed(self.first)
+        self.assertEqual(self.first.down_until, 0)  # Пока просто медленный
+        self.selector.failed(self.first)
+        self.assertGreater(self.first.down_until, self.now)
+        self.assertIsNot(self.selector.choose(), self.first)
+        self.now = self.first.down_until
+        self.assertIsNot(self.selector.choose(), self.first)  # Ожил, но теперь он самый медленный
+        self.selector.answered(self.first, 0.001)
+        self.assertEqual((self.first.failures, self.first.down_until), (0, 0))
+
+    def test_backoff_grows(self):
+        for _ in range(UPSTREAM_MAX_FAILURES):
+            self.selector.failed(self.first)
+        first_pause = self.first.down_until - self.now
+        self.selector.failed(self.first)
+        self.assertAlmostEqual(self.first.down_until - self.now, first_pause * 2)
+
+    def test_all_down(self):
+        for index, stats in enumerate(self.selector.upstreams):
+            for _ in range(UPSTREAM_MAX_FAILURES + 2 - index):
+                self.selector.failed(stats)
+        self.assertIs(self.selector.choose(), self.third)  # Встанет раньше всех
+
+    def test_hedge_delay(self):
+        self.assertEqual(self.selector.hedge_delay(self.first), 0.25)  # Замеров мало - половина таймаута
+        for index in range(20):
+            self.selector.answered(self.first, 0.001 * (index + 1))
+        self.assertAlmostEqual(self.selector.hedge_delay(self.first), 0.02)
+        self.assertIsNot(self.selector.other(self.first), self.first)
+        self.assertIsNone(UpstreamSelector([('10.0.0.1', 53)]).other(self.first))
+
+
+class HedgeTest(unittest.TestCase):
+    def test_second_upstream_answers(self):
+        silent, alive = FakeUpstream(lambda request: None), FakeUpstream()
+        for upstream in (silent, alive):
+            self.addCleanup(upstream.stop)
+        selector = UpstreamSelector([silent.address, alive.address], timeout=0.4)
+        pool = UpstreamPool(selector, timeout=0.4, retries=0, hedge=True)
+        self.addCleanup(pool.close)
+        with mock.patch('DnsUpstream.random.random', return_value=1.0):
+            response = pool.query(QUESTION)
+        self.assertEqual(DNSPacket.from_bytes(response).answer, [a_record('www.e1.ru.')])
+        self.assertEqual((len(silent.requests), len(alive.requests)), (1, 1))
+        self.assertEqual((selector.hedged, selector.hedge_wins), (1, 1))
+        self.assertEqual(selector.upstreams[1].answered, 1)
+
+    def test_hedge_gets_own_timeout(self):
+        silent, alive = FakeUpstream(lambda request: None), FakeUpstream()
+        for upstream in (silent, alive):
+            self.addCleanup(upstream.stop)
+        selector = UpstreamSelector([silent.address, alive.address], timeout=0.2)
+        for _ in range(8):
+            selector.answered(selector.upstreams[0], 0.3)  # Перцентиль упирается в таймаут
+            selector.answered(selector.upstreams[1], 0.5)
+        pool = UpstreamPool(selector, timeout=0.2, retries=0, hedge=True)
+        self.addCleanup(pool.close)
+        with mock.patch('DnsUpstream.random.random', return_value=1.0):
+            self.assertIsNotNone(pool.query(QUESTION))
+        self.assertEqual((selector.upstreams[0].timeouts, selector.upstreams[1].timeouts), (0, 0))
+
+    def test_no_hedge_when_fast(self):
+        first, second = FakeUpstream(), FakeUpstream()
+        for upstream in (first, second):
+            self.addCleanup(upstream.stop)
+        selector = UpstreamSelector([first.address, second.address], timeout=0.4)
+        pool = UpstreamPool(selector, timeout=0.4, retries=0, hedge=True)
+        self.addCleanup(pool.close)
+        with mock.patch('DnsUpstream.random.random', return_value=1.0):
+            self.assertIsNotNone(pool.query(QUESTION))
+        self.assertEqual(len(first.requests) + len(second.requests), 1)
+        self.assertEqual(selector.hedged, 0)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_same_key_asked_once(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def ask():
+            calls.append(1)
+            release.wait()
+            return ['answer']
+
+        threads = [threading.Thread(target=lambda: results.append(flights.do('key', ask))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(wait_until(lambda: flights.sent + flights.saved == 5))  # Все пять потоков спросили
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['answer']] * 5)
+        self.assertEqual((flights.sent, flights.saved), (1, 4))
+        self.assertEqual(flights.flights, {})
+
+    def test_failed_leader_wakes_followers(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def fail():
+            started.set()
+            release.wait()
+            raise OSError('boom')
+
+        def leader():
+            with self.assertRaises(OSError):
+                flights.do('key', fail)
+
+        threads = [threading.Thread(target=leader)]
+        threads[0].start()
+        started.wait()
+        threads.append(threading.Thread(target=lambda: results.append(flights.do('key', lambda: ['never']))))
+        threads[1].start()
+        self.assertTrue(wait_until(lambda: flights.saved == 1))
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [None])  # Ждавшему достается None, а не вечное ожидание
+        self.assertEqual(flights.do('key', lambda: ['again']), ['again'])  # Ключ снова свободен
+
+    def test_async_same_key_asked_once(self):
+        calls = []
+
+        async def ask():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ['answer']
+
+        async def main():
+            flights = AsyncSingleFlight(asyncio.get_running_loop())
+            results = await asyncio.gather(*[flights.do('key', ask) for _ in range(5)],
+                                           flights.do('other', ask))
+            return flights, results
+
+        flights, results = asyncio.run(main())
+        self.assertEqual(results, [['answer']] * 6)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((flights.sent, flights.saved), (2, 4))
+        self.assertEqual(flights.flights, {})
+
+
+if __name__ == '__main__':
+    unittest.main()